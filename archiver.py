@@ -1,9 +1,25 @@
-from flask import Flask, request
+from flask import Flask, request, jsonify, g, make_response
 from flask_cors import CORS, cross_origin
 import logging
+import time
 import traceback
 
 import aux
+import blobs
+import bulk
+import bundle
+import cache
+import catalog
+import compression
+import delta
+import download
+import jobs
+import mailer
+import metrics
+import pool
+import sessions
+import tiers
+import transcode
 
 
 # WSGI application name
@@ -14,6 +30,16 @@ app.config['CORS_HEADERS'] = 'Content-Type'
 # Data archive storage location
 datapath = aux.get_config('storage')
 
+# Response and session cache sizes and lifetimes
+cache.configure()
+sessions.configure()
+
+# Largest page /archives/list will return when a limit is given
+LIST_MAX_LIMIT = int(aux.get_config('list_max_limit', 1000))
+
+# Whether archive downloads are sent from Python or by the front-end proxy
+OFFLOAD = download.offload_mode()
+
 # Configure the log file
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -24,6 +50,91 @@ log_handle.setFormatter(log_format)
 logger.addHandler(log_handle)
 
 
+@app.before_request
+def start_workers():
+    """Make sure this process is draining the job queue and the outbox."""
+    jobs.ensure_workers()
+    mailer.ensure_sender()
+
+
+# Drain the queue as soon as a process is up, not on its first request, so
+# jobs left queued by a restart do not wait for traffic. uwsgi loads the app
+# in the master, so workers are started in each process after the fork.
+try:
+    from uwsgidecorators import postfork
+except ImportError:
+    start_workers()
+else:
+    postfork(start_workers)
+
+
+@app.before_request
+def start_timer():
+    """Note when a request started and count it as in flight."""
+    g.metrics_route = request.url_rule.rule if request.url_rule else 'none'
+    g.metrics_start = time.perf_counter()
+    metrics.IN_FLIGHT.inc(route=g.metrics_route)
+
+
+@app.after_request
+def record_latency(response):
+    """Observe the time taken to build the response."""
+    if 'metrics_start' in g:
+        metrics.REQUEST_SECONDS.observe(
+            time.perf_counter() - g.metrics_start, route=g.metrics_route,
+            method=request.method, status=response.status_code)
+    return response
+
+
+@app.teardown_request
+def end_timer(error=None):
+    """Stop counting the request and publish this worker's metrics."""
+    if 'metrics_start' in g:
+        metrics.IN_FLIGHT.dec(route=g.metrics_route)
+    metrics.flush()
+
+
+# /stats values that only ever grow; the rest are levels or settings
+COUNTER_STATS = ('created', 'closed', 'borrowed', 'waits', 'timeouts',
+                 'health_failures', 'wait_seconds_total', 'hits', 'misses',
+                 'loads')
+
+
+@metrics.collector
+def service_stats():
+    """Export the pool, cache and index counters shown on /stats.
+
+    Growing counts go to a <name>_total counter family, summed across
+    processes; sizes and settings stay in the <name> gauge family.
+    """
+    families = [('archiver_db_pool', 'Database connection pool counters',
+                 pool.stats()),
+                ('archiver_response_cache', 'Response cache counters',
+                 cache.responses.stats()),
+                ('archiver_session_cache', 'Session cache counters',
+                 sessions.stats()),
+                ('archiver_catalog', 'Archive index counters',
+                 catalog.archives.stats()),
+                ('archiver_outbox', 'Outbox messages by state',
+                 mailer.pending())]
+
+    result = list()
+    for name, documentation, stats in families:
+        values = {(('stat', key),): value for key, value in stats.items()
+                  if key != 'pid' and isinstance(value, (int, float))}
+        gauges = {labels: value for labels, value in values.items()
+                  if labels[0][1] not in COUNTER_STATS}
+        counters = {labels: value for labels, value in values.items()
+                    if labels[0][1] in COUNTER_STATS}
+        if gauges:
+            result.append((name, documentation, gauges))
+        if counters:
+            result.append((name + '_total', documentation, counters,
+                           'counter'))
+
+    return result
+
+
 @app.errorhandler(404)
 @cross_origin()
 def not_found(error):
@@ -52,48 +163,351 @@ def schema():
     logger.info('Database schema access')
     return aux.schema_read()
 
+@app.route('/stats')
+@cross_origin()
+def stats():
+    """Report connection pool, cache and index usage for this worker."""
+    return jsonify({'db_pool': pool.stats(),
+                    'response_cache': cache.responses.stats(),
+                    'catalog': catalog.archives.stats(),
+                    'sessions': sessions.stats(),
+                    'outbox': mailer.pending()})
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Report metrics for all workers in the Prometheus text format."""
+    from flask import Response
+
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+def list_filters(args):
+    """Parse /archives/list query parameters into aux.list_query filters."""
+    from datetime import date
+
+    filters = dict()
+
+    for name in ('limit', 'after_archive_no', 'enterer_no'):
+        if name in args:
+            filters[name] = int(args[name])
+
+    limit = filters.get('limit')
+    if limit is not None and not 0 < limit <= LIST_MAX_LIMIT:
+        raise ValueError(f'limit must be between 1 and {LIST_MAX_LIMIT}')
+
+    if 'status' in args:
+        filters['status'] = args['status']
+
+    for name in ('created_after', 'created_before'):
+        if name in args:
+            filters[name] = date.fromisoformat(args[name]).isoformat()
+
+    if 'doi' in args:
+        flag = args['doi'].lower()
+        if flag in ('1', 'true', 'yes', 'present'):
+            filters['has_doi'] = True
+        elif flag in ('0', 'false', 'no', 'absent'):
+            filters['has_doi'] = False
+        else:
+            raise ValueError('doi must be present or absent')
+
+    return filters
+
 @app.route('/archives/list')
 @cross_origin()
 def info():
-    """Return information about existing data archives."""
+    """Return information about existing data archives.
+
+    Optional query parameters: limit and after_archive_no for keyset
+    pagination (pass the last archive_no of a page to get the next one),
+    enterer_no, status, created_after, created_before (YYYY-MM-DD) and
+    doi=present|absent. format=ndjson or stream=1 stream rows straight from
+    the database cursor instead of building the whole list.
+    """
+    from flask import Response, json, stream_with_context
+
     logger.info('List path access')
-    return aux.archive_summary()
+
+    try:
+        filters = list_filters(request.args)
+    except ValueError as e:
+        return aux.responder(f'Parameter error - {e}', 400)
+
+    if request.args.get('format') == 'ndjson':
+        rows = (json.dumps(row) + '\n' for row in aux.iter_archives(**filters))
+        return Response(stream_with_context(rows),
+                        mimetype='application/x-ndjson')
+
+    if request.args.get('stream'):
+        def array():
+            yield '['
+            for i, row in enumerate(aux.iter_archives(**filters)):
+                yield (',' if i else '') + json.dumps(row)
+            yield ']\n'
+        return Response(stream_with_context(array()),
+                        mimetype='application/json')
+
+    return cache.cached_json(('list', tuple(sorted(filters.items()))),
+                             lambda: aux.archive_summary(**filters))
 
 
 @app.route('/archives/retrieve/<int:archive_no>', methods=['GET'])
 @cross_origin()
 def retrieve(archive_no):
     """Retrieve an existing archive given an archive number."""
-    from flask import send_from_directory
-
     try:
-        filename = ''.join([str(archive_no), '.bz2'])
+        if not archive_no:
+            logger.info('Unspecified archive number')
+            return aux.responder('Unspecified archive number', 400, archive_no)
+
+        # Missing, failed and unfinished archives are answered from the index
+        entry = catalog.lookup(archive_no)
+        if entry is None:
+            logger.info('Archive {0:d} not found'.format(archive_no))
+            return aux.responder('Archive not found', 404, archive_no)
+
+        # Never serve a file known to be truncated or damaged
+        if catalog.damaged(entry):
+            logger.error(f'Archive {archive_no} failed integrity check: '
+                         f'{entry.integrity}, {entry.size} bytes on disk, '
+                         f'{entry.expected_size} recorded')
+            return aux.responder('Archive damaged', 500, archive_no)
+
+        tiers.touch(archive_no)
+
+        # Delta archives are rebuilt from their chain of base archives
+        if entry.base is not None:
+            try:
+                links = delta.chain(entry)
+            except (delta.DeltaError, tiers.TierError) as e:
+                logger.error(f'Archive {archive_no} cannot be rebuilt: {e}')
+                return aux.responder('Archive damaged', 500, archive_no)
+
+        try:
+            # Decompressed or converted forms instead of the archive file
+            fmt = request.args.get('format')
+            if fmt:
+                return retrieve_derived(entry, fmt)
+
+            if entry.base is not None:
+                return retrieve_delta(entry, links)
+
+            if entry.cold:
+                return retrieve_cold(entry)
 
-        file_type = aux.get_file_type(archive_no)
+        except tiers.TierError as e:
+            logger.error(f'Archive {archive_no} unavailable: {e}')
+            return aux.responder('Archive unavailable', 503, archive_no)
+
+        archive_codec = compression.get(entry.codec)
+
+        filename = ''.join([str(archive_no), archive_codec.extension])
 
         attachment_filename = ''.join(['pbdb_archive_',
                                        str(archive_no),
-                                       file_type,
-                                       '.bz2'])
+                                       entry.file_type,
+                                       archive_codec.extension])
 
-        if archive_no:
-            try:
-                return send_from_directory(datapath,
-                                           filename,
-                                           as_attachment=True,
-                                           attachment_filename=attachment_filename,
-                                           mimetype='application/x-compressed')
+        try:
+            if OFFLOAD == 'none':
+                response = download.send_archive(
+                    entry.path, archive_no, attachment_filename,
+                    archive_codec.mimetype, st=entry.stat)
+            else:
+                response = download.offload_archive(
+                    entry.path, filename, attachment_filename,
+                    archive_codec.mimetype, mode=OFFLOAD)
+
+            logger.info('Retrieved archive {0:d} ({1:d})'.format(
+                archive_no, response.status_code))
+            metrics.TIER_READS.inc(tier='hot')
+            return response
 
-                logger.info('Retrieved archive {0:d}'.format(archive_no))
+        except Exception as e:
+            logger.info('Retrieval error archive {0:d}'.format(archive_no))
+            logger.info(e)
+            return aux.responder('Retrieval error', 500, archive_no)
 
-            except Exception as e:
-                logger.info('Retrieval error archive {0:d}'.format(archive_no))
-                logger.info(e)
-                return aux.responder('Retrieval error', 500, archive_no)
+    except Exception as e:
+        logger.error(e)
+        logger.error(traceback.format_exc())
+        return aux.responder('Error', 509)
+
+def retrieve_delta(entry, links):
+    """Stream a delta archive rebuilt and compressed with its codec."""
+    from flask import Response
+
+    archive_codec = compression.get(entry.codec)
+    attachment_filename = ''.join(['pbdb_archive_',
+                                   str(entry.archive_no),
+                                   entry.file_type,
+                                   archive_codec.extension])
+
+    response = Response(delta.compressed(links, entry.codec),
+                        mimetype=archive_codec.mimetype)
+    response.headers['Content-Disposition'] = \
+        f'attachment; filename={attachment_filename}'
+    response.headers['Accept-Ranges'] = 'none'
+    logger.info(f'Retrieved archive {entry.archive_no} rebuilt from '
+                f'{len(links) - 1} deltas')
+    return response
+
+
+def retrieve_cold(entry):
+    """Send an archive from the cold tier and promote it in the background.
+
+    A cold tier on a mounted path is served like the hot tier; an object
+    store is streamed through without ranges.
+    """
+    from flask import Response
+
+    archive_no = entry.archive_no
+    archive_codec = compression.get(entry.codec)
+    attachment_filename = ''.join(['pbdb_archive_',
+                                   str(archive_no),
+                                   entry.file_type,
+                                   archive_codec.extension])
+
+    path = tiers.cold_path(entry)
+    if path is not None:
+        response = download.send_archive(path, archive_no,
+                                         attachment_filename,
+                                         archive_codec.mimetype)
+    else:
+        response = Response(tiers.read_cold(entry),
+                            mimetype=archive_codec.mimetype)
+        response.headers['Content-Disposition'] = \
+            f'attachment; filename={attachment_filename}'
+        response.headers['Accept-Ranges'] = 'none'
+        response.content_length = entry.expected_size
+
+    tiers.promote_soon(archive_no)
+    metrics.TIER_READS.inc(tier='cold')
+    logger.info(f'Retrieved archive {archive_no} from the cold tier '
+                f'({response.status_code})')
+    return response
+
+
+def retrieve_derived(entry, fmt):
+    """Send an archive decompressed (format=raw) or converted.
+
+    Converted forms are cached on disk; a miss streams the conversion to
+    the client while it is written to the cache.
+    """
+    from flask import Response
+
+    archive_no = entry.archive_no
 
+    try:
+        transcode.check(entry, fmt)
+    except transcode.Unsupported as e:
+        return aux.responder(f'Parameter error - {e}', 400, archive_no)
+
+    stem = f'pbdb_archive_{archive_no}'
+    if fmt == 'raw':
+        response = Response(transcode.content(entry),
+                            mimetype=transcode.raw_mimetype(entry.file_type))
+        attachment_filename = stem + entry.file_type
+    else:
+        _, mimetype, extension = transcode.FORMATS[fmt]
+        attachment_filename = stem + extension
+        digest = aux.get_content_hash(archive_no)
+        if not digest:
+            # Without a digest the cache key needs the file's stat
+            entry = tiers.local(entry)
+        path = transcode.cache_path(entry, fmt, digest)
+
+        st = transcode.cached(path)
+        if st is not None:
+            logger.info(f'Retrieved archive {archive_no} as {fmt} (cached)')
+            return download.send_archive(path, archive_no,
+                                         attachment_filename, mimetype,
+                                         st=st)
+
+        response = Response(transcode.convert(entry, fmt, path),
+                            mimetype=mimetype)
+
+    response.headers['Content-Disposition'] = \
+        f'attachment; filename={attachment_filename}'
+    logger.info(f'Retrieved archive {archive_no} as {fmt}')
+    return response
+
+@app.route('/archives/bundle', methods=['GET', 'POST'])
+@cross_origin()
+def bundle_archives():
+    """Stream several archives and their headers as one zip or tar file.
+
+    Archive numbers come from archive_no query parameters (repeated or
+    comma-separated) or an archive_nos list in a JSON body; format is zip
+    (default) or tar.
+    """
+    from flask import Response
+
+    try:
+        try:
+            archive_nos = set()
+            for value in request.args.getlist('archive_no'):
+                archive_nos.update(int(n) for n in value.split(',') if n)
+            if request.is_json:
+                archive_nos.update(int(n) for n in
+                                   request.json.get('archive_nos', []))
+        except (TypeError, ValueError):
+            return aux.responder('Parameter error - archive_no', 400)
+
+        bundle_format = request.args.get('format', 'zip')
+        if bundle_format not in bundle.FORMATS:
+            return aux.responder('Unsupported bundle format', 400)
+
+        max_archives = int(aux.get_config('bundle_max_archives', 100))
+        if not archive_nos:
+            return aux.responder('Missing archive_no', 400)
+        if len(archive_nos) > max_archives:
+            return aux.responder(f'At most {max_archives} archives per '
+                                 'bundle', 400)
+
+        entries = {n: catalog.lookup(n) for n in archive_nos}
+        missing = sorted(n for n, entry in entries.items()
+                         if entry is None or catalog.damaged(entry))
+        if missing:
+            logger.info(f'Bundle missing archives {missing}')
+            return aux.responder('Archives not found: ' +
+                                 ','.join(str(n) for n in missing), 404)
+
+        members = bundle.open_members(tiers.local(entry)
+                                      for entry in entries.values())
+        first, last = min(archive_nos), max(archive_nos)
+        filename = f'pbdb_archives_{first}-{last}.{bundle_format}'
+
+        if bundle_format == 'tar':
+            response = Response(bundle.stream_tar(members),
+                                mimetype=bundle.FORMATS['tar'])
+            response.content_length = bundle.tar_size(members)
         else:
-            logger.info('Unspecified archive number')
-            return aux.responder('Unspecified archive number', 400, archive_no)
+            response = Response(bundle.stream_zip(members),
+                                mimetype=bundle.FORMATS['zip'])
+
+        response.headers['Content-Disposition'] = \
+            f'attachment; filename={filename}'
+        logger.info(f'Bundling archives {sorted(archive_nos)}')
+        return response
+
+    except Exception as e:
+        logger.error(e)
+        logger.error(traceback.format_exc())
+        return aux.responder('Error', 509)
+
+@app.route('/archives/status/<int:archive_no>', methods=['GET'])
+@cross_origin()
+def status(archive_no):
+    """Report creation progress for an archive."""
+    try:
+        archive_status = aux.get_status(archive_no)
+        if archive_status is None:
+            return aux.responder('Archive not found', 404, archive_no)
+
+        return jsonify({'archive_no': archive_no,
+                        'status': archive_status,
+                        'job': jobs.job_info(archive_no)})
 
     except Exception as e:
         logger.error(e)
@@ -105,7 +519,8 @@ def retrieve(archive_no):
 def view(archive_no):
     """Retrieve details on a single archive."""
     logger.info('View path access')
-    return aux.view_archive(archive_no)
+    return cache.cached_json(('view', archive_no),
+                             lambda: aux.view_archive(archive_no))
 
 
 @app.route('/archives/delete/<int:archive_no>', methods=['GET'])
@@ -128,14 +543,31 @@ def delete(archive_no):
             return aux.responder('Client error - Invalid credentials(2)', 400)
 
         try:
+            # Look up the stored format before the record goes away
+            try:
+                codec = aux.archive_format(archive_no)[1]
+            except KeyError:
+                codec = compression.DEFAULT
+            digest = aux.get_content_hash(archive_no)
+            entry = catalog.lookup(archive_no)
+
+            # Archives stored as deltas of this one need their own copy
+            for dependent in aux.delta_dependents(archive_no):
+                delta.materialize(dependent)
+
             # Remove DB record
             aux.delete_archive(archive_no)
 
             # Remove actual data file and data service response header
             realpath = '/'.join([datapath, str(archive_no)])
             headerpath = f'{realpath}.header'
-            archivepath = f'{realpath}.bz2'
-            syscall = subprocess.run(['rm', headerpath, archivepath])
+            archivepath = realpath + compression.get(codec).extension
+            syscall = subprocess.run(['rm', '-f', headerpath])
+            if entry is not None and entry.base is not None:
+                blobs.release(entry.path)
+            else:
+                blobs.release(archivepath, digest, codec)
+            tiers.discard(archive_no, codec)
 
             logger.info(f'Files deleted: {headerpath}, {archivepath}')
             return aux.responder('Success', 200, archive_no)
@@ -199,11 +631,7 @@ def update(archive_no):
 @app.route('/archives/create', methods=['POST'])
 @cross_origin()
 def create():
-    """Create an archive file on disk."""
-    import subprocess
-    import os
-    from datetime import datetime as dt
-    import time
+    """Queue creation of an archive file on disk."""
 
     try:
         # Attempt to find session_id in the payload (testing only)
@@ -215,13 +643,15 @@ def create():
  
         # Determine authorizer and enter numbers from the session_id
         try:
-            auth, ent = aux.user_info(session_id)
+            with metrics.STAGE_SECONDS.time(stage='auth'):
+                principal = sessions.get(session_id)
+            auth, ent = principal.authorizer_no, principal.enterer_no
         except Exception as e:
             logger.info(e)
             return aux.responder('Client error - Invalid session ID', 400)
  
         # Determine if the user has an ORCID
-        has_orcid = aux.check_for_orcid(ent)
+        has_orcid = principal.has_orcid
         logger.info(f'Enter ID {ent} has ORCID {has_orcid}')
         if not has_orcid:
             return aux.responder('Missing ORCID', 403)
@@ -234,6 +664,9 @@ def create():
         # Extract components of data service call from payload
         path = request.json.get('uri_path')
         args = request.json.get('uri_args')
+
+        # Compression format of the archive file
+        codec = request.json.get('codec', compression.DEFAULT)
  
         # Parameter checks
         if not title:
@@ -248,77 +681,113 @@ def create():
         else:
             return aux.responder('Missing uri_path', 400)
 
+        if codec not in compression.CODECS:
+            return aux.responder('Unsupported codec', 400)
+
         # Build data service URI
-        base = aux.get_config('dataservice')
-        uri = ''.join([base, path, '?', args])
-        uri = uri.replace(' ', '%20')
+        uri = bulk.data_uri(path, args)
 
         # Initiate new record in database
         try:
-            aux.create_record(auth, ent, authors, title, desc, path, args)
-            logger.info('Record created. Enterer No: {0:d}'.format(ent))
+            with metrics.STAGE_SECONDS.time(stage='db_insert'):
+                archive_no = aux.create_record(auth, ent, authors, title,
+                                               desc, path, args, codec)
+            logger.info('Record created. Archive No: {0:d}'.format(archive_no))
         except Exception as e:
             logger.info(e)
             return aux.responder('Server error - Record creation', 500)
 
-        time.sleep(2)
- 
-        # Read archive_no back from the table and create filename
+        # Hand the download, compression and DOI email to a worker
         try:
-            archive_no = aux.get_archive_no(ent)
-            logger.info('Record created. Archive No: {0:d}'.format(archive_no))
+            jobs.enqueue(archive_no, {'session_id': session_id,
+                                      'auth': auth,
+                                      'uri': uri,
+                                      'title': title,
+                                      'authors': authors,
+                                      'ent': ent,
+                                      'email': principal.email,
+                                      'codec': codec})
         except Exception as e:
             logger.info(e)
             aux.archive_status(archive_no, success=False)
-            return aux.responder('Server error - Archive number not found', 500, archive_no)
- 
-        # Append the data path and remove extra "/" if one was added in config
-        realpath = '/'.join([datapath, str(archive_no)])
-        realpath = realpath.replace('//', '/')
- 
-        # Use cURL to retrive the dataset
-        token = '='.join(['session_id', session_id])
-        headerpath = realpath + '.header'
-        syscall = subprocess.run(['curl', '-s', '--cookie', token,
-                                  '-o', realpath, '-D', headerpath, uri])
- 
-        # Check to see that there were no errors in the data service return
-        if syscall.returncode != 0 or not os.path.exists(headerpath):
-            logger.info('Archive download error')
-            aux.archive_status(archive_no, success=False)
-            return aux.responder('Server error - File retrieval', 500, archive_no)
-        with open(headerpath, 'r') as f:
-            content = f.readlines()
-            if '200' not in content[0]:
-                logger.info('Data service error')
-                aux.archive_status(archive_no, success=False)
-                return aux.responder('Server error - Data service', 500, archive_no)
- 
-        # Compress and replace the retrieved dataset on disk
-        syscall = subprocess.run(['bzip2', '-f', realpath])
-        if syscall.returncode != 0:
-            logger.info('Archive compression error')
-            aux.archive_status(archive_no=archive_no, success=False)
-            return aux.responder('Server error - File compression', 500, archive_no)
- 
-        # Archive was successfully created on disk
-        logger.info('Created archive number: {0:d}'.format(archive_no))
-        aux.archive_status(archive_no=archive_no, success=True)
- 
-        # Determine the current year
-        yr = dt.now().year
- 
-        # Dispatch email requesting DOI
-        result = aux.request_doi(archive_no, title, yr, authors, ent)
-        if result == 0:
-            logger.info('DOI email sent')
-        else:
-            logger.info(f'Server error - Email: {result}')
- 
-        # Return 200 OK
-        return aux.responder('success', 200, archive_no)
+            return aux.responder('Server error - Job queue', 500, archive_no)
+
+        logger.info('Queued archive number: {0:d}'.format(archive_no))
+        return aux.responder('accepted', 202, archive_no)
 
     except Exception as e:
         logger.error(e)
         logger.error(traceback.format_exc())
         return aux.responder('Error', 509)
+
+
+@app.route('/archives/bulk', methods=['POST'])
+@cross_origin()
+def bulk_create():
+    """Queue creation of many archives from a JSON list or CSV upload.
+
+    Records for all valid specs are inserted in one transaction and their
+    jobs queued as one batch, of which at most concurrency (default
+    bulk_concurrency) run at once. Invalid specs are reported per item.
+    """
+    try:
+        content_type = request.content_type or ''
+        body = request.get_data()
+
+        try:
+            specs = bulk.parse(body, content_type)
+        except bulk.BulkError as e:
+            return aux.responder(f'Parameter error - {e}', 400)
+
+        # Session from the JSON payload (testing only) or the browser cookie
+        session_id = request.cookies.get('session_id')
+        if 'json' in content_type:
+            payload = request.get_json(silent=True)
+            if isinstance(payload, dict) and payload.get('session_id'):
+                session_id = payload['session_id']
+
+        try:
+            principal = sessions.get(session_id)
+        except Exception as e:
+            logger.info(e)
+            return aux.responder('Client error - Invalid session ID', 400)
+
+        if not principal.has_orcid:
+            return aux.responder('Missing ORCID', 403)
+
+        try:
+            concurrency = request.args.get('concurrency', type=int)
+            batch, results = bulk.create(principal, session_id, specs,
+                                         concurrency)
+        except bulk.BulkError as e:
+            return aux.responder(f'Parameter error - {e}', 400)
+        except Exception as e:
+            logger.info(e)
+            return aux.responder('Server error - Record creation', 500)
+
+        if batch is None:
+            return make_response(jsonify({'message': 'No valid archives',
+                                          'status': 400,
+                                          'archives': results}), 400)
+
+        queued = sum(1 for r in results if 'archive_no' in r)
+        logger.info(f'Queued bulk batch {batch}: {queued} of {len(results)}')
+        return make_response(jsonify({'message': 'accepted',
+                                      'status': 202,
+                                      'batch': batch,
+                                      'archives': results}), 202)
+
+    except Exception as e:
+        logger.error(e)
+        logger.error(traceback.format_exc())
+        return aux.responder('Error', 509)
+
+@app.route('/archives/bulk/<batch>', methods=['GET'])
+@cross_origin()
+def bulk_status(batch):
+    """Report progress of a bulk creation batch."""
+    progress = bulk.progress(batch)
+    if not progress['total']:
+        return aux.responder('Batch not found', 404)
+
+    return jsonify(progress)
@@ -0,0 +1,346 @@
+"""Asyncio (ASGI) serving mode for the archive API.
+
+Usage:
+
+    uvicorn asgi:app --workers 2 --port 6002
+
+Serves the same routes and responses as archiver.py. Under uwsgi every
+request holds a worker thread until its last byte is sent, so a few slow
+downloads fill the processes x threads slots. Here a request only holds a
+thread while Python code runs for it: Flask builds the response in a
+bounded thread pool (asgi_threads per process), each body chunk is read in
+that pool, and the wait for the client to accept it happens on the event
+loop. Thousands of slow downloads and status polls can then share a couple
+of processes.
+
+Status polls, the most frequent request while archives are being built,
+are answered on the event loop without Flask. Their database query goes
+through aiomysql when it is installed and through the connection pool in a
+thread otherwise.
+"""
+
+import asyncio
+import io
+import json
+import logging
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aux
+import jobs
+import mailer
+import metrics
+import pool
+import tiers
+
+try:
+    import aiomysql
+except ImportError:
+    aiomysql = None
+
+
+logger = logging.getLogger(__name__)
+
+STATUS_ROUTE = '/archives/status/<int:archive_no>'
+STATUS_PATH = re.compile(r'^/archives/status/(\d+)$')
+
+STATUS_SQL = """SELECT status
+                FROM data_archives
+                WHERE archive_no = %s
+                LIMIT 1
+             """
+
+_executor = None
+_db_pool = None
+
+
+def executor():
+    """Return this process's thread pool for blocking work."""
+    global _executor
+
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=int(aux.get_config('asgi_threads', 16)),
+            thread_name_prefix='asgi')
+    return _executor
+
+
+async def run_sync(func, *args):
+    """Run a blocking function in the thread pool."""
+    return await asyncio.get_running_loop().run_in_executor(executor(), func,
+                                                            *args)
+
+
+def flask_app():
+    import archiver
+
+    return archiver.app
+
+
+async def startup():
+    global _db_pool
+
+    await run_sync(jobs.ensure_workers)
+    await run_sync(mailer.ensure_sender)
+
+    if aiomysql is not None:
+        _db_pool = await aiomysql.create_pool(
+            read_default_file='./settings.cnf',
+            minsize=1,
+            maxsize=int(aux.get_config('db_pool_size', 4)),
+            autocommit=True)
+        logger.info('Status queries use aiomysql')
+
+
+async def shutdown():
+    global _db_pool
+
+    if _db_pool is not None:
+        _db_pool.close()
+        await _db_pool.wait_closed()
+        _db_pool = None
+
+    tiers.flush(force=True)
+    metrics.flush(force=True)
+
+
+def _fetch_one(sql, params):
+    with pool.connection() as db:
+        cursor = db.cursor()
+        cursor.execute(sql, params)
+        return cursor.fetchone()
+
+
+async def fetch_one(sql, params):
+    """Run a query and return its first row, without blocking the loop."""
+    start = time.perf_counter()
+    try:
+        if _db_pool is None:
+            return await run_sync(_fetch_one, sql, params)
+
+        async with _db_pool.acquire() as db:
+            async with db.cursor() as cursor:
+                await cursor.execute(sql, params)
+                return await cursor.fetchone()
+
+    finally:
+        metrics.DB_SECONDS.observe(time.perf_counter() - start,
+                                   function='asgi.fetch_one')
+
+
+def json_body(obj):
+    """Encode like Flask's jsonify."""
+    return (json.dumps(obj, sort_keys=True, separators=(',', ':')) +
+            '\n').encode()
+
+
+async def send_json(send, obj, status):
+    body = json_body(obj)
+    await send({'type': 'http.response.start',
+                'status': status,
+                'headers': [(b'content-type', b'application/json'),
+                            (b'content-length', str(len(body)).encode()),
+                            (b'access-control-allow-origin', b'*')]})
+    await send({'type': 'http.response.body', 'body': body})
+    return status
+
+
+async def status(send, archive_no):
+    """Report creation progress for an archive (see archiver.status)."""
+    try:
+        row = await fetch_one(STATUS_SQL, (archive_no,))
+        if row is None:
+            return await send_json(send, {'message': 'Archive not found',
+                                          'status': 404,
+                                          'pbdb_id': archive_no}, 404)
+
+        job = await run_sync(jobs.job_info, archive_no)
+        return await send_json(send, {'archive_no': archive_no,
+                                      'status': row[0],
+                                      'job': job}, 200)
+
+    except Exception as e:
+        logger.error(f'Status of archive {archive_no}: {e}')
+        return await send_json(send, {'message': 'Error', 'status': 509}, 509)
+
+
+def wsgi_environ(scope, body):
+    """Build a WSGI environ for an ASGI HTTP scope."""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    path = scope.get('raw_path') or scope['path'].encode()
+    query = scope.get('query_string', b'')
+
+    environ = {'REQUEST_METHOD': scope['method'],
+               'SCRIPT_NAME': scope.get('root_path', ''),
+               'PATH_INFO': path.split(b'?', 1)[0].decode('latin-1'),
+               'QUERY_STRING': query.decode('latin-1'),
+               'SERVER_NAME': server[0],
+               'SERVER_PORT': str(server[1]),
+               'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+               'REMOTE_ADDR': client[0],
+               'CONTENT_LENGTH': str(len(body)),
+               'wsgi.version': (1, 0),
+               'wsgi.url_scheme': scope.get('scheme', 'http'),
+               'wsgi.input': io.BytesIO(body),
+               'wsgi.errors': sys.stderr,
+               'wsgi.multithread': True,
+               'wsgi.multiprocess': True,
+               'wsgi.run_once': False}
+
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+            continue
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = 'HTTP_' + name
+        if key in environ:
+            sep = '; ' if name == 'COOKIE' else ', '
+            value = environ[key] + sep + value
+        environ[key] = value
+
+    return environ
+
+
+async def read_body(receive):
+    parts = list()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ConnectionError('Client disconnected')
+        parts.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(parts)
+
+
+async def wait_disconnect(receive):
+    """Return once the client has gone away."""
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+def _start(wsgi_app, environ):
+    """Call the WSGI app up to its first output.
+
+    Returns the start_response arguments, the body written so far, the
+    app's iterable and an iterator over the rest of it.
+    """
+    started = dict()
+    written = list()
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = headers
+        return written.append
+
+    iterable = wsgi_app(environ, start_response)
+    # Apps may defer start_response until the body is iterated
+    iterator = iter(iterable)
+    first = b'' if started else next(iterator, b'')
+
+    return started, written + [first], iterable, iterator
+
+
+async def call_wsgi(wsgi_app, scope, receive, send):
+    """Serve a request with a WSGI app, streaming its body from the loop.
+
+    Returns the response status, or None if the client disconnected before
+    its request body arrived. A client that disconnects while the body is
+    streamed stops the iteration, so an abandoned download does not go on
+    reading and decompressing the archive.
+    """
+    try:
+        body = await read_body(receive)
+    except ConnectionError:
+        logger.info(f'{scope["path"]}: client disconnected')
+        return None
+
+    environ = wsgi_environ(scope, body)
+    started, pending, iterable, iterator = await run_sync(_start, wsgi_app,
+                                                          environ)
+
+    if not started:
+        if hasattr(iterable, 'close'):
+            await run_sync(iterable.close)
+        logger.error(f'{scope["path"]}: response was never started')
+        return await send_json(send, {'message': 'Error', 'status': 500},
+                               500)
+
+    disconnected = asyncio.ensure_future(wait_disconnect(receive))
+    try:
+        await send({'type': 'http.response.start',
+                    'status': started['status'],
+                    'headers': [(name.lower().encode('latin-1'),
+                                 value.encode('latin-1'))
+                                for name, value in started['headers']]})
+
+        for chunk in pending:
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk,
+                            'more_body': True})
+
+        while True:
+            if disconnected.done():
+                logger.info(f'{scope["path"]}: client disconnected')
+                return started['status']
+            chunk = await run_sync(next, iterator, None)
+            if chunk is None:
+                break
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk,
+                            'more_body': True})
+
+        await send({'type': 'http.response.body', 'body': b''})
+
+    finally:
+        disconnected.cancel()
+        # Releases files and database cursors held by streamed bodies
+        if hasattr(iterable, 'close'):
+            await run_sync(iterable.close)
+
+    return started['status']
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                await startup()
+            except Exception as e:
+                await send({'type': 'lifespan.startup.failed',
+                            'message': str(e)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI entry point."""
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        raise ValueError(f'Unsupported ASGI scope {scope["type"]}')
+
+    match = STATUS_PATH.match(scope['path'])
+    if match is None or scope['method'] != 'GET':
+        return await call_wsgi(flask_app(), scope, receive, send)
+
+    metrics.IN_FLIGHT.inc(route=STATUS_ROUTE)
+    start = time.perf_counter()
+    try:
+        code = await status(send, int(match.group(1)))
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - start,
+                                        route=STATUS_ROUTE, method='GET',
+                                        status=code)
+    finally:
+        metrics.IN_FLIGHT.dec(route=STATUS_ROUTE)
+        metrics.flush()
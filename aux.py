@@ -1,5 +1,11 @@
 from flask import make_response, jsonify
 
+import cache
+import catalog
+import metrics
+import pool
+import sessions
+
 
 def responder(msg, status, pbdb_id=None):
     """Format a JSON response."""
@@ -12,421 +18,773 @@ def responder(msg, status, pbdb_id=None):
                                       'status': status}), status)
 
 
-def get_config(setting):
+def get_config(setting, default=None):
     """Retrive archive storage path from settings file."""
     import configparser
 
     config = configparser.ConfigParser()
     config.read('settings.cnf')
 
+    if default is not None and not config.has_option('environment', setting):
+        return default
+
     return str(config['environment'][setting])
 
 
-def request_doi(archive_no, title, yr, authors, ent):
-    """Dispatch email to specified addresses using UNIX sendmail."""
-    from email.mime.text import MIMEText
-    from subprocess import Popen, PIPE
+def request_doi(archive_no, title, yr, authors, ent, ent_email=None):
+    """Queue the DOI request email; return its outbox id."""
+    import mailer
 
-    try:
+    if not ent_email:
         ent_email = get_ent_email(ent)
-    
-        base = get_config('base')
-        default_emails = get_config('email')
-        email_addr = ','.join([default_emails, ent_email])
-    
-        body = f'URL: {base}/classic/app/archive/view?id={archive_no}\n'
-        body += f'Creators: {authors}\n'
-        body += f'Title: {title}\n'
-        body += 'Publisher: Paleobiology Database\n'
-        body += f'Publication Year: {yr}\n'
-        body += 'Resource Type: Dataset\n'
-        body += '========\n'
-        body += f'PBDB Archive ID Number: {archive_no}\n'
-        body += 'DOI: Pending\n'
-    
-        msg = MIMEText(body)
-    
-        msg['From'] = 'do-not-reply@paleobiodb.org'
-        msg['To'] = email_addr
-        msg['Subject'] = 'PBDB archive DOI request'
-    
-        p = Popen(['/usr/sbin/sendmail', '-t', '-oi'], stdin=PIPE)
-    
-        return p.communicate(msg.as_bytes())
-
-    except exception as e:
-        return e
 
+    # Enterers without an email on file still get their DOI requested
+    recipients = get_config('email').split(',') + [ent_email or '']
+    recipients = [addr.strip() for addr in recipients if addr.strip()]
 
-def check_for_orcid(ent):
-    """Check to see if a user has a stored ORCID."""
-    import MySQLdb
+    msg = mailer.doi_request(archive_no, title, yr, authors, recipients)
+
+    return mailer.enqueue(recipients, msg, archive_no)
 
-    db = MySQLdb.connect(read_default_file='./settings.cnf')
 
-    cursor = db.cursor()
-    sql = """SELECT orcid
-             FROM pbdb_wing.users
-             WHERE person_no = {0:d}
-          """.format(ent)
+@metrics.db_timer
+def check_for_orcid(ent):
+    """Check to see if a user has a stored ORCID."""
+    with pool.connection() as db:
+        cursor = db.cursor()
+        sql = """SELECT orcid
+                 FROM pbdb_wing.users
+                 WHERE person_no = {0:d}
+              """.format(ent)
 
-    cursor.execute(sql)
+        cursor.execute(sql)
 
-    for orcid in cursor:
-        orcid = orcid[0]
+        for orcid in cursor:
+            orcid = orcid[0]
 
-    return False if orcid == '' else True
+        return False if orcid == '' else True
 
 
+@metrics.db_timer
 def get_ent_email(ent):
     """Retrieve user email from the database."""
-    import MySQLdb
-
-    db = MySQLdb.connect(read_default_file='./settings.cnf')
-
-    cursor = db.cursor()
-    sql = """SELECT email
-             FROM pbdb_wing.users
-             WHERE person_no = {0:d}
-          """.format(ent)
+    with pool.connection() as db:
+        cursor = db.cursor()
+        sql = """SELECT email
+                 FROM pbdb_wing.users
+                 WHERE person_no = {0:d}
+              """.format(ent)
 
-    cursor.execute(sql)
+        cursor.execute(sql)
 
-    for email in cursor:
-        ent_email = email[0]
+        for email in cursor:
+            ent_email = email[0]
 
-    return ent_email
+        return ent_email
 
 
 def admin_check(session_id):
     """Validate credentials for update and create."""
-    import MySQLdb
+    return sessions.get(session_id).admin
 
-    db = MySQLdb.connect(read_default_file='./settings.cnf')
 
-    cursor = db.cursor()
-    sql = """SELECT user_id
-             FROM session_data
-             WHERE session_id = '{0:s}'
-          """.format(session_id)
+def user_info(session_id):
+    """Retrieve authorizer and enterer numbers based on browser cookie."""
+    principal = sessions.get(session_id)
 
-    cursor.execute(sql)
+    return principal.authorizer_no, principal.enterer_no
 
-    for user_id in cursor:
-        user_id = user_id[0]
 
-    cursor = db.cursor()
-    sql = """SELECT admin
-             FROM pbdb_wing.users
-             WHERE id = '{0:s}'
-          """.format(user_id)
+@metrics.db_timer
+def view_archive(archive_no):
+    """Retrieve metadata for a single record."""
+    with pool.connection() as db:
+        cursor = db.cursor()
 
-    cursor.execute(sql)
+        sql = """SELECT archive_no, title, doi, authors, created,
+                        description, uri_path, uri_args
+                 FROM data_archives
+                 WHERE archive_no = {0:d}
+                 LIMIT 1
+              """.format(archive_no)
 
-    for admin in cursor:
-        admin = admin[0]
+        cursor.execute(sql)
 
-    return False if admin == 0 else True
+        archives = list()
+        for archive_no, title, doi, authors, created, description, \
+                uri_path, uri_base in cursor:
 
+                archives.append({'archive_no': archive_no,
+                                 'title': title,
+                                 'doi': doi,
+                                 'authors': authors,
+                                 'created': created,
+                                 'description': description,
+                                 'uri_path': uri_path,
+                                 'uri_base': uri_base})
 
-def user_info(session_id):
-    """Retrieve authorizer and enterer numbers based on browser cookie."""
-    import MySQLdb
+        return jsonify(archives)
 
-    db = MySQLdb.connect(read_default_file='./settings.cnf')
 
-    cursor = db.cursor()
-    sql = """SELECT authorizer_no, enterer_no
-             FROM session_data
-             WHERE session_id = '{0:s}'
-          """.format(session_id)
+@metrics.db_timer
+def delete_archive(archive_no):
+    """Permanently remove a dataset from the system."""
+    with pool.connection() as db:
+        cursor = db.cursor()
 
-    cursor.execute(sql)
+        sql = """DELETE FROM data_archives
+                 WHERE archive_no = {0:d}
+                 LIMIT 1
+              """.format(archive_no)
 
-    for authorizer_no, enterer_no in cursor:
-        auth = authorizer_no
-        ent = enterer_no
+        try:
+            cursor.execute(sql)
+            db.commit()
+        except Exception as e:
+            db.rollback()
 
-    return auth, ent
+    cache.invalidate()
+    catalog.invalidate()
 
+    # TODO: delete from file system?
 
-def view_archive(archive_no):
-    """Retrieve metadata for a single record."""
-    import MySQLdb
 
-    db = MySQLdb.connect(read_default_file='./settings.cnf')
+@metrics.db_timer
+def archive_names():
+    """Return a hash of DOIs and actual filenames."""
+    with pool.connection() as db:
+        cursor = db.cursor()
 
-    cursor = db.cursor()
+        sql = """SELECT doi, filename
+                 FROM data_archives
+              """
 
-    sql = """SELECT archive_no, title, doi, authors, created,
-                    description, uri_path, uri_args
-             FROM data_archives
-             WHERE archive_no = {0:d}
-             LIMIT 1
-          """.format(archive_no)
+        cursor.execute(sql)
 
-    cursor.execute(sql)
+        doi_map = dict()
+        for doi, filename in cursor:
+            doi_map[doi.lower()] = filename
 
-    archives = list()
-    for archive_no, title, doi, authors, created, description, \
-            uri_path, uri_base in cursor:
+        return doi_map
 
-            archives.append({'archive_no': archive_no,
-                             'title': title,
-                             'doi': doi,
-                             'authors': authors,
-                             'created': created,
-                             'description': description,
-                             'uri_path': uri_path,
-                             'uri_base': uri_base})
 
-    db.close()
+@metrics.db_timer
+def schema_read():
+    """Dump the header info to check db connector."""
+    with pool.connection() as db:
+        cursor = db.cursor()
 
-    return jsonify(archives)
+        sql = """SHOW COLUMNS
+                 FROM data_archives
+              """
 
+        cursor.execute(sql)
 
-def delete_archive(archive_no):
-    """Permanently remove a dataset from the system."""
-    import MySQLdb
+        schema = list()
+        for row in cursor:
+            schema.append(row)
+
+        return make_response(jsonify(schema))
+
+
+def list_query(limit=None, after_archive_no=None, enterer_no=None,
+               status=None, created_after=None, created_before=None,
+               has_doi=None):
+    """Build the archive listing query and its parameters.
+
+    Pages are keyed on archive_no: pass the last archive_no of one page as
+    after_archive_no to fetch the next.
+    """
+    where = list()
+    params = list()
+
+    if after_archive_no is not None:
+        where.append('archive_no > %s')
+        params.append(after_archive_no)
+    if enterer_no is not None:
+        where.append('enterer_no = %s')
+        params.append(enterer_no)
+    if status is not None:
+        where.append('status = %s')
+        params.append(status)
+    if created_after is not None:
+        where.append('created >= %s')
+        params.append(created_after)
+    if created_before is not None:
+        where.append('created < %s')
+        params.append(created_before)
+    if has_doi is True:
+        where.append("doi IS NOT NULL AND doi <> ''")
+    elif has_doi is False:
+        where.append("(doi IS NULL OR doi = '')")
+
+    sql = """SELECT archive_no, title, doi, authors, created,
+                    description, uri_path, uri_args
+             FROM data_archives
+          """
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY archive_no'
+    if limit is not None:
+        sql += ' LIMIT %s'
+        params.append(limit)
+
+    return sql, params
+
+
+def summary_row(archive_no, title, doi, authors, created, description,
+                uri_path, uri_base):
+    """Format one data_archives row for the list and view responses."""
+    return {'archive_no': archive_no,
+            'title': title,
+            'doi': doi,
+            'authors': authors,
+            'created': created,
+            'description': description,
+            'uri_path': uri_path,
+            'uri_base': uri_base}
+
+
+@metrics.db_timer
+def archive_summary(**filters):
+    """Load archive information from database."""
+    with pool.connection() as db:
+        cursor = db.cursor()
 
-    db = MySQLdb.connect(read_default_file='./settings.cnf')
+        cursor.execute(*list_query(**filters))
 
-    cursor = db.cursor()
+        archives = [summary_row(*row) for row in cursor]
 
-    sql = """DELETE FROM data_archives
-             WHERE archive_no = {0:d}
-             LIMIT 1
-          """.format(archive_no)
+        return jsonify(archives)
 
+
+def stream_cursor(db):
+    """Open an unbuffered cursor so large results are not held in memory."""
     try:
-        cursor.execute(sql)
-        db.commit()
-    except Exception as e:
-        db.rollback()
+        import MySQLdb.cursors
+    except ImportError:
+        return db.cursor()
 
-    db.close()
+    return db.cursor(MySQLdb.cursors.SSCursor)
 
-    # TODO: delete from file system?
 
+@metrics.db_timer
+def iter_archives(batch_size=500, **filters):
+    """Yield archive rows one at a time straight from the cursor."""
+    with pool.connection() as db:
+        cursor = stream_cursor(db)
 
-def archive_names():
-    """Return a hash of DOIs and actual filenames."""
-    import MySQLdb
+        cursor.execute(*list_query(**filters))
 
-    db = MySQLdb.connect(read_default_file='./settings.cnf')
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield summary_row(*row)
 
-    cursor = db.cursor()
+        cursor.close()
 
-    sql = """SELECT doi, filename
-             FROM data_archives
-          """
 
-    cursor.execute(sql)
+@metrics.db_timer
+def archive_status(archive_no, success=None, stage=None):
+    """Set the archive creation status in the table."""
+    if stage:
+        status = stage
+    elif success:
+        status = 'complete'
+    else:
+        status = 'fail'
 
-    doi_map = dict()
-    for doi, filename in cursor:
-        doi_map[doi.lower()] = filename
+    with pool.connection() as db:
+        cursor = db.cursor()
 
-    return doi_map
+        sql = """UPDATE data_archives
+                 SET status = '{0:s}'
+                 WHERE archive_no = {1:d}
+              """.format(status, archive_no)
 
+        try:
+            cursor.execute(sql)
+            db.commit()
+        except Exception as e:
+            db.rollback()
 
-def schema_read():
-    """Dump the header info to check db connector."""
-    import MySQLdb
+    cache.invalidate()
+    # Other statuses are only set while an archive is being built
+    if status == 'complete':
+        catalog.invalidate()
 
-    db = MySQLdb.connect(read_default_file='./settings.cnf')
 
-    cursor = db.cursor()
+@metrics.db_timer
+def get_status(archive_no):
+    """Return the status column for an archive, or None if it is unknown."""
+    with pool.connection() as db:
+        cursor = db.cursor()
 
-    sql = """SHOW COLUMNS
-             FROM data_archives
-          """
+        sql = """SELECT status
+                 FROM data_archives
+                 WHERE archive_no = {0:d}
+                 LIMIT 1
+              """.format(archive_no)
 
-    cursor.execute(sql)
+        cursor.execute(sql)
 
-    schema = list()
-    for row in cursor:
-        schema.append(row)
+        row = cursor.fetchone()
 
-    return make_response(jsonify(schema))
+        return None if row is None else row[0]
 
 
-def archive_summary():
-    """Load archive information from database."""
-    import MySQLdb
+@metrics.db_timer
+def archive_format(archive_no):
+    """Return the file type extension and compression codec of an archive."""
+    with pool.connection() as db:
+        cursor = db.cursor()
 
-    db = MySQLdb.connect(read_default_file='./settings.cnf')
+        sql = """SELECT uri_path, codec
+                 FROM data_archives
+                 WHERE archive_no = {0:d}
+                 LIMIT 1
+              """.format(archive_no)
 
-    cursor = db.cursor()
+        cursor.execute(sql)
 
-    sql = """SELECT archive_no, title, doi, authors, created,
-                    description, uri_path, uri_args
-             FROM data_archives
-          """
+        row = cursor.fetchone()
 
-    cursor.execute(sql)
+        if row is None:
+            raise KeyError(archive_no)
 
-    archives = list()
-    for archive_no, title, doi, authors, created, description, \
-            uri_path, uri_base in cursor:
+        uri_path, codec = row
 
-            archives.append({'archive_no': archive_no,
-                             'title': title,
-                             'doi': doi,
-                             'authors': authors,
-                             'created': created,
-                             'description': description,
-                             'uri_path': uri_path,
-                             'uri_base': uri_base})
+        return uri_path[uri_path.rfind('.'):], codec or 'bz2'
 
-    db.close()
 
-    return jsonify(archives)
+@metrics.db_timer
+def archive_catalog():
+    """Return (archive_no, uri_path, codec, status, file_size, integrity,
+    base_archive_no, content_size, cold_copy, file_sha256) for every
+    archive."""
+    with pool.connection() as db:
+        cursor = db.cursor()
 
+        sql = """SELECT archive_no, uri_path, codec, status, file_size,
+                        integrity, base_archive_no, content_size, cold_copy,
+                        file_sha256
+                 FROM data_archives
+              """
 
-def archive_status(archive_no, success):
-    """Set the archive creation status in the table."""
-    import MySQLdb
+        cursor.execute(sql)
 
-    db = MySQLdb.connect(read_default_file='./settings.cnf')
+        return cursor.fetchall()
 
-    cursor = db.cursor()
 
-    if success:
-        sql = """UPDATE data_archives
-                 SET status = '{0:s}'
-                 WHERE archive_no = {1:d}
-              """.format('complete', archive_no)
-    else:
+def get_file_type(archive_no):
+    """Determine file type of the archive and return an extension."""
+    return archive_format(archive_no)[0]
+
+
+@metrics.db_timer
+def set_codec(archive_no, codec, file_sha256=None, file_size=None):
+    """Record the codec an archive file is stored with.
+
+    The checksums of the new file, when given, are switched over in the
+    same update so readers never see one without the other.
+    """
+    with pool.connection() as db:
+        cursor = db.cursor()
+
         sql = """UPDATE data_archives
-                 SET status = '{0:s}'
-                 WHERE archive_no = {1:d}
-              """.format('fail', archive_no)
+                 SET codec = %s,
+                     file_sha256 = COALESCE(%s, file_sha256),
+                     file_size = COALESCE(%s, file_size)
+                 WHERE archive_no = %s
+              """
 
-    try:
-        cursor.execute(sql)
-        db.commit()
-    except Exception as e:
-        db.rollback()
+        try:
+            cursor.execute(sql, (codec, file_sha256, file_size, archive_no))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            raise ValueError(e)
 
-    db.close()
+    cache.invalidate()
+    catalog.invalidate()
 
 
-def get_archive_no(ent):
-    """Determine the last incremented number generated by the active user."""
-    import MySQLdb
+@metrics.db_timer
+def set_checksums(archive_no, content_sha256=None, content_size=None,
+                  file_sha256=None, file_size=None):
+    """Record sizes and SHA-256s of an archive's data and file.
 
-    db = MySQLdb.connect(read_default_file='./settings.cnf')
+    Values left as None keep what is already recorded.
+    """
+    with pool.connection() as db:
+        cursor = db.cursor()
 
-    cursor = db.cursor()
+        sql = """UPDATE data_archives
+                 SET content_sha256 = COALESCE(%s, content_sha256),
+                     content_size = COALESCE(%s, content_size),
+                     file_sha256 = COALESCE(%s, file_sha256),
+                     file_size = COALESCE(%s, file_size)
+                 WHERE archive_no = %s
+              """
+
+        try:
+            cursor.execute(sql, (content_sha256, content_size, file_sha256,
+                                 file_size, archive_no))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            raise ValueError(e)
+
+    cache.invalidate()
+    catalog.invalidate()
+
+
+@metrics.db_timer
+def integrity_index():
+    """Return (archive_no, codec, status, content_sha256, content_size,
+    file_sha256, file_size) for every archive."""
+    with pool.connection() as db:
+        cursor = db.cursor()
+
+        sql = """SELECT archive_no, codec, status, content_sha256,
+                        content_size, file_sha256, file_size
+                 FROM data_archives
+                 ORDER BY archive_no
+              """
 
-    sql = """SELECT archive_no
-             FROM data_archives
-             WHERE enterer_no = {0:d}
-             ORDER BY created DESC
-             LIMIT 1
-          """.format(ent)
+        cursor.execute(sql)
 
-    cursor.execute(sql)
+        return cursor.fetchall()
+
+
+@metrics.db_timer
+def record_scrub(states, checksums=()):
+    """Record scrub outcomes and backfill missing checksums in one go.
+
+    states maps archive_no to ok, mismatch, corrupt or missing; checksums
+    is a list of (archive_no, Checksums) for archives that had none.
+    """
+    with pool.connection() as db:
+        cursor = db.cursor()
+
+        try:
+            cursor.executemany("""UPDATE data_archives
+                                  SET integrity = %s, verified = now()
+                                  WHERE archive_no = %s
+                               """, [(state, archive_no) for archive_no, state
+                                     in states.items()])
+            cursor.executemany("""UPDATE data_archives
+                                  SET content_sha256 =
+                                          COALESCE(content_sha256, %s),
+                                      content_size =
+                                          COALESCE(content_size, %s),
+                                      file_sha256 = COALESCE(file_sha256, %s),
+                                      file_size = COALESCE(file_size, %s)
+                                  WHERE archive_no = %s
+                               """, [tuple(values) + (archive_no,)
+                                     for archive_no, values in checksums])
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            raise ValueError(e)
+
+    cache.invalidate()
+    catalog.invalidate()
+
+
+@metrics.db_timer
+def get_content_hash(archive_no):
+    """Return the SHA-256 of an archive's uncompressed data, if recorded."""
+    with pool.connection() as db:
+        cursor = db.cursor()
+
+        sql = """SELECT content_sha256
+                 FROM data_archives
+                 WHERE archive_no = %s
+              """
+
+        cursor.execute(sql, (archive_no,))
+
+        row = cursor.fetchone()
+
+        return row[0] if row else None
+
+
+@metrics.db_timer
+def delta_base(archive_no):
+    """Find the latest finished archive of the same query as archive_no.
+
+    Returns (archive_no, content_sha256, content_size, delta_depth) of the
+    base, or None.
+    """
+    with pool.connection() as db:
+        cursor = db.cursor()
+
+        sql = """SELECT b.archive_no, b.content_sha256, b.content_size,
+                        b.delta_depth
+                 FROM data_archives AS a
+                 JOIN data_archives AS b
+                     ON b.uri_path = a.uri_path AND b.uri_args = a.uri_args
+                 WHERE a.archive_no = %s
+                     AND b.archive_no < a.archive_no
+                     AND b.status = 'complete'
+                     AND b.content_sha256 IS NOT NULL
+                 ORDER BY b.archive_no DESC
+                 LIMIT 1
+              """
+
+        cursor.execute(sql, (archive_no,))
+
+        return cursor.fetchone()
+
+
+@metrics.db_timer
+def set_delta(archive_no, base_archive_no, depth, file_sha256=None,
+              file_size=None):
+    """Record the base an archive is stored as a delta of (None for a full
+    archive), together with its new file checksums."""
+    with pool.connection() as db:
+        cursor = db.cursor()
 
-    for archive_no in cursor:
-        current_archive = archive_no[0]
+        sql = """UPDATE data_archives
+                 SET base_archive_no = %s,
+                     delta_depth = %s,
+                     file_sha256 = COALESCE(%s, file_sha256),
+                     file_size = COALESCE(%s, file_size)
+                 WHERE archive_no = %s
+              """
 
-    db.close()
+        try:
+            cursor.execute(sql, (base_archive_no, depth, file_sha256,
+                                 file_size, archive_no))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            raise ValueError(e)
 
-    return current_archive
+    cache.invalidate()
+    catalog.invalidate()
 
 
-def get_file_type(archive_no):
-    """Determine file type of the archive and return an extension."""
-    import MySQLdb
+@metrics.db_timer
+def delta_dependents(archive_no):
+    """List the archives stored as deltas of archive_no."""
+    with pool.connection() as db:
+        cursor = db.cursor()
 
-    db = MySQLdb.connect(read_default_file='./settings.cnf')
+        sql = """SELECT archive_no
+                 FROM data_archives
+                 WHERE base_archive_no = %s
+                 ORDER BY archive_no
+              """
 
-    cursor = db.cursor()
+        cursor.execute(sql, (archive_no,))
 
-    sql = """SELECT uri_path
-             FROM data_archives
-             WHERE archive_no = {0:d}
-             LIMIT 1
-          """.format(archive_no)
+        return [row[0] for row in cursor]
 
-    cursor.execute(sql)
 
-    for uri_path in cursor:
-        uri_path = uri_path[0]
+@metrics.db_timer
+def delta_bases():
+    """Map each delta archive to its base archive."""
+    with pool.connection() as db:
+        cursor = db.cursor()
 
-    db.close()
+        sql = """SELECT archive_no, base_archive_no
+                 FROM data_archives
+                 WHERE base_archive_no IS NOT NULL
+              """
 
-    return uri_path[uri_path.rfind('.'):]
+        cursor.execute(sql)
 
+        return dict(cursor.fetchall())
 
-def create_record(auth, ent, authors, title, desc, path, args):
-    """Create new record in database."""
-    import MySQLdb
 
-    db = MySQLdb.connect(read_default_file='./settings.cnf')
+@metrics.db_timer
+def get_checksums(archive_no):
+    """Return (content_sha256, content_size, file_sha256, file_size) for an
+    archive, or None if there is no such archive."""
+    with pool.connection() as db:
+        cursor = db.cursor()
 
-    cursor = db.cursor()
-    sql = """INSERT INTO data_archives
-             (authorizer_no, enterer_no, authors, title, description,
-              uri_path, uri_args)
-             VALUES ({0:d}, {1:d}, '{2:s}', '{3:s}', '{4:s}', '{5:s}', '{6:s}')
-          """.format(auth, ent, authors, title, desc, path, args)
+        sql = """SELECT content_sha256, content_size, file_sha256, file_size
+                 FROM data_archives
+                 WHERE archive_no = %s
+              """
 
-    try:
-        cursor.execute(sql)
-        db.commit()
-    except Exception as e:
-        db.rollback()
-        raise ValueError(e)
+        cursor.execute(sql, (archive_no,))
 
-    db.close()
+        return cursor.fetchone()
 
 
-def update_record(archive_no, title, desc, authors, doi):
-    """Add metadata to the archive table in database."""
-    import MySQLdb
+@metrics.db_timer
+def tier_index():
+    """Return (archive_no, codec, status, base_archive_no, content_sha256,
+    file_sha256, file_size, cold_copy) for every archive."""
+    with pool.connection() as db:
+        cursor = db.cursor()
 
-    db = MySQLdb.connect(read_default_file='./settings.cnf')
-    cursor = db.cursor()
+        sql = """SELECT archive_no, codec, status, base_archive_no,
+                        content_sha256, file_sha256, file_size, cold_copy
+                 FROM data_archives
+                 ORDER BY archive_no
+              """
 
-    if title:
-        title = title[:255]
-        sql = """UPDATE data_archives
-                 SET title = '{0:s}', modified = now()
-                 WHERE archive_no = {1:d}
-              """.format(title, archive_no)
         cursor.execute(sql)
 
-    if desc:
-        desc = desc[:5000]
-        sql = """UPDATE data_archives
-                 SET description = '{0:s}', modified = now()
-                 WHERE archive_no = {1:d}
-              """.format(desc, archive_no)
-        cursor.execute(sql)
+        return cursor.fetchall()
 
-    if authors:
-        desc = desc[:255]
-        sql = """UPDATE data_archives
-                 SET authors = '{0:s}', modified = now()
-                 WHERE archive_no = {1:d}
-              """.format(desc, archive_no)
-        cursor.execute(sql)
 
-    if doi:
-        doi = doi[:100]
+@metrics.db_timer
+def set_cold_copy(archive_nos, cold=True):
+    """Record whether archives have a copy in the cold storage tier."""
+    archive_nos = list(archive_nos)
+    if not archive_nos:
+        return
+
+    with pool.connection() as db:
+        cursor = db.cursor()
+
         sql = """UPDATE data_archives
-                 SET doi = '{0:s}', modified = now()
-                 WHERE archive_no = {1:d}
-              """.format(doi, archive_no)
-        cursor.execute(sql)
+                 SET cold_copy = %s
+                 WHERE archive_no = %s
+              """
+
+        try:
+            cursor.executemany(sql, [(int(cold), archive_no)
+                                     for archive_no in archive_nos])
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            raise ValueError(e)
+
+    cache.invalidate()
+    catalog.invalidate()
+
+
+@metrics.db_timer
+def archives_by_codec(codec=None):
+    """List completed full (not delta) archive numbers, optionally only
+    those using a codec."""
+    with pool.connection() as db:
+        cursor = db.cursor()
+
+        sql = """SELECT archive_no, codec
+                 FROM data_archives
+                 WHERE status = 'complete' AND base_archive_no IS NULL
+                 ORDER BY archive_no
+              """
 
-    try:
         cursor.execute(sql)
-        db.commit()
-    except Exception as e:
-        db.rollback()
 
-    db.close()
+        return [archive_no for archive_no, archive_codec in cursor
+                if codec is None or (archive_codec or 'bz2') == codec]
+
+
+@metrics.db_timer
+def create_record(auth, ent, authors, title, desc, path, args, codec='bz2'):
+    """Create new record in database and return its archive_no."""
+    with pool.connection() as db:
+        cursor = db.cursor()
+        sql = """INSERT INTO data_archives
+                 (authorizer_no, enterer_no, authors, title, description,
+                  uri_path, uri_args, codec)
+                 VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+              """
+
+        try:
+            cursor.execute(sql, (auth, ent, authors, title, desc, path, args,
+                                 codec))
+            # AUTO_INCREMENT value generated on this connection
+            archive_no = cursor.lastrowid
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            raise ValueError(e)
+
+    cache.invalidate()
+
+    return archive_no
+
+
+@metrics.db_timer
+def create_records(auth, ent, specs, status='queued'):
+    """Create one record per spec in a single transaction.
+
+    Each spec is a dict with authors, title, description, uri_path,
+    uri_args and codec. Returns the new archive_nos in spec order; if any
+    insert fails none of the records are kept.
+    """
+    with pool.connection() as db:
+        cursor = db.cursor()
+        sql = """INSERT INTO data_archives
+                 (authorizer_no, enterer_no, authors, title, description,
+                  uri_path, uri_args, codec, status)
+                 VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+              """
+
+        archive_nos = list()
+        try:
+            for spec in specs:
+                cursor.execute(sql, (auth, ent, spec['authors'],
+                                     spec['title'], spec['description'],
+                                     spec['uri_path'], spec['uri_args'],
+                                     spec['codec'], status))
+                archive_nos.append(cursor.lastrowid)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            raise ValueError(e)
+
+    cache.invalidate()
+
+    return archive_nos
+
+
+@metrics.db_timer
+def update_record(archive_no, title, desc, authors, doi):
+    """Add metadata to the archive table in database."""
+    with pool.connection() as db:
+        cursor = db.cursor()
+
+        if title:
+            title = title[:255]
+            sql = """UPDATE data_archives
+                     SET title = '{0:s}', modified = now()
+                     WHERE archive_no = {1:d}
+                  """.format(title, archive_no)
+            cursor.execute(sql)
+
+        if desc:
+            desc = desc[:5000]
+            sql = """UPDATE data_archives
+                     SET description = '{0:s}', modified = now()
+                     WHERE archive_no = {1:d}
+                  """.format(desc, archive_no)
+            cursor.execute(sql)
+
+        if authors:
+            desc = desc[:255]
+            sql = """UPDATE data_archives
+                     SET authors = '{0:s}', modified = now()
+                     WHERE archive_no = {1:d}
+                  """.format(desc, archive_no)
+            cursor.execute(sql)
+
+        if doi:
+            doi = doi[:100]
+            sql = """UPDATE data_archives
+                     SET doi = '{0:s}', modified = now()
+                     WHERE archive_no = {1:d}
+                  """.format(doi, archive_no)
+            cursor.execute(sql)
+
+        try:
+            cursor.execute(sql)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+
+    cache.invalidate()
+
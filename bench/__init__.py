@@ -0,0 +1 @@
+"""Benchmarks for the PBDB data archive API."""
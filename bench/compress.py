@@ -0,0 +1,103 @@
+"""Compare single-process and block-parallel archive compression.
+
+Usage:
+
+    python -m bench.compress --size 256 --workers 1 2 4 8
+
+A synthetic occurrence-style CSV of the requested size (MiB) is compressed
+once with the single-process engine and once per worker count with the
+parallel engine. Every output is checked with stock bunzip2 when it is
+installed. Results are printed as JSON.
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+import pipeline
+
+
+def synthetic_csv(size_mb, seed=0):
+    """Build an in-memory CSV with roughly PBDB-like redundancy."""
+    rng = random.Random(seed)
+    taxa = [f'Taxon{rng.randrange(10 ** 6)} species{i}' for i in range(2000)]
+    states = ['Wyoming', 'Montana', 'Utah', 'Colorado', 'Alberta']
+    target = size_mb << 20
+
+    out = io.BytesIO()
+    out.write(b'occurrence_no,collection_no,accepted_name,lat,lng,state\n')
+    occ = 0
+    while out.tell() < target:
+        occ += 1
+        out.write(('%d,%d,"%s",%.4f,%.4f,%s\n' % (
+            occ, rng.randrange(200000), rng.choice(taxa),
+            rng.uniform(-60, 80), rng.uniform(-180, 180),
+            rng.choice(states))).encode())
+
+    return out.getvalue()
+
+
+def verify(path):
+    """Return True if stock bunzip2 accepts the file, None if unavailable."""
+    if shutil.which('bunzip2') is None:
+        return None
+    return subprocess.run(['bunzip2', '-t', path]).returncode == 0
+
+
+def run(label, payload, destpath, compress):
+    start = time.perf_counter()
+    bytes_in, bytes_out = compress(io.BytesIO(payload), destpath)
+    elapsed = time.perf_counter() - start
+
+    return {'engine': label,
+            'seconds': round(elapsed, 3),
+            'mb_per_second': round(bytes_in / elapsed / 2 ** 20, 2),
+            'ratio': round(bytes_in / bytes_out, 2),
+            'bunzip2_ok': verify(destpath)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=64,
+                        help='uncompressed size in MiB')
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[2, os.cpu_count() or 2])
+    parser.add_argument('--block-size', type=int,
+                        default=pipeline.BLOCK_SIZE)
+    opts = parser.parse_args()
+
+    payload = synthetic_csv(opts.size)
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        destpath = os.path.join(tmp, 'bench.bz2')
+
+        results.append(run('single', payload, destpath,
+                           pipeline.compress_stream))
+
+        for workers in opts.workers:
+            # Warm the pool so process start-up is not timed
+            pipeline.get_executor(workers).submit(len, b'').result()
+
+            def compress(source, dest):
+                return pipeline.parallel_compress_stream(
+                    source, dest, workers, block_size=opts.block_size)
+
+            results.append(run(f'parallel-{workers}', payload, destpath,
+                               compress))
+
+    base = results[0]['seconds']
+    for result in results:
+        result['speedup'] = round(base / result['seconds'], 2)
+
+    print(json.dumps({'size_mb': opts.size, 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
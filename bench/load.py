@@ -0,0 +1,373 @@
+"""Load-test the archive API against local stand-ins.
+
+Usage:
+
+    python -m bench.load --clients 1 8 --requests 200 --large 16
+
+The service runs in a child process, exactly as archiver.py is deployed
+but on a threaded development server, with the stand-ins from
+bench.standin: a SQLite database in place of MySQL, a fake data service
+and a sendmail stub. Nothing outside a temporary directory is touched.
+
+Each scenario runs once per client count, with the clients sharing
+--requests requests:
+
+    list            GET /archives/list over --rows seeded archives
+    view            GET /archives/view/<n> of random seeded archives
+    retrieve_small  GET /archives/retrieve/<n> of a --small MiB archive
+    retrieve_large  the same for a --large MiB archive
+    create          POST /archives/create for distinct queries of
+                    --create-size MiB, then wait until all are complete
+
+Latency is measured to the last byte of the response. Peak RSS is the
+service process's high-water mark during the run (reset between runs
+where the kernel allows). Results are printed as JSON.
+"""
+
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from bench import standin
+
+
+SCENARIOS = ('list', 'view', 'retrieve_small', 'retrieve_large', 'create')
+
+SESSION_ID = 'bench-session'
+
+DATABASE = 'archives.sqlite'
+
+SETTINGS = """[environment]
+storage={storage}
+dataservice={dataservice}
+base=
+email=bench@example.org
+queue_db=jobs.sqlite
+job_workers={job_workers}
+job_poll_interval=0.2
+db_pool_size={db_pool_size}
+mail_transport=sendmail
+mail_sendmail={sendmail}
+mail_poll_interval=0.5
+"""
+
+
+def percentile(samples, p):
+    """Nearest-rank percentile of a list of numbers."""
+    ordered = sorted(samples)
+    if not ordered:
+        return None
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def request(url, data=None):
+    """Make one request and read the body; return (status, bytes read)."""
+    headers = {'Content-Type': 'application/json'} if data else {}
+    req = urllib.request.Request(url, data=data, headers=headers)
+    try:
+        response = urllib.request.urlopen(req, timeout=300)
+    except urllib.error.HTTPError as e:
+        response = e
+
+    with response:
+        size = 0
+        while True:
+            chunk = response.read(1 << 16)
+            if not chunk:
+                return response.status, size
+            size += len(chunk)
+
+
+def get_json(url, data=None):
+    req = urllib.request.Request(url, data=data and json.dumps(data).encode(),
+                                 headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(req, timeout=300) as response:
+        return json.load(response)
+
+
+class Service:
+    """The archiver running in a child process."""
+
+    def __init__(self, workdir, port):
+        self.workdir = workdir
+        self.url = f'http://127.0.0.1:{port}'
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=root)
+        self.proc = subprocess.Popen(
+            [sys.executable, '-m', 'bench.load', '--serve', str(port)],
+            cwd=workdir, env=env)
+
+    def wait_ready(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError('Service exited during startup')
+            try:
+                request(self.url + '/')
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError('Service did not start')
+
+    def _proc_file(self, name):
+        return f'/proc/{self.proc.pid}/{name}'
+
+    def reset_peak_rss(self):
+        """Restart the high-water mark (Linux 4.0+)."""
+        try:
+            with open(self._proc_file('clear_refs'), 'w') as f:
+                f.write('5')
+        except OSError:
+            pass
+
+    def peak_rss_mb(self):
+        try:
+            with open(self._proc_file('status')) as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return round(int(line.split()[1]) / 1024, 1)
+        except OSError:
+            pass
+        return None
+
+    def create(self, args, title='Bench archive'):
+        reply = get_json(self.url + '/archives/create',
+                         {'session_id': SESSION_ID,
+                          'title': title,
+                          'uri_path': '/data1.2/occs/list.csv',
+                          'uri_args': args})
+        return reply['pbdb_id']
+
+    def wait_complete(self, archive_nos, timeout=600):
+        deadline = time.monotonic() + timeout
+        pending = set(archive_nos)
+        while pending:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f'Archives not complete: {sorted(pending)}')
+            for archive_no in list(pending):
+                status = get_json(
+                    f'{self.url}/archives/status/{archive_no}')['status']
+                if status == 'fail':
+                    raise RuntimeError(f'Archive {archive_no} failed')
+                if status == 'complete':
+                    pending.discard(archive_no)
+            if pending:
+                time.sleep(0.1)
+
+    def stop(self):
+        self.proc.terminate()
+        self.proc.wait()
+
+
+def run(service, name, clients, n_requests, make_request):
+    """Run n_requests calls of make_request(i) over clients threads."""
+    tickets = iter(range(n_requests))
+    lock = threading.Lock()
+    latencies = list()
+    errors = list()
+    nbytes = [0]
+
+    def client():
+        while True:
+            with lock:
+                i = next(tickets, None)
+            if i is None:
+                return
+            start = time.perf_counter()
+            try:
+                status, size = make_request(i)
+            except OSError as e:
+                status, size = str(e), 0
+            elapsed = time.perf_counter() - start
+            with lock:
+                if isinstance(status, int) and status < 400:
+                    latencies.append(elapsed)
+                    nbytes[0] += size
+                else:
+                    errors.append(status)
+
+    service.reset_peak_rss()
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - start
+
+    ms = lambda s: None if s is None else round(s * 1000, 2)
+    return {'scenario': name,
+            'clients': clients,
+            'requests': n_requests,
+            'errors': len(errors),
+            'wall_seconds': round(wall, 3),
+            'requests_per_second': round(len(latencies) / wall, 1),
+            'mb_per_second': round(nbytes[0] / wall / 2 ** 20, 2),
+            'p50_ms': ms(percentile(latencies, 50)),
+            'p99_ms': ms(percentile(latencies, 99)),
+            'max_ms': ms(max(latencies, default=None)),
+            'peak_rss_mb': service.peak_rss_mb()}
+
+
+def scenario(service, name, clients, opts, fixtures):
+    """Run one scenario; returns its result dict."""
+    url = service.url
+    rng = random.Random(0)
+
+    if name == 'list':
+        return run(service, name, clients, opts.requests,
+                   lambda i: request(url + '/archives/list'))
+
+    if name == 'view':
+        return run(service, name, clients, opts.requests,
+                   lambda i: request(
+                       f'{url}/archives/view/{rng.randint(1, opts.rows)}'))
+
+    if name.startswith('retrieve_'):
+        archive_no = fixtures[name]
+        return run(service, name, clients, opts.requests,
+                   lambda i: request(f'{url}/archives/retrieve/{archive_no}'))
+
+    if name == 'create':
+        created = list()
+        size = int(opts.create_size * 2 ** 20)
+        run_id = time.monotonic_ns()
+
+        def create(i):
+            archive_no = service.create(
+                f'base_name=Bench&run={run_id}&seq={i}&size={size}')
+            created.append(archive_no)
+            return 202, 0
+
+        start = time.perf_counter()
+        result = run(service, name, clients, opts.create_requests, create)
+        service.wait_complete(created)
+        drain = time.perf_counter() - start
+
+        result.update(complete_seconds=round(drain, 3),
+                      archives_per_second=round(len(created) / drain, 2),
+                      peak_rss_mb=service.peak_rss_mb())
+        return result
+
+    raise ValueError(f'Unknown scenario {name}')
+
+
+def setup(workdir, opts, dataservice):
+    """Write settings and the stand-in database into workdir."""
+    storage = os.path.join(workdir, 'storage')
+    os.makedirs(storage)
+    os.makedirs(os.path.join(workdir, 'logs'))
+
+    with open(os.path.join(workdir, 'settings.cnf'), 'w') as f:
+        f.write(SETTINGS.format(storage=storage,
+                                dataservice=dataservice.url,
+                                job_workers=opts.job_workers,
+                                db_pool_size=opts.db_pool_size,
+                                sendmail=standin.sendmail_stub(workdir)))
+
+    path = os.path.join(workdir, DATABASE)
+    standin.create(path, users=[(SESSION_ID, 1, True, '0000-0000-0000-0001',
+                                 'bench@example.org')])
+    standin.seed_archives(path, opts.rows)
+
+
+def serve(port):
+    """Run the service with the stand-in database (child process)."""
+    import logging
+    from functools import partial
+
+    from werkzeug.serving import make_server
+
+    import aux
+    import pool
+
+    pool.configure(connect=partial(standin.connect,
+                                   os.path.abspath(DATABASE)),
+                   size=int(aux.get_config('db_pool_size', 4)))
+
+    import archiver
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    make_server('127.0.0.1', port, archiver.app,
+                threaded=True).serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS,
+                        default=list(SCENARIOS))
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per run')
+    parser.add_argument('--rows', type=int, default=1000,
+                        help='archive rows seeded for list and view')
+    parser.add_argument('--small', type=float, default=0.1,
+                        help='small archive data size in MiB')
+    parser.add_argument('--large', type=float, default=16,
+                        help='large archive data size in MiB')
+    parser.add_argument('--create-requests', type=int, default=20,
+                        help='archives created per create run')
+    parser.add_argument('--create-size', type=float, default=1,
+                        help='created archive data size in MiB')
+    parser.add_argument('--job-workers', type=int, default=2)
+    parser.add_argument('--db-pool-size', type=int, default=4)
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    opts = parser.parse_args()
+
+    if opts.serve:
+        return serve(opts.serve)
+
+    dataservice = standin.DataService().start()
+    service = None
+
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            setup(workdir, opts, dataservice)
+            service = Service(workdir, free_port())
+            service.wait_ready()
+
+            fixtures = dict()
+            for name, size in (('retrieve_small', opts.small),
+                               ('retrieve_large', opts.large)):
+                if name in opts.scenarios:
+                    fixtures[name] = service.create(
+                        f'base_name=Fixture&size={int(size * 2 ** 20)}',
+                        title=name)
+            service.wait_complete(fixtures.values())
+
+            results = [scenario(service, name, clients, opts, fixtures)
+                       for name in opts.scenarios
+                       for clients in opts.clients]
+
+        finally:
+            if service:
+                service.stop()
+            dataservice.stop()
+
+    print(json.dumps({'rows': opts.rows,
+                      'small_mb': opts.small,
+                      'large_mb': opts.large,
+                      'create_mb': opts.create_size,
+                      'job_workers': opts.job_workers,
+                      'db_pool_size': opts.db_pool_size,
+                      'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
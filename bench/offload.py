@@ -0,0 +1,130 @@
+"""Compare worker occupancy of direct and offloaded archive downloads.
+
+Usage:
+
+    python -m bench.offload --size 64 --clients 4 --rate 8
+
+Each simulated client downloads one archive of --size MiB and drains the
+response at --rate MiB/s, the way a researcher on a slow link would. A WSGI
+middleware records how long each request keeps the worker busy: from the
+call into the application until the response iterable is closed. With
+offload enabled the proxy sends the body, so the worker is free as soon as
+the headers are built. Results are printed as JSON.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+from flask import Flask
+
+import download
+
+
+class Occupancy:
+    """WSGI middleware measuring time from request start to close()."""
+
+    def __init__(self, app):
+        self.app = app
+        self.samples = []
+        self.lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        start = time.perf_counter()
+        body = self.app(environ, start_response)
+        return _Timed(body, start, self)
+
+
+class _Timed:
+    def __init__(self, body, start, recorder):
+        self.body = body
+        self.start = start
+        self.recorder = recorder
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self):
+        if hasattr(self.body, 'close'):
+            self.body.close()
+        with self.recorder.lock:
+            self.recorder.samples.append(time.perf_counter() - self.start)
+
+
+def build_app(path, mode):
+    app = Flask(__name__)
+
+    @app.route('/archives/retrieve/1')
+    def retrieve():
+        if mode == 'none':
+            return download.send_archive(path, 1, 'pbdb_archive_1.csv.bz2',
+                                         'application/x-compressed')
+        return download.offload_archive(path, '1.bz2',
+                                        'pbdb_archive_1.csv.bz2',
+                                        'application/x-compressed',
+                                        mode=mode)
+
+    app.wsgi_app = Occupancy(app.wsgi_app)
+    return app
+
+
+def slow_client(app, rate):
+    """Download once, draining the body at rate bytes per second."""
+    client = app.test_client()
+    response = client.get('/archives/retrieve/1', buffered=False)
+    for chunk in response.response:
+        time.sleep(len(chunk) / rate)
+    response.close()
+
+
+def scenario(path, mode, clients, rate):
+    app = build_app(path, mode)
+    threads = [threading.Thread(target=slow_client, args=(app, rate))
+               for _ in range(clients)]
+
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - start
+
+    samples = app.wsgi_app.samples
+    return {'mode': mode,
+            'clients': clients,
+            'wall_seconds': round(wall, 3),
+            'worker_seconds_total': round(sum(samples), 4),
+            'worker_seconds_mean': round(statistics.mean(samples), 4),
+            'worker_seconds_max': round(max(samples), 4)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=16,
+                        help='archive size in MiB')
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=32,
+                        help='client download rate in MiB/s')
+    opts = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, '1.bz2')
+        with open(path, 'wb') as f:
+            for _ in range(opts.size):
+                f.write(os.urandom(1 << 20))
+
+        rate = opts.rate * 2 ** 20
+        results = [scenario(path, mode, opts.clients, rate)
+                   for mode in ('none', 'x-accel')]
+
+    print(json.dumps({'size_mb': opts.size,
+                      'rate_mb_per_second': opts.rate,
+                      'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+"""Local stand-ins for the services the archiver talks to.
+
+    SQLite database    the data_archives, session_data and pbdb_wing.users
+                       tables aux.py and sessions.py query, behind a DB-API
+                       shim that accepts MySQL-style SQL; hand connect() to
+                       pool.configure()
+    DataService        HTTP server returning synthetic CSV or JSON of a
+                       requested size for any data service path
+    sendmail_stub()    script accepting sendmail's arguments that appends
+                       each message to a file
+
+Used by bench.load; nothing here is imported by the service itself.
+"""
+
+import hashlib
+import json
+import os
+import random
+import re
+import sqlite3
+import stat
+import threading
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS data_archives (
+    archive_no INTEGER PRIMARY KEY AUTOINCREMENT,
+    authorizer_no INTEGER,
+    enterer_no INTEGER,
+    title VARCHAR(255),
+    doi VARCHAR(100),
+    filename VARCHAR(255),
+    authors VARCHAR(255),
+    created DATETIME DEFAULT CURRENT_TIMESTAMP,
+    modified DATETIME,
+    description TEXT,
+    uri_path VARCHAR(255),
+    uri_args TEXT,
+    status VARCHAR(20),
+    codec VARCHAR(10) NOT NULL DEFAULT 'bz2',
+    content_sha256 CHAR(64),
+    content_size BIGINT,
+    file_size BIGINT,
+    file_sha256 CHAR(64),
+    integrity VARCHAR(10),
+    verified DATETIME,
+    base_archive_no INTEGER,
+    delta_depth INTEGER NOT NULL DEFAULT 0,
+    cold_copy INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS content_sha256
+    ON data_archives (content_sha256);
+CREATE INDEX IF NOT EXISTS base_archive_no
+    ON data_archives (base_archive_no);
+CREATE TABLE IF NOT EXISTS session_data (
+    session_id VARCHAR(80) PRIMARY KEY,
+    authorizer_no INTEGER,
+    enterer_no INTEGER,
+    user_id INTEGER
+);
+CREATE TABLE IF NOT EXISTS pbdb_wing.users (
+    id INTEGER PRIMARY KEY,
+    person_no INTEGER,
+    admin INTEGER,
+    orcid VARCHAR(20),
+    email VARCHAR(255)
+);
+"""
+
+# MySQL-only syntax in the queries aux.py sends
+_REWRITES = [(re.compile(r'%s'), '?'),
+             (re.compile(r'\bnow\(\)', re.I), 'CURRENT_TIMESTAMP'),
+             (re.compile(r'^(\s*(?:UPDATE|DELETE)\b.*?)\s+LIMIT\s+1\s*$',
+                         re.I | re.S), r'\1')]
+
+
+def translate(sql):
+    """Rewrite a MySQL query for SQLite."""
+    for pattern, replacement in _REWRITES:
+        sql = pattern.sub(replacement, sql)
+    return sql
+
+
+class Cursor:
+    """DB-API cursor taking MySQL placeholders and syntax."""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, params=()):
+        self.cursor.execute(translate(sql), tuple(params))
+
+    def executemany(self, sql, rows):
+        self.cursor.executemany(translate(sql), [tuple(r) for r in rows])
+
+    @property
+    def lastrowid(self):
+        return self.cursor.lastrowid
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size):
+        return self.cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def close(self):
+        self.cursor.close()
+
+
+class Connection:
+    """DB-API connection to the SQLite stand-in."""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute('ATTACH DATABASE ? AS pbdb_wing',
+                        (users_path(path),))
+
+    def cursor(self, *args):
+        return Cursor(self.db.cursor())
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+    def ping(self):
+        self.db.execute('SELECT 1')
+
+    def close(self):
+        self.db.close()
+
+
+def users_path(path):
+    return os.path.splitext(path)[0] + '-users.sqlite'
+
+
+def connect(path):
+    """Open a connection to the stand-in database at path."""
+    return Connection(path)
+
+
+def create(path, users=()):
+    """Create the stand-in database and return a connection factory.
+
+    users are (session_id, person_no, admin, orcid, email) tuples; each
+    gets a session and a pbdb_wing.users row, and is its own authorizer.
+    """
+    db = Connection(path)
+    db.db.execute('PRAGMA journal_mode=WAL')
+    db.db.executescript(SCHEMA)
+
+    for user_id, (session_id, person_no, admin, orcid, email) in \
+            enumerate(users, 1):
+        db.db.execute('INSERT OR REPLACE INTO session_data VALUES '
+                      '(?, ?, ?, ?)',
+                      (session_id, person_no, person_no, user_id))
+        db.db.execute('INSERT OR REPLACE INTO pbdb_wing.users VALUES '
+                      '(?, ?, ?, ?, ?)',
+                      (user_id, person_no, int(admin), orcid, email))
+
+    db.commit()
+    db.close()
+
+    return partial(connect, path)
+
+
+def seed_archives(path, n, enterer_no=1):
+    """Insert n finished archive rows without files, for list and view."""
+    db = Connection(path)
+    db.db.executemany(
+        """INSERT INTO data_archives
+           (authorizer_no, enterer_no, title, doi, authors, description,
+            uri_path, uri_args, status)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'complete')""",
+        [(enterer_no, enterer_no, f'Seeded archive {i}',
+          f'10.5072/bench.{i}' if i % 2 else None, 'Bench, A.',
+          'Seeded for load testing', '/data1.2/occs/list.csv',
+          f'base_name=Taxon{i}') for i in range(n)])
+    db.commit()
+    db.close()
+
+
+def synthetic_rows(seed):
+    """Yield occurrence-style rows forever."""
+    rng = random.Random(seed)
+    taxa = [f'Taxon{rng.randrange(10 ** 6)} species{i}' for i in range(500)]
+    occ = 0
+    while True:
+        occ += 1
+        yield {'occurrence_no': occ,
+               'collection_no': rng.randrange(200000),
+               'accepted_name': rng.choice(taxa),
+               'lat': round(rng.uniform(-60, 80), 4),
+               'lng': round(rng.uniform(-180, 180), 4)}
+
+
+def synthetic_body(size, fmt, seed):
+    """Yield about size bytes of CSV or JSON records in chunks."""
+    rows = synthetic_rows(seed)
+    sent = 0
+    lines = list()
+    pending = 0
+
+    if fmt == 'json':
+        head, sep, tail = b'{"records":[\n', b',\n', b'\n]}\n'
+        encode = json.dumps
+    else:
+        head = b'occurrence_no,collection_no,accepted_name,lat,lng\n'
+        sep, tail = b'\n', b'\n'
+        encode = lambda row: '%(occurrence_no)d,%(collection_no)d,' \
+                             '"%(accepted_name)s",%(lat)s,%(lng)s' % row
+
+    yield head
+    sent += len(head)
+
+    while sent + pending < size:
+        line = encode(next(rows)).encode()
+        lines.append(line)
+        pending += len(line) + len(sep)
+        if pending >= 1 << 16:
+            yield sep.join(lines) + sep
+            sent += pending
+            lines.clear()
+            pending = 0
+
+    if lines:
+        yield sep.join(lines)
+    yield tail
+
+
+class _DataServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.0'
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        size = int(query.get('size', [self.server.default_size])[0])
+        fmt = 'json' if parts.path.endswith('.json') else 'csv'
+        seed = int(hashlib.sha256(parts.query.encode()).hexdigest()[:8], 16)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json' if fmt == 'json'
+                         else 'text/csv')
+        self.end_headers()
+        for chunk in synthetic_body(size, fmt, seed):
+            self.wfile.write(chunk)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DataService(ThreadingHTTPServer):
+    """Fake data service on a local port.
+
+    Every GET returns synthetic records: JSON when the path ends in .json
+    and CSV otherwise, of about ?size= bytes (default_size if absent). The
+    query string seeds the generator, so the same query always returns the
+    same data and different queries do not deduplicate.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port=0, default_size=1 << 20):
+        super().__init__(('127.0.0.1', port), _DataServiceHandler)
+        self.default_size = default_size
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def sendmail_stub(directory):
+    """Write a sendmail replacement into directory and return its path.
+
+    The script accepts sendmail's arguments and appends each message to
+    sendmail.log next to it.
+    """
+    path = os.path.join(directory, 'sendmail')
+    log = os.path.join(directory, 'sendmail.log')
+    with open(path, 'w') as f:
+        f.write('#!/bin/sh\n'
+                f'{{ echo "To: $*"; cat; echo; }} >> "{log}"\n')
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    return path
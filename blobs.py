@@ -0,0 +1,122 @@
+"""Content-addressed store for compressed archive payloads.
+
+Compressed archives are kept once per (SHA-256 of the uncompressed data,
+codec) under <storage>/blobs/ab/abcdef....<ext>. Each archive's usual file,
+<storage>/<archive_no><ext>, is a hard link to its blob, so retrieve,
+offload and range requests are unchanged and the link count of the blob is
+its reference count: one for the store plus one per archive. A blob is
+removed when the last archive referencing it is deleted.
+"""
+
+import fcntl
+import os
+from contextlib import contextmanager
+
+import compression
+
+
+def blob_root():
+    import aux
+
+    return os.path.join(aux.get_config('storage'), 'blobs')
+
+
+def blob_path(digest, codec=None):
+    """Return the store path for an uncompressed SHA-256 and codec."""
+    return os.path.join(blob_root(), digest[:2],
+                        digest + compression.get(codec).extension)
+
+
+@contextmanager
+def locked():
+    """Serialise store updates across threads and processes."""
+    root = blob_root()
+    os.makedirs(root, exist_ok=True)
+
+    with open(os.path.join(root, '.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def store(archivepath, digest, codec=None):
+    """Move a freshly written archive into the store.
+
+    If an identical payload is already stored the new file is replaced by a
+    link to the existing blob. Returns the number of bytes saved.
+    """
+    blob = blob_path(digest, codec)
+
+    with locked():
+        if os.path.exists(blob):
+            saved = os.path.getsize(archivepath)
+            linkpath = archivepath + '.link'
+            os.link(blob, linkpath)
+            os.replace(linkpath, archivepath)
+            return saved
+
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        os.link(archivepath, blob)
+        return 0
+
+
+def link(archivepath, digest, codec=None):
+    """Point an archive at an existing blob; return False if there is none."""
+    blob = blob_path(digest, codec)
+
+    with locked():
+        if not os.path.exists(blob):
+            return False
+        linkpath = archivepath + '.link'
+        os.link(blob, linkpath)
+        os.replace(linkpath, archivepath)
+        return True
+
+
+def release(archivepath, digest=None, codec=None):
+    """Remove an archive file and its blob if no other archive uses it."""
+    with locked():
+        try:
+            os.remove(archivepath)
+        except FileNotFoundError:
+            pass
+
+        if not digest:
+            return
+
+        blob = blob_path(digest, codec)
+        try:
+            if os.stat(blob).st_nlink == 1:
+                os.remove(blob)
+        except FileNotFoundError:
+            pass
+
+
+def report():
+    """Summarise how much space deduplication saves."""
+    root = blob_root()
+    blobs = references = physical = logical = 0
+    shared = 0
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            if name.startswith('.'):
+                continue
+            st = os.stat(os.path.join(dirpath, name))
+            refs = st.st_nlink - 1
+            blobs += 1
+            references += refs
+            physical += st.st_size
+            logical += st.st_size * refs
+            if refs > 1:
+                shared += 1
+
+    return {'blobs': blobs,
+            'shared_blobs': shared,
+            'references': references,
+            'physical_bytes': physical,
+            'logical_bytes': logical,
+            'saved_bytes': logical - physical if logical > physical else 0,
+            'dedup_ratio': round(logical / physical, 3) if physical else None}
@@ -0,0 +1,169 @@
+"""Bulk archive creation shared by /archives/bulk and manage.py bulk-create.
+
+Specs arrive as a JSON list (or {"archives": [...]}) or as CSV with a header
+row naming the columns title, authors, description, uri_path, uri_args and
+codec. A uri column holding a full data service URL may be given instead of
+uri_path and uri_args, as in archive_drivers.csv.
+"""
+
+import csv
+import io
+import json
+import urllib.parse
+import uuid
+
+import aux
+import compression
+import jobs
+
+
+class BulkError(Exception):
+    """Raised when a bulk request cannot be processed at all."""
+
+
+def parse(body, content_type='application/json'):
+    """Return the list of archive specs in a JSON or CSV request body."""
+    if isinstance(body, bytes):
+        body = body.decode('utf-8-sig')
+
+    if 'csv' in content_type:
+        rows = csv.DictReader(io.StringIO(body))
+        specs = [{key.strip(): (value or '').strip()
+                  for key, value in row.items() if key}
+                 for row in rows]
+    else:
+        try:
+            specs = json.loads(body)
+        except ValueError as e:
+            raise BulkError(f'Invalid JSON - {e}')
+        if isinstance(specs, dict):
+            specs = specs.get('archives')
+
+    if not isinstance(specs, list) or not specs:
+        raise BulkError('No archives given')
+
+    return specs
+
+
+def normalise(spec, ent):
+    """Return a complete spec for create_records, or raise ValueError."""
+    if not isinstance(spec, dict):
+        raise ValueError('Archive spec must be an object')
+    for name in ('title', 'authors', 'description', 'uri', 'uri_path',
+                 'uri_args', 'codec'):
+        if spec.get(name) is not None and not isinstance(spec[name], str):
+            raise ValueError(f'{name} must be a string')
+
+    path = spec.get('uri_path')
+    args = spec.get('uri_args')
+
+    # Full data service URL, as in archive_drivers.csv
+    if spec.get('uri') and not (path or args):
+        parts = urllib.parse.urlsplit(spec['uri'])
+        path, args = parts.path, parts.query
+
+    codec = spec.get('codec') or compression.DEFAULT
+
+    # Parameter checks, as for /archives/create
+    if not spec.get('title'):
+        raise ValueError('Missing title')
+    if not args:
+        raise ValueError('Missing uri_args')
+    if not path:
+        raise ValueError('Missing uri_path')
+    if path[0] != '/':
+        raise ValueError('uri_path not preceeded by "/"')
+    if codec not in compression.CODECS:
+        raise ValueError('Unsupported codec')
+
+    return {'title': spec['title'],
+            'authors': spec.get('authors') or 'Enter No. ' + str(ent),
+            'description': spec.get('description') or 'No description',
+            'uri_path': path,
+            'uri_args': args,
+            'codec': codec}
+
+
+def data_uri(path, args):
+    """Build the data service URI for a query."""
+    base = aux.get_config('dataservice')
+    uri = ''.join([base, path, '?', args])
+    return uri.replace(' ', '%20')
+
+
+def create(principal, session_id, specs, concurrency=None):
+    """Create records and queue jobs for a list of specs.
+
+    Valid specs are inserted in one transaction and queued as one batch;
+    invalid ones are reported without stopping the rest. Returns the batch
+    id (None if nothing was queued) and one result per spec, in order.
+    """
+    max_items = int(aux.get_config('bulk_max_items', 1000))
+    if len(specs) > max_items:
+        raise BulkError(f'At most {max_items} archives per request')
+
+    if concurrency is None:
+        concurrency = int(aux.get_config('bulk_concurrency', 2))
+    if concurrency < 1:
+        raise BulkError('concurrency must be at least 1')
+    # One batch may not take every worker from other requests
+    max_concurrency = int(aux.get_config('bulk_max_concurrency', 4))
+    if concurrency > max_concurrency:
+        raise BulkError(f'concurrency must be at most {max_concurrency}')
+
+    ent = principal.enterer_no
+    results = list()
+    valid = list()
+
+    for index, spec in enumerate(specs):
+        try:
+            valid.append((index, normalise(spec, ent)))
+            results.append(None)
+        except ValueError as e:
+            results.append({'index': index, 'error': str(e)})
+
+    if not valid:
+        return None, results
+
+    archive_nos = aux.create_records(principal.authorizer_no, ent,
+                                     [spec for _, spec in valid])
+
+    batch = uuid.uuid4().hex
+    items = list()
+    for (index, spec), archive_no in zip(valid, archive_nos):
+        items.append((archive_no, {'session_id': session_id,
+                                   'auth': principal.authorizer_no,
+                                   'uri': data_uri(spec['uri_path'],
+                                                   spec['uri_args']),
+                                   'title': spec['title'],
+                                   'authors': spec['authors'],
+                                   'ent': ent,
+                                   'email': principal.email,
+                                   'codec': spec['codec']}))
+        results[index] = {'index': index,
+                          'archive_no': archive_no,
+                          'status': 'queued'}
+
+    try:
+        jobs.enqueue_batch(batch, items, concurrency)
+    except Exception:
+        for archive_no, _ in items:
+            aux.archive_status(archive_no, success=False)
+        raise
+
+    return batch, results
+
+
+def progress(batch):
+    """Summarise a batch: job counts by state and per-archive results."""
+    entries = jobs.batch_info(batch)
+
+    counts = dict()
+    for entry in entries.values():
+        counts[entry['state']] = counts.get(entry['state'], 0) + 1
+
+    return {'batch': batch,
+            'total': len(entries),
+            'states': counts,
+            'archives': [dict(entry, archive_no=archive_no)
+                         for archive_no, entry in entries.items()]}
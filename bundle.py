@@ -0,0 +1,192 @@
+"""Stream several archives as one zip or tar file.
+
+Bundles are generated while they are sent: each member is copied from its
+archive file in CHUNK_SIZE pieces straight into the response, so memory use
+is constant and nothing is written to disk however large the bundle is.
+Archive files are already compressed, so zip members are stored as is.
+
+Delta archives (see delta.py) are included rebuilt and uncompressed, with
+a codec of null in the manifest.
+
+Every bundle starts with MANIFEST.json, listing its members in archive_no
+order with their sizes and the SHA-256 of the uncompressed data. Member
+names, order, timestamps and the manifest depend only on the archives, so
+the same request always produces the same bytes.
+"""
+
+import io
+import json
+import os
+import tarfile
+import time
+import zipfile
+from collections import namedtuple
+
+import aux
+import compression
+from download import CHUNK_SIZE, ChunkWriter
+
+
+FORMATS = {'zip': 'application/zip', 'tar': 'application/x-tar'}
+
+MANIFEST = 'MANIFEST.json'
+
+Member = namedtuple('Member', ['name', 'fileobj', 'size', 'mtime'])
+
+
+def open_members(entries):
+    """Open the archive and header files for catalog entries.
+
+    Files are opened up front so the bundle is a consistent snapshot even
+    if an archive is re-encoded or deleted while it is being sent. Returns
+    the members with the manifest first.
+    """
+    members = list()
+    listing = list()
+
+    try:
+        for entry in sorted(entries, key=lambda e: e.archive_no):
+            extension = compression.get(entry.codec).extension
+            stem = f'pbdb_archive_{entry.archive_no}'
+
+            if entry.base is None:
+                f = open(entry.path, 'rb')
+                st = os.fstat(f.fileno())
+                member = Member(stem + entry.file_type + extension, f,
+                                st.st_size, int(st.st_mtime))
+                codec = entry.codec
+            else:
+                member = delta_member(entry, stem)
+                codec = None
+            members.append(member)
+            item = {'archive_no': entry.archive_no,
+                    'file': member.name,
+                    'size': member.size,
+                    'codec': codec,
+                    'content_sha256': aux.get_content_hash(entry.archive_no),
+                    'header': None}
+
+            headerpath = '/'.join([os.path.dirname(entry.path),
+                                   f'{entry.archive_no}.header'])
+            try:
+                f = open(headerpath, 'rb')
+            except FileNotFoundError:
+                pass
+            else:
+                st = os.fstat(f.fileno())
+                members.append(Member(stem + '.header', f, st.st_size,
+                                      int(st.st_mtime)))
+                item['header'] = members[-1].name
+
+            listing.append(item)
+
+    except BaseException:
+        close_members(members)
+        raise
+
+    body = json.dumps({'archives': listing}, indent=2, sort_keys=True)
+    body = (body + '\n').encode()
+    mtime = max((m.mtime for m in members), default=0)
+
+    return [Member(MANIFEST, body, len(body), mtime)] + members
+
+
+def delta_member(entry, stem):
+    """Member for a delta archive: its data rebuilt, uncompressed."""
+    import delta
+    import transcode
+
+    if entry.content_size is None:
+        raise delta.DeltaError(f'Archive {entry.archive_no} has no '
+                               'recorded size')
+
+    reader = io.BufferedReader(transcode.ChunkReader(
+        delta.rebuild(delta.chain(entry))), CHUNK_SIZE)
+    return Member(stem + entry.file_type, reader, entry.content_size,
+                  int(entry.mtime))
+
+
+def close_members(members):
+    """Close the files behind members."""
+    for member in members:
+        if hasattr(member.fileobj, 'close'):
+            member.fileobj.close()
+
+
+def chunks(member):
+    """Yield the contents of a member."""
+    if isinstance(member.fileobj, bytes):
+        yield member.fileobj
+        return
+
+    remaining = member.size
+    while remaining > 0:
+        chunk = member.fileobj.read(min(CHUNK_SIZE, remaining))
+        if not chunk:
+            raise OSError(f'{member.name} shrank while being bundled')
+        remaining -= len(chunk)
+        yield chunk
+
+
+def tar_header(member):
+    info = tarfile.TarInfo(member.name)
+    info.size = member.size
+    info.mtime = member.mtime
+    info.mode = 0o644
+    info.uname = info.gname = 'pbdb'
+    return info.tobuf(format=tarfile.PAX_FORMAT)
+
+
+def tar_size(members):
+    """Return the exact length of the tar stream for members."""
+    size = 2 * tarfile.BLOCKSIZE
+    for member in members:
+        size += len(tar_header(member))
+        size += -(-member.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+    return size
+
+
+def stream_tar(members):
+    """Yield a POSIX tar archive of members."""
+    try:
+        for member in members:
+            yield tar_header(member)
+            for chunk in chunks(member):
+                yield chunk
+            padding = -member.size % tarfile.BLOCKSIZE
+            if padding:
+                yield b'\0' * padding
+
+        yield b'\0' * (2 * tarfile.BLOCKSIZE)
+
+    finally:
+        close_members(members)
+
+
+def stream_zip(members):
+    """Yield a zip archive of members, stored without recompression."""
+    sink = ChunkWriter()
+
+    try:
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as zf:
+            for member in members:
+                mtime = time.gmtime(max(member.mtime, 315532800))
+                info = zipfile.ZipInfo(member.name, mtime[:6])
+                info.compress_type = zipfile.ZIP_STORED
+                info.external_attr = 0o644 << 16
+                info.file_size = member.size
+
+                with zf.open(info, 'w') as dest:
+                    for chunk in chunks(member):
+                        dest.write(chunk)
+                        data = sink.drain()
+                        if data:
+                            yield data
+
+                yield sink.drain()
+
+        # Central directory
+        yield sink.drain()
+
+    finally:
+        close_members(members)
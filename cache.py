@@ -0,0 +1,183 @@
+"""In-memory TTL caches with explicit, cross-process invalidation.
+
+Each uwsgi process keeps its own caches. Writers call invalidate(), which
+clears the local caches and replaces a small stamp file; every lookup stats
+that file and drops its entries when the stamp has changed, so a write in
+one process is seen by the others on their next request.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Thread-safe LRU mapping whose entries expire after ttl seconds."""
+
+    def __init__(self, maxsize=256, ttl=60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return a live entry and mark it recently used."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        """Store an entry, evicting the least recently used if full."""
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        """Drop one entry if present."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Drop every entry."""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """Return size and hit/miss counters."""
+        with self._lock:
+            return {'size': len(self._data),
+                    'maxsize': self.maxsize,
+                    'ttl': self.ttl,
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+
+class Stamp:
+    """A stamp file whose replacement clears a set of caches in every process.
+
+    path is called for the stamp file's location on each use.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.caches = []
+        self.current = None
+        self._lock = threading.Lock()
+
+    def register(self, cache):
+        self.caches.append(cache)
+        return cache
+
+    def read(self):
+        try:
+            st = os.stat(self.path())
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns
+
+    def check(self):
+        """Clear local caches if another process has invalidated them."""
+        current = self.read()
+        if current != self.current:
+            with self._lock:
+                if current != self.current:
+                    for c in self.caches:
+                        c.clear()
+                    self.current = current
+
+    def invalidate(self):
+        """Clear the caches in this and every other process."""
+        path = self.path()
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}'
+        with open(tmp, 'w') as f:
+            f.write(str(time.time_ns()))
+        os.replace(tmp, path)
+
+        with self._lock:
+            for c in self.caches:
+                c.clear()
+            self.current = self.read()
+
+
+def stamp_path():
+    import aux
+
+    return aux.get_config('cache_stamp', 'cache.stamp')
+
+
+_archive_data = Stamp(lambda: stamp_path())
+
+
+def register(cache):
+    """Have a cache cleared whenever archive data is invalidated."""
+    return _archive_data.register(cache)
+
+
+def check():
+    """Clear local caches if another process has invalidated them."""
+    _archive_data.check()
+
+
+def invalidate():
+    """Clear cached archive data in this and every other process."""
+    _archive_data.invalidate()
+
+
+responses = register(TTLCache())
+
+
+def configure():
+    """Apply cache size and TTL from settings."""
+    import aux
+
+    responses.maxsize = int(aux.get_config('cache_size', 256))
+    responses.ttl = float(aux.get_config('cache_ttl', 60))
+
+
+def cached_json(key, build):
+    """Serve a JSON response from the cache, honouring If-None-Match.
+
+    build() is called on a miss and must return a Flask response; only
+    successful responses are cached. Cached bodies carry a strong ETag
+    derived from their content.
+    """
+    from flask import make_response, request
+
+    check()
+    entry = responses.get(key)
+
+    if entry is None:
+        stamp = _archive_data.current
+        response = build()
+        if response.status_code != 200:
+            return response
+        body = response.get_data()
+        etag = hashlib.sha1(body).hexdigest()
+        entry = (body, etag)
+        # Do not keep a body built across a concurrent invalidation
+        if _archive_data.read() == stamp:
+            responses.set(key, entry)
+
+    body, etag = entry
+
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(body)
+        response.mimetype = 'application/json'
+
+    response.set_etag(etag)
+    return response
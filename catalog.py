@@ -0,0 +1,139 @@
+"""In-memory index of archive metadata for the download path.
+
+The index maps archive_no to file type, codec, status, recorded size and
+checksum, loaded from data_archives with a single query, so the common
+retrieve call needs no database round trip. It is dropped in every process
+through the catalog_stamp file only when something a download depends on
+changes: an archive completing or being deleted, or its codec, checksums,
+delta base, cold copy or integrity. Job stage changes and metadata edits
+leave it alone (see cache.invalidate for those). Only complete archives are
+returned by lookup. File size and mtime come from a stat of the archive
+file at lookup time, which also lets missing files be answered with a
+cheap 404. For a delta archive (see delta.py) the file is its delta file
+and base is the archive it was stored against. An archive whose file was
+evicted to the cold storage tier (see tiers.py) is returned with cold set,
+no stat and its recorded size.
+"""
+
+import os
+import threading
+from collections import namedtuple
+
+import aux
+import cache
+import compression
+
+
+Entry = namedtuple('Entry', ['archive_no', 'file_type', 'codec', 'status',
+                             'path', 'size', 'mtime', 'stat',
+                             'expected_size', 'integrity', 'base',
+                             'content_size', 'cold', 'file_sha256'],
+                   defaults=(None, None, None, None, False, None))
+
+
+class Catalog:
+    """Archive metadata for one process, reloaded lazily after invalidation."""
+
+    def __init__(self):
+        self._rows = None
+        self._storage = None
+        self._lock = threading.Lock()
+        self.loads = 0
+
+    def clear(self):
+        """Forget the loaded rows; the next lookup reloads them."""
+        with self._lock:
+            self._rows = None
+
+    def rows(self):
+        """Return the loaded rows, querying the database if needed."""
+        _stamp.check()
+
+        rows = self._rows
+        if rows is None:
+            with self._lock:
+                if self._rows is None:
+                    self._storage = aux.get_config('storage')
+                    self._rows = {row[0]: row
+                                  for row in aux.archive_catalog()}
+                    self.loads += 1
+                rows = self._rows
+
+        return rows
+
+    def lookup(self, archive_no):
+        """Return the Entry for a retrievable archive, or None.
+
+        None is returned when there is no such record, when creation failed
+        or is still in progress (its file may already exist but is not
+        final until the status is complete), or when the archive file is
+        missing from both storage tiers.
+        """
+        row = self.rows().get(archive_no)
+        if row is None:
+            return None
+
+        (archive_no, uri_path, codec, status, file_size, integrity, base,
+         content_size, cold_copy, file_sha256) = row
+        if status != 'complete':
+            return None
+
+        codec = codec or compression.DEFAULT
+        path = '/'.join([self._storage, str(archive_no)])
+        path = path.replace('//', '/')
+        if base is not None:
+            path += '.delta'
+        path += compression.get(codec).extension
+
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            if not cold_copy:
+                return None
+            st = None
+
+        return Entry(archive_no=archive_no,
+                     file_type=uri_path[uri_path.rfind('.'):],
+                     codec=codec,
+                     status=status,
+                     path=path,
+                     size=file_size if st is None else st.st_size,
+                     mtime=None if st is None else st.st_mtime,
+                     stat=st,
+                     expected_size=file_size,
+                     integrity=integrity,
+                     base=base,
+                     content_size=content_size,
+                     cold=st is None,
+                     file_sha256=file_sha256)
+
+    def stats(self):
+        """Return the number of indexed archives and reloads."""
+        rows = self._rows
+        return {'archives': None if rows is None else len(rows),
+                'loads': self.loads}
+
+
+def stamp_path():
+    return aux.get_config('catalog_stamp', 'catalog.stamp')
+
+
+_stamp = cache.Stamp(lambda: stamp_path())
+
+archives = _stamp.register(Catalog())
+
+
+def invalidate():
+    """Reload the index in this and every other process."""
+    _stamp.invalidate()
+
+
+def lookup(archive_no):
+    """Look up a retrievable archive in the process-wide index."""
+    return archives.lookup(archive_no)
+
+
+def damaged(entry):
+    """Whether an archive file is known to be truncated or corrupt."""
+    return (entry.integrity in ('mismatch', 'corrupt') or
+            entry.expected_size not in (None, entry.size))
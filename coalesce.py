@@ -0,0 +1,76 @@
+"""Single-flight coalescing of identical data service fetches.
+
+Archive jobs for the same query (normalised uri_path and uri_args, the
+authorizer whose visibility the data service applies, and the codec) take
+an exclusive lock on a per-query lock file under <storage>/.flights/. The
+first job to get the lock fetches and compresses the data; jobs queued
+before that fetch finished, whether waiting on the lock or claimed later,
+find its result recorded next to the lock and link their archive to the
+same blob instead of fetching again. The lock is
+an flock, so this holds across threads and uwsgi processes alike.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import time
+import urllib.parse
+from contextlib import contextmanager
+
+
+def flight_root():
+    import aux
+
+    return os.path.join(aux.get_config('storage'), '.flights')
+
+
+def query_key(uri, visibility, codec=None):
+    """Hash a normalised query so equivalent requests share a key."""
+    parts = urllib.parse.urlsplit(uri)
+    args = sorted(urllib.parse.parse_qsl(parts.query, keep_blank_values=True))
+    normal = '\n'.join([parts.path,
+                        urllib.parse.urlencode(args),
+                        str(visibility),
+                        codec or ''])
+    return hashlib.sha256(normal.encode()).hexdigest()
+
+
+@contextmanager
+def flight(key):
+    """Hold the fetch lock for a query key."""
+    root = flight_root()
+    os.makedirs(root, exist_ok=True)
+
+    with open(os.path.join(root, key + '.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def result_path(key):
+    return os.path.join(flight_root(), key + '.json')
+
+
+def finished_since(key, since):
+    """Return the result of a fetch for key completed after since, if any."""
+    try:
+        with open(result_path(key)) as f:
+            result = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    return result if result.get('finished', 0) >= since else None
+
+
+def record(key, **result):
+    """Publish the result of a completed fetch to waiting jobs."""
+    result['finished'] = time.time()
+
+    path = result_path(key)
+    tmp = f'{path}.{os.getpid()}'
+    with open(tmp, 'w') as f:
+        json.dump(result, f)
+    os.replace(tmp, path)
@@ -0,0 +1,83 @@
+"""Compression codecs available for archive files.
+
+Each codec knows its file extension and Content-Type, how to build an
+incremental compressor for the streaming pipeline, how to compress a single
+independent block for the parallel engine, and how to open a reader that
+decompresses concatenated streams. zstd is only offered when the optional
+zstandard package is installed.
+"""
+
+import bz2
+import gzip
+import lzma
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+DEFAULT = 'bz2'
+
+
+class Codec:
+    """Description of one archive compression format."""
+
+    def __init__(self, name, extension, mimetype, compressor, compress_block,
+                 open_reader):
+        self.name = name
+        self.extension = extension
+        self.mimetype = mimetype
+        self.compressor = compressor
+        self.compress_block = compress_block
+        self.open_reader = open_reader
+
+    def __repr__(self):
+        return f'Codec({self.name!r})'
+
+
+def _gzip_compressor():
+    return zlib.compressobj(6, zlib.DEFLATED, 31)
+
+
+def _gzip_block(block):
+    return gzip.compress(block, compresslevel=6, mtime=0)
+
+
+def _zstd_compressor():
+    return zstandard.ZstdCompressor(level=10).compressobj()
+
+
+def _zstd_block(block):
+    return zstandard.ZstdCompressor(level=10).compress(block)
+
+
+def _zstd_reader(fileobj):
+    return zstandard.ZstdDecompressor().stream_reader(
+        fileobj, read_across_frames=True)
+
+
+CODECS = {
+    'bz2': Codec('bz2', '.bz2', 'application/x-compressed',
+                 bz2.BZ2Compressor, bz2.compress,
+                 lambda f: bz2.open(f, 'rb')),
+    'gzip': Codec('gzip', '.gz', 'application/gzip',
+                  _gzip_compressor, _gzip_block,
+                  lambda f: gzip.open(f, 'rb')),
+    'xz': Codec('xz', '.xz', 'application/x-xz',
+                lzma.LZMACompressor, lzma.compress,
+                lambda f: lzma.open(f, 'rb')),
+}
+
+if zstandard is not None:
+    CODECS['zstd'] = Codec('zstd', '.zst', 'application/zstd',
+                           _zstd_compressor, _zstd_block, _zstd_reader)
+
+
+def get(name):
+    """Return a codec by name, treating an empty name as the default."""
+    try:
+        return CODECS[name or DEFAULT]
+    except KeyError:
+        raise ValueError(f'Unsupported codec: {name}')
@@ -0,0 +1,117 @@
+"""Shared fixtures: the Flask app running against the bench stand-ins.
+
+The archiver module reads settings.cnf from the working directory when it
+is imported, so the app is imported once per session from a scratch
+directory holding settings and storage. Each test gets its own stand-in
+SQLite database. Background workers are not started; tests drive the queue
+themselves.
+"""
+
+import os
+import shutil
+
+import pytest
+
+import cache
+import catalog
+import jobs
+import mailer
+import metrics
+import pool
+from bench import standin
+
+
+SESSION_ID = 'test-session'
+ENTERER = 1
+
+SETTINGS = """[environment]
+storage={workdir}/storage
+dataservice=http://127.0.0.1:9
+base=
+email=archives@example.org
+queue_db={workdir}/jobs.sqlite
+job_workers=0
+cache_stamp={workdir}/cache.stamp
+catalog_stamp={workdir}/catalog.stamp
+session_stamp={workdir}/session.stamp
+metrics_dir={workdir}/metrics
+mail_transport=file
+mail_file_dir={workdir}/mail
+"""
+
+
+@pytest.fixture(scope='session')
+def workdir(tmp_path_factory):
+    """Scratch directory with settings.cnf, logs and storage."""
+    workdir = tmp_path_factory.mktemp('service')
+    os.makedirs(workdir / 'storage')
+    os.makedirs(workdir / 'logs')
+
+    with open(workdir / 'settings.cnf', 'w') as f:
+        f.write(SETTINGS.format(workdir=workdir))
+
+    return workdir
+
+
+@pytest.fixture()
+def client(workdir, tmp_path, monkeypatch):
+    """Flask test client for the archiver app, with empty storage."""
+    monkeypatch.chdir(workdir)
+    shutil.rmtree(workdir / 'storage')
+    os.makedirs(workdir / 'storage')
+    monkeypatch.setattr(pool, '_pool', None)
+    pool.configure(connect=standin.create(
+        str(tmp_path / 'archives.sqlite'),
+        users=[(SESSION_ID, ENTERER, False, '0000-0000-0000-0001',
+                'tester@example.org')]))
+
+    # Keep the import from starting threads that outlive the test
+    monkeypatch.setattr(jobs, '_started_pid', os.getpid())
+    monkeypatch.setattr(mailer, '_started_pid', os.getpid())
+
+    import archiver
+
+    # The app's metrics collector reads settings only this directory has
+    if archiver.service_stats not in metrics._collectors:
+        metrics._collectors.append(archiver.service_stats)
+
+    cache.invalidate()
+    catalog.invalidate()
+    yield archiver.app.test_client()
+    catalog.archives.clear()
+    metrics._collectors.remove(archiver.service_stats)
+
+
+def add_archive(status='complete', data=None, codec='bz2', **columns):
+    """Insert a data_archives row and optionally its file; return its number.
+
+    Call inside the client fixture; data is written as the archive file.
+    """
+    import aux
+    import cache
+    import compression
+
+    columns = dict({'authorizer_no': ENTERER, 'enterer_no': ENTERER,
+                    'title': 'Test archive', 'authors': 'Tester, A.',
+                    'description': 'Test', 'uri_path': '/data1.2/occs/list.csv',
+                    'uri_args': 'base_name=Canis'}, **columns)
+
+    with pool.connection() as db:
+        cursor = db.cursor()
+        names = ', '.join(list(columns) + ['status', 'codec'])
+        marks = ', '.join(['%s'] * (len(columns) + 2))
+        cursor.execute(f'INSERT INTO data_archives ({names}) '
+                       f'VALUES ({marks})',
+                       list(columns.values()) + [status, codec])
+        archive_no = cursor.lastrowid
+        db.commit()
+
+    if data is not None:
+        path = os.path.join(aux.get_config('storage'), str(archive_no) +
+                            compression.get(codec).extension)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    cache.invalidate()
+    catalog.invalidate()
+    return archive_no
@@ -0,0 +1,363 @@
+"""Delta archives for repeated queries.
+
+When a new archive has the same uri_path and uri_args as an earlier one,
+its data usually differs from the earlier archive's in a few rows. Instead
+of a full copy it can be stored as a line-level diff against that base
+archive, in <storage>/<archive_no>.delta<ext> (compressed with the
+archive's codec). The diff is a list of operations:
+
+    PBDB-DELTA 1 <base archive_no> <base content SHA-256>
+    C <skip> <count>     skip lines of the base, then copy count lines
+    I <nbytes>           insert the nbytes that follow
+    E                    end
+
+Copies only ever move forward through the base, so a delta is applied by
+streaming the base once alongside it, and a base may itself be a delta.
+Chains are kept short by full snapshots: an archive whose base is already
+delta_max_depth deltas deep is stored in full. A delta is only kept when
+it is at most delta_max_ratio of the full file and rebuilding it
+reproduces the recorded content SHA-256 exactly.
+"""
+
+import bisect
+import hashlib
+import io
+import logging
+import os
+
+import compression
+from download import CHUNK_SIZE
+
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'PBDB-DELTA 1'
+
+
+class DeltaError(Exception):
+    """Raised when a delta cannot be applied to its base."""
+
+
+def lines(chunks):
+    """Return a reader over chunks whose lines keep their newlines."""
+    import transcode
+
+    return io.BufferedReader(transcode.ChunkReader(chunks), CHUNK_SIZE)
+
+
+def index_lines(chunks):
+    """Map the hash of each base line to its line number(s)."""
+    index = dict()
+    for i, line in enumerate(lines(chunks)):
+        key = hash(line)
+        found = index.get(key)
+        if found is None:
+            index[key] = i
+        elif isinstance(found, list):
+            found.append(i)
+        else:
+            index[key] = [found, i]
+    return index
+
+
+def _find(index, key, position):
+    """Return the first base line at or after position with this hash."""
+    found = index.get(key)
+    if found is None:
+        return None
+    if isinstance(found, int):
+        return found if found >= position else None
+    i = bisect.bisect_left(found, position)
+    return found[i] if i < len(found) else None
+
+
+def encode(chunks, index, base_no, base_digest):
+    """Yield the delta of a stream of chunks against an indexed base.
+
+    Lines are matched greedily by hash; rebuilding and comparing the
+    content digest afterwards catches any collision.
+    """
+    yield b'%s %d %s\n' % (MAGIC, base_no, base_digest.encode())
+
+    position = skip = copy = 0
+    literal = list()
+    literal_size = 0
+
+    for line in lines(chunks):
+        match = _find(index, hash(line), position)
+
+        if match is None:
+            if copy:
+                yield b'C %d %d\n' % (skip, copy)
+                copy = 0
+            literal.append(line)
+            literal_size += len(line)
+            if literal_size >= CHUNK_SIZE:
+                yield b'I %d\n' % literal_size + b''.join(literal)
+                literal.clear()
+                literal_size = 0
+            continue
+
+        if literal:
+            yield b'I %d\n' % literal_size + b''.join(literal)
+            literal.clear()
+            literal_size = 0
+
+        if copy and match == position:
+            copy += 1
+        else:
+            if copy:
+                yield b'C %d %d\n' % (skip, copy)
+            skip, copy = match - position, 1
+        position = match + 1
+
+    if copy:
+        yield b'C %d %d\n' % (skip, copy)
+    if literal:
+        yield b'I %d\n' % literal_size + b''.join(literal)
+    yield b'E\n'
+
+
+def apply(reader, base_chunks):
+    """Yield the data rebuilt from an uncompressed delta and its base."""
+    header = reader.readline()
+    if not header.startswith(MAGIC):
+        raise DeltaError('Not a delta file')
+
+    base = lines(base_chunks)
+    pending = list()
+    pending_size = 0
+
+    while True:
+        op = reader.readline().split()
+        if not op:
+            raise DeltaError('Delta ends without E')
+
+        if op[0] == b'C':
+            skip, count = int(op[1]), int(op[2])
+            for _ in range(skip):
+                if not base.readline():
+                    raise DeltaError('Delta skips past the end of its base')
+            for _ in range(count):
+                line = base.readline()
+                if not line:
+                    raise DeltaError('Delta copies past the end of its base')
+                pending.append(line)
+                pending_size += len(line)
+                if pending_size >= CHUNK_SIZE:
+                    yield b''.join(pending)
+                    pending.clear()
+                    pending_size = 0
+
+        elif op[0] == b'I':
+            if pending:
+                yield b''.join(pending)
+                pending.clear()
+                pending_size = 0
+            size = int(op[1])
+            data = reader.read(size)
+            if len(data) != size:
+                raise DeltaError('Delta is truncated')
+            yield data
+
+        elif op[0] == b'E':
+            if pending:
+                yield b''.join(pending)
+            return
+
+        else:
+            raise DeltaError(f'Unknown delta operation {op[0]!r}')
+
+
+def rebuild(links):
+    """Yield the uncompressed data of an archive in chunks.
+
+    links are (path, codec) pairs from the archive's own file down to the
+    full snapshot at the end of its chain; all but the last are deltas.
+    """
+    import transcode
+
+    (path, codec), rest = links[0], links[1:]
+    if not rest:
+        yield from transcode.decompressed(path, codec)
+        return
+
+    with open(path, 'rb') as f, \
+            compression.get(codec).open_reader(f) as reader:
+        yield from apply(io.BufferedReader(reader, CHUNK_SIZE),
+                         rebuild(rest))
+
+
+def delta_path(archivepath, codec=None):
+    """Return the delta file for an archive's full file path."""
+    extension = compression.get(codec).extension
+    return archivepath[:-len(extension)] + '.delta' + extension
+
+
+def chain(entry):
+    """Return the (path, codec) links to rebuild a catalog entry.
+
+    Archives of the chain that are in the cold tier are promoted.
+    """
+    import catalog
+    import tiers
+
+    entry = tiers.local(entry)
+    links = [(entry.path, entry.codec)]
+    seen = {entry.archive_no}
+    while entry.base is not None:
+        base = entry.base
+        entry = catalog.lookup(base)
+        if entry is None or entry.archive_no in seen:
+            raise DeltaError(f'Base archive {base} is not available')
+        entry = tiers.local(entry)
+        seen.add(entry.archive_no)
+        links.append((entry.path, entry.codec))
+    return links
+
+
+def compressed(links, codec=None):
+    """Yield rebuilt data compressed with a codec."""
+    compressor = compression.get(codec).compressor()
+    for chunk in rebuild(links):
+        block = compressor.compress(chunk)
+        if block:
+            yield block
+    yield compressor.flush()
+
+
+def write(path, codec, chunks, base_links, base_no, base_digest):
+    """Write the delta of chunks against a base; return (size, SHA-256)."""
+    import pipeline
+    import transcode
+
+    index = index_lines(rebuild(base_links))
+    source = io.BufferedReader(transcode.ChunkReader(
+        encode(chunks, index, base_no, base_digest)), CHUNK_SIZE)
+    sha256 = hashlib.sha256()
+    _, size = pipeline.compress_stream(source, path, codec=codec,
+                                       sha256=sha256)
+    return size, sha256.hexdigest()
+
+
+def digest(links):
+    """Return the SHA-256 and size of rebuilt data."""
+    sha256 = hashlib.sha256()
+    size = 0
+    for chunk in rebuild(links):
+        sha256.update(chunk)
+        size += len(chunk)
+    return sha256.hexdigest(), size
+
+
+def store(archive_no, codec, checksums):
+    """Replace a new archive's full file by a delta if that pays off.
+
+    Called once the full file is written and before the archive is marked
+    complete. Returns the checksums to record, with the file checksums of
+    the delta if one was stored.
+    """
+    import aux
+    import blobs
+    import catalog
+    import pipeline
+    import transcode
+
+    codec = compression.get(codec).name
+    _, archivepath = pipeline.archive_paths(archive_no, codec)
+    deltapath = delta_path(archivepath, codec)
+
+    # A retried job may have stored a delta before failing
+    if os.path.exists(deltapath):
+        aux.set_delta(archive_no, None, 0)
+        os.remove(deltapath)
+
+    max_depth = int(aux.get_config('delta_max_depth', 4))
+    max_bytes = int(aux.get_config('delta_max_bytes', 256 * 1024 ** 2))
+    max_ratio = float(aux.get_config('delta_max_ratio', 0.5))
+
+    base = aux.delta_base(archive_no)
+    if not max_depth or base is None:
+        return checksums
+
+    base_no, base_digest, base_size, depth = base
+    if base_digest == checksums.content_sha256:
+        return checksums
+    if depth >= max_depth:
+        logger.info(f'Archive {archive_no}: full snapshot after '
+                    f'{depth} deltas')
+        return checksums
+    if (base_size or 0) > max_bytes or os.stat(archivepath).st_nlink > 2:
+        return checksums
+
+    base_entry = catalog.lookup(base_no)
+    if base_entry is None:
+        return checksums
+
+    try:
+        base_links = chain(base_entry)
+        size, file_sha256 = write(deltapath, codec,
+                                  transcode.decompressed(archivepath, codec),
+                                  base_links, base_no, base_digest)
+
+        if size > max_ratio * checksums.file_size:
+            os.remove(deltapath)
+            return checksums
+
+        rebuilt = digest([(deltapath, codec)] + base_links)
+        if rebuilt != (checksums.content_sha256, checksums.content_size):
+            logger.error(f'Archive {archive_no}: delta does not rebuild '
+                         'the archive, keeping the full file')
+            os.remove(deltapath)
+            return checksums
+
+    except (OSError, DeltaError) as e:
+        logger.info(f'Archive {archive_no}: cannot store a delta: {e}')
+        if os.path.exists(deltapath):
+            os.remove(deltapath)
+        return checksums
+
+    aux.set_delta(archive_no, base_no, depth + 1, file_sha256, size)
+    blobs.release(archivepath, checksums.content_sha256, codec)
+    logger.info(f'Archive {archive_no}: stored as a delta of archive '
+                f'{base_no}, {size} bytes instead of {checksums.file_size}')
+
+    return checksums._replace(file_sha256=file_sha256, file_size=size)
+
+
+def materialize(archive_no):
+    """Turn a delta archive back into a full archive.
+
+    Used before an archive that other archives are based on is deleted.
+    """
+    import aux
+    import blobs
+    import catalog
+    import integrity
+    import pipeline
+    import tiers
+    import transcode
+
+    entry = catalog.lookup(archive_no)
+    if entry is None or entry.base is None:
+        return
+
+    _, archivepath = pipeline.archive_paths(archive_no, entry.codec)
+    links = chain(entry)
+    source = io.BufferedReader(transcode.ChunkReader(rebuild(links)),
+                               CHUNK_SIZE)
+    sha256 = hashlib.sha256()
+    pipeline.compress_stream(source, archivepath, codec=entry.codec,
+                             sha256=sha256)
+
+    file_sha256 = sha256.hexdigest()
+    content_sha256 = aux.get_content_hash(archive_no)
+    if content_sha256 and blobs.store(archivepath, content_sha256,
+                                      entry.codec):
+        file_sha256 = integrity.file_digest(archivepath)[0]
+
+    aux.set_delta(archive_no, None, 0, file_sha256,
+                  os.path.getsize(archivepath))
+    os.remove(entry.path)
+    tiers.discard(archive_no, entry.codec)
+    logger.info(f'Archive {archive_no}: rebuilt as a full archive')
@@ -0,0 +1,219 @@
+"""Send archive files with conditional GET and byte-range support.
+
+Responses carry a stable ETag and Last-Modified for the file so clients can
+revalidate cheaply, and honour Range requests (single ranges as a plain 206,
+several ranges as multipart/byteranges) so interrupted downloads can be
+resumed without resending what the client already has.
+
+When an offload mode is configured the file body is not sent from Python at
+all: the response only carries X-Accel-Redirect (nginx) or X-Sendfile
+(Apache, lighttpd) and the front-end proxy streams the file itself,
+including ranges and revalidation.
+"""
+
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from flask import Response, request
+
+
+CHUNK_SIZE = 256 * 1024
+
+OFFLOAD_MODES = ('none', 'x-accel', 'x-sendfile')
+
+
+class ChunkWriter:
+    """Unseekable file that collects written bytes until drained.
+
+    Lets zipfile, pyarrow and similar writers feed a streamed response.
+    """
+
+    def __init__(self):
+        self.parts = list()
+        self.offset = 0
+        self.closed = False
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts.clear()
+        return data
+
+
+def file_etag(archive_no, st):
+    """Build an ETag that changes whenever the archive file is rewritten."""
+    return f'pbdb-{archive_no}-{st.st_size:x}-{st.st_mtime_ns:x}'
+
+
+def read_range(path, start, stop):
+    """Yield the bytes of path between start and stop in chunks."""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def satisfiable_ranges(byte_range, length):
+    """Resolve a parsed Range header to sorted, merged (start, stop) pairs."""
+    spans = list()
+    for start, stop in byte_range.ranges:
+        if start < 0:
+            start, stop = max(length + start, 0), length
+        elif stop is None or stop > length:
+            stop = length
+        if start < stop:
+            spans.append((start, stop))
+
+    spans.sort()
+    merged = list()
+    for start, stop in spans:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+
+    return merged
+
+
+def not_modified(etag, last_modified):
+    """Evaluate If-None-Match and If-Modified-Since for this request."""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def range_applies(etag, last_modified):
+    """Check If-Range; a stale or weak validator means send the whole file.
+
+    A date only validates when it is exactly the file's Last-Modified and
+    that is strong, i.e. the file had not changed for a second before now.
+    """
+    if_range = request.if_range
+    if if_range.etag:
+        return if_range.etag == etag
+    if if_range.date:
+        now = datetime.now(timezone.utc)
+        return (last_modified == if_range.date and
+                now - last_modified > timedelta(seconds=1))
+    return True
+
+
+def send_archive(path, archive_no, attachment_filename, mimetype, st=None):
+    """Build the response for GET/HEAD of an archive file."""
+    st = st or os.stat(path)
+    length = st.st_size
+    etag = file_etag(archive_no, st)
+    last_modified = datetime.fromtimestamp(int(st.st_mtime), timezone.utc)
+
+    response = Response(mimetype=mimetype, direct_passthrough=True)
+    response.headers.add('Content-Disposition', 'attachment',
+                         filename=attachment_filename)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.set_etag(etag)
+    response.last_modified = last_modified
+
+    if not_modified(etag, last_modified):
+        response.status_code = 304
+        return response
+
+    byte_range = request.range
+    if (byte_range is None or byte_range.units != 'bytes'
+            or not range_applies(etag, last_modified)):
+        response.response = read_range(path, 0, length)
+        response.content_length = length
+        return response
+
+    spans = satisfiable_ranges(byte_range, length)
+
+    if not spans:
+        response.status_code = 416
+        response.headers['Content-Range'] = f'bytes */{length}'
+        response.content_length = 0
+        return response
+
+    response.status_code = 206
+
+    if len(spans) == 1:
+        start, stop = spans[0]
+        response.headers['Content-Range'] = \
+            f'bytes {start}-{stop - 1}/{length}'
+        response.response = read_range(path, start, stop)
+        response.content_length = stop - start
+        return response
+
+    boundary = uuid.uuid4().hex
+    parts = list()
+    for start, stop in spans:
+        head = (f'\r\n--{boundary}\r\n'
+                f'Content-Type: {mimetype}\r\n'
+                f'Content-Range: bytes {start}-{stop - 1}/{length}\r\n'
+                '\r\n').encode()
+        parts.append((head, start, stop))
+    tail = f'\r\n--{boundary}--\r\n'.encode()
+
+    def multipart():
+        for head, start, stop in parts:
+            yield head
+            yield from read_range(path, start, stop)
+        yield tail
+
+    response.response = multipart()
+    response.mimetype = 'multipart/byteranges'
+    response.headers['Content-Type'] = \
+        f'multipart/byteranges; boundary={boundary}'
+    response.content_length = (sum(len(h) + stop - start
+                                   for h, start, stop in parts) + len(tail))
+    return response
+
+
+def offload_mode():
+    """Return the configured download offload mode."""
+    import aux
+
+    mode = aux.get_config('offload', 'none').lower()
+    if mode not in OFFLOAD_MODES:
+        raise ValueError(f'Unsupported offload mode: {mode}')
+
+    return mode
+
+
+def offload_archive(path, filename, attachment_filename, mimetype,
+                    mode=None):
+    """Hand the file transfer for an archive to the front-end proxy."""
+    import aux
+
+    mode = mode or offload_mode()
+
+    response = Response(mimetype=mimetype)
+    response.headers.add('Content-Disposition', 'attachment',
+                         filename=attachment_filename)
+
+    if mode == 'x-accel':
+        prefix = aux.get_config('offload_prefix', '/protected-archives/')
+        response.headers['X-Accel-Redirect'] = \
+            prefix.rstrip('/') + '/' + filename
+    else:
+        response.headers['X-Sendfile'] = os.path.abspath(path)
+
+    return response
@@ -0,0 +1,305 @@
+"""Archive checksums and the storage scrubber.
+
+Every archive records the size and SHA-256 of its uncompressed data
+(content_size, content_sha256) and of its compressed file (file_size,
+file_sha256) when it is created. scrub() walks the whole store and checks
+files against those records in a process pool, with reads throttled so a
+scrub does not starve downloads. It reports:
+
+    mismatch  file size or SHA-256 differs from the record
+    corrupt   file does not decompress to the recorded content (deep only)
+    missing   a finished archive's row has no file
+    orphans   files in storage with no row, stray .part files and blobs no
+              archive links to
+
+Delta archives (see delta.py) are checked against their delta file; a deep
+check rebuilds their data from the chain of base archives.
+"""
+
+import hashlib
+import os
+import re
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import compression
+
+
+CHUNK_SIZE = 1 << 20
+
+Checksums = namedtuple('Checksums', ['content_sha256', 'content_size',
+                                     'file_sha256', 'file_size'])
+
+# Statuses of rows that are not expected to have a file yet, or ever
+UNFINISHED = ('fail', 'queued', 'downloading', 'compressing')
+
+ARCHIVE_FILE = re.compile(
+    r'^(\d+)(\.header|(?:\.delta)?\.[a-z0-9]+)(\S*\.part)?$')
+
+
+class Throttle:
+    """Limit reads to rate bytes per second (no limit if rate is falsy)."""
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.start = time.monotonic()
+        self.consumed = 0
+
+    def __call__(self, n):
+        if not self.rate:
+            return
+        self.consumed += n
+        ahead = self.consumed / self.rate - (time.monotonic() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def _digest(reader, throttle=None):
+    sha256 = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = reader.read(CHUNK_SIZE)
+        if not chunk:
+            return sha256.hexdigest(), size
+        sha256.update(chunk)
+        size += len(chunk)
+        if throttle:
+            throttle(len(chunk))
+
+
+def file_digest(path, throttle=None):
+    """Return the SHA-256 and size of a file."""
+    with open(path, 'rb') as f:
+        return _digest(f, throttle)
+
+
+def content_digest(path, codec, throttle=None):
+    """Return the SHA-256 and size of an archive's uncompressed data."""
+    with open(path, 'rb') as f:
+        counted = _ThrottledFile(f, throttle)
+        with compression.get(codec).open_reader(counted) as reader:
+            return _digest(reader)
+
+
+def rebuilt_digest(links, throttle=None):
+    """Return the SHA-256 and size of a delta archive's rebuilt data."""
+    import delta
+    import transcode
+
+    return _digest(_ThrottledFile(transcode.ChunkReader(delta.rebuild(links)),
+                                  throttle))
+
+
+class _ThrottledFile:
+    """Throttle reads of the compressed file under a decompressor."""
+
+    def __init__(self, f, throttle):
+        self.f = f
+        self.throttle = throttle
+
+    def read(self, size=-1):
+        chunk = self.f.read(size)
+        if self.throttle:
+            self.throttle(len(chunk))
+        return chunk
+
+    def readinto(self, buffer):
+        n = self.f.readinto(buffer)
+        if self.throttle and n:
+            self.throttle(n)
+        return n
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+
+def check_file(archive_no, path, codec, expected, deep=False, rate=None,
+               links=None):
+    """Verify one archive file; run in a scrub worker process.
+
+    expected is the archive's Checksums row (fields may be None); links
+    are the (path, codec) pairs to rebuild a delta archive. Returns a dict
+    with the measured values and a state of ok, mismatch, corrupt or
+    missing.
+    """
+    throttle = Throttle(rate)
+    result = {'archive_no': archive_no, 'path': path}
+
+    try:
+        file_sha256, file_size = file_digest(path, throttle)
+    except FileNotFoundError:
+        return dict(result, state='missing')
+
+    result.update(file_sha256=file_sha256, file_size=file_size)
+    problems = list()
+
+    if expected.file_size is not None and expected.file_size != file_size:
+        problems.append(f'size {file_size} != {expected.file_size}')
+    if expected.file_sha256 and expected.file_sha256 != file_sha256:
+        problems.append('file SHA-256 differs')
+
+    if deep:
+        try:
+            if links:
+                content_sha256, content_size = rebuilt_digest(links,
+                                                              throttle)
+            else:
+                content_sha256, content_size = content_digest(path, codec,
+                                                              throttle)
+        except Exception as e:
+            deep_problems = [f'does not decompress: {e}']
+        else:
+            result.update(content_sha256=content_sha256,
+                          content_size=content_size)
+            deep_problems = list()
+            if expected.content_sha256 and \
+                    expected.content_sha256 != content_sha256:
+                deep_problems.append('content SHA-256 differs')
+            if expected.content_size is not None and \
+                    expected.content_size != content_size:
+                deep_problems.append('content size differs')
+
+        # A file that no longer matches its record is a mismatch first
+        if deep_problems and not problems:
+            return dict(result, state='corrupt', problems=deep_problems)
+        problems += deep_problems
+
+    if problems:
+        return dict(result, state='mismatch', problems=problems)
+
+    return dict(result, state='ok')
+
+
+def archive_path(storage, archive_no, codec, delta=False):
+    realpath = '/'.join([storage, str(archive_no)]).replace('//', '/')
+    if delta:
+        realpath += '.delta'
+    return realpath + compression.get(codec).extension
+
+
+def delta_links(storage, archive_no, codecs, bases):
+    """Return the (path, codec) pairs to rebuild an archive, or None."""
+    links = list()
+    while archive_no is not None and len(links) <= len(bases):
+        if archive_no not in codecs:
+            return None
+        links.append((archive_path(storage, archive_no, codecs[archive_no],
+                                   archive_no in bases),
+                      codecs[archive_no]))
+        archive_no = bases.get(archive_no)
+    return links if archive_no is None else None
+
+
+def find_orphans(storage, rows, bases=None):
+    """List files in storage that no archive row accounts for."""
+    import blobs
+
+    bases = bases or dict()
+    expected = {archive_no: ('.delta' if archive_no in bases else '') +
+                compression.get(codec).extension
+                for archive_no, codec, *_ in rows}
+    orphans = list()
+
+    for name in sorted(os.listdir(storage)):
+        path = os.path.join(storage, name)
+        if name.startswith('.') or not os.path.isfile(path):
+            continue
+
+        match = ARCHIVE_FILE.match(name)
+        if match is None:
+            continue
+
+        archive_no, extension, part = match.groups()
+        archive_no = int(archive_no)
+        if part:
+            orphans.append({'path': path, 'reason': 'partial write'})
+        elif archive_no not in expected:
+            orphans.append({'path': path, 'reason': 'no archive row'})
+        elif extension not in ('.header', expected[archive_no]):
+            # A full file replaced by a delta, or the other way round
+            same_codec = (extension.rsplit('.', 1)[1] ==
+                          expected[archive_no].rsplit('.', 1)[1])
+            orphans.append({'path': path, 'reason': 'stale file' if same_codec
+                            else 'stale codec'})
+
+    root = blobs.blob_root()
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            if name.startswith('.'):
+                continue
+            if os.stat(path).st_nlink == 1:
+                orphans.append({'path': path, 'reason': 'unreferenced blob'})
+
+    return orphans
+
+
+def check_cold(archive_no, path, expected, cold):
+    """Check an archive held only in the cold tier by its size there."""
+    size = cold[os.path.basename(path)]
+    result = {'archive_no': archive_no, 'path': path, 'tier': 'cold',
+              'file_size': size}
+    if expected.file_size is not None and expected.file_size != size:
+        return dict(result, state='mismatch',
+                    problems=[f'size {size} != {expected.file_size}'])
+    return dict(result, state='ok')
+
+
+def scrub(rows, storage, workers=None, rate=None, deep=False, bases=None,
+          cold=None):
+    """Check every archive file and the storage directory.
+
+    rows are (archive_no, codec, status, content_sha256, content_size,
+    file_sha256, file_size) tuples and bases maps delta archives to their
+    base. cold maps the files in the cold storage tier to their sizes;
+    archives found only there are checked by size, and deltas whose chain
+    is partly cold are not rebuilt. rate is the total read budget in bytes
+    per second, shared between workers. Returns a report dict.
+    """
+    workers = workers or os.cpu_count() or 1
+    per_worker = rate / workers if rate else None
+    bases = bases or dict()
+    cold = cold or dict()
+    codecs = {archive_no: codec for archive_no, codec, *_ in rows}
+
+    def is_cold(path):
+        return os.path.basename(path) in cold and not os.path.exists(path)
+
+    results = list()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = list()
+        for archive_no, codec, status, *checksums in rows:
+            if status in UNFINISHED:
+                continue
+            is_delta = archive_no in bases
+            path = archive_path(storage, archive_no, codec, is_delta)
+            if is_cold(path):
+                results.append(check_cold(archive_no, path,
+                                          Checksums(*checksums), cold))
+                continue
+            links = None
+            archive_deep = deep
+            if is_delta and deep:
+                links = delta_links(storage, archive_no, codecs, bases)
+                if links and any(is_cold(link) for link, _ in links):
+                    links, archive_deep = None, False
+            futures.append(executor.submit(check_file, archive_no, path,
+                                           codec, Checksums(*checksums),
+                                           archive_deep, per_worker, links))
+        for future in futures:
+            results.append(future.result())
+
+    by_state = dict()
+    for result in results:
+        by_state.setdefault(result['state'], []).append(result)
+
+    return {'checked': len(results),
+            'ok': len(by_state.get('ok', [])),
+            'cold': sum(1 for result in results
+                        if result.get('tier') == 'cold'),
+            'mismatch': by_state.get('mismatch', []),
+            'corrupt': by_state.get('corrupt', []),
+            'missing': by_state.get('missing', []),
+            'orphans': find_orphans(storage, rows, bases),
+            'results': results}
@@ -0,0 +1,487 @@
+"""Durable archive-creation job queue and background workers.
+
+Jobs are stored in a local SQLite database so they survive worker restarts
+and are visible to every uwsgi process. Each process runs a small pool of
+worker threads that claim queued jobs, build the archive file on disk and
+report progress through the status column of data_archives (queued,
+downloading, compressing). A job that fails for a transient reason, such as
+an unreachable data service, is queued again with exponential backoff from
+job_retry_base seconds until it has been tried job_max_attempts times.
+"""
+
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+
+import aux
+import blobs
+import coalesce
+import delta
+import integrity
+import metrics
+import pipeline
+import tiers
+import upstream
+
+
+logger = logging.getLogger('archiver.jobs')
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS jobs (
+                archive_no INTEGER PRIMARY KEY,
+                payload TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'queued',
+                stage TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker TEXT,
+                error TEXT,
+                created REAL NOT NULL,
+                updated REAL NOT NULL,
+                batch TEXT,
+                next_attempt REAL NOT NULL DEFAULT 0
+            )"""
+
+BATCH_SCHEMA = """CREATE TABLE IF NOT EXISTS batches (
+                      id TEXT PRIMARY KEY,
+                      concurrency INTEGER NOT NULL,
+                      created REAL NOT NULL
+                  )"""
+
+
+class JobError(Exception):
+    """Raised by a job stage to fail the archive with a client message."""
+
+
+def connect():
+    """Open the local queue database, creating the schema if needed."""
+    path = aux.get_config('queue_db', 'jobs.sqlite')
+
+    db = sqlite3.connect(path, timeout=30, isolation_level=None)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute(SCHEMA)
+    db.execute(BATCH_SCHEMA)
+
+    # Queues created before bulk imports or retries lack these columns
+    columns = [row[1] for row in db.execute('PRAGMA table_info(jobs)')]
+    for column, definition in [('batch', 'TEXT'),
+                               ('next_attempt', 'REAL NOT NULL DEFAULT 0')]:
+        if column not in columns:
+            try:
+                db.execute(f'ALTER TABLE jobs ADD COLUMN {column} '
+                           f'{definition}')
+            except sqlite3.OperationalError:
+                pass
+
+    return db
+
+
+def worker_id():
+    """Identify this process for the worker column."""
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def enqueue(archive_no, payload):
+    """Persist a new job and wake a local worker."""
+    now = time.time()
+
+    db = connect()
+    try:
+        db.execute("""INSERT OR REPLACE INTO jobs
+                      (archive_no, payload, state, created, updated)
+                      VALUES (?, ?, 'queued', ?, ?)""",
+                   (archive_no, json.dumps(payload), now, now))
+    finally:
+        db.close()
+
+    aux.archive_status(archive_no, stage='queued')
+
+    with _wakeup:
+        _wakeup.notify()
+
+
+def enqueue_batch(batch, items, concurrency):
+    """Persist the jobs of a bulk import in one transaction.
+
+    At most concurrency jobs of the batch run at once, and queued
+    single-archive jobs are always claimed ahead of batch jobs. The
+    archives' status must already be 'queued'.
+    """
+    now = time.time()
+
+    db = connect()
+    try:
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute("""INSERT INTO batches (id, concurrency, created)
+                          VALUES (?, ?, ?)""", (batch, concurrency, now))
+            db.executemany("""INSERT OR REPLACE INTO jobs
+                              (archive_no, payload, state, created, updated,
+                               batch)
+                              VALUES (?, ?, 'queued', ?, ?, ?)""",
+                           [(archive_no, json.dumps(payload), now, now, batch)
+                            for archive_no, payload in items])
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+    finally:
+        db.close()
+
+    with _wakeup:
+        _wakeup.notify_all()
+
+
+def batch_info(batch):
+    """Return the queue entries of a bulk import keyed by archive_no."""
+    db = connect()
+    try:
+        rows = db.execute("""SELECT archive_no, state, stage, error
+                             FROM jobs
+                             WHERE batch = ?
+                             ORDER BY archive_no""", (batch,)).fetchall()
+    finally:
+        db.close()
+
+    return {archive_no: {'state': state, 'stage': stage, 'error': error}
+            for archive_no, state, stage, error in rows}
+
+
+def job_info(archive_no):
+    """Return the queue entry for an archive, or None."""
+    db = connect()
+    try:
+        row = db.execute("""SELECT state, stage, attempts, error,
+                                   created, updated
+                            FROM jobs
+                            WHERE archive_no = ?""",
+                         (archive_no,)).fetchone()
+    finally:
+        db.close()
+
+    if row is None:
+        return None
+
+    state, stage, attempts, error, created, updated = row
+    return {'state': state,
+            'stage': stage,
+            'attempts': attempts,
+            'error': error,
+            'queued_at': created,
+            'updated_at': updated}
+
+
+def claim(db):
+    """Atomically move the oldest due job to running.
+
+    Returns its archive_no, payload and attempt number, or None.
+    """
+    now = time.time()
+
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        row = db.execute("""SELECT j.archive_no, j.payload, j.attempts
+                            FROM jobs AS j
+                                 LEFT JOIN batches AS b ON b.id = j.batch
+                            WHERE j.state = 'queued'
+                              AND j.next_attempt <= ?
+                              AND (j.batch IS NULL
+                                   OR (SELECT COUNT(*)
+                                       FROM jobs AS r
+                                       WHERE r.batch = j.batch
+                                         AND r.state = 'running')
+                                      < COALESCE(b.concurrency, 1))
+                            ORDER BY j.batch IS NOT NULL, j.created
+                            LIMIT 1""", (now,)).fetchone()
+        if row is None:
+            db.execute('COMMIT')
+            return None
+
+        db.execute("""UPDATE jobs
+                      SET state = 'running', worker = ?,
+                          attempts = attempts + 1, updated = ?
+                      WHERE archive_no = ?""",
+                   (worker_id(), now, row[0]))
+        db.execute('COMMIT')
+    except Exception:
+        db.execute('ROLLBACK')
+        raise
+
+    return row[0], json.loads(row[1]), row[2] + 1
+
+
+def set_stage(db, archive_no, stage):
+    """Record job progress locally and in data_archives."""
+    db.execute("""UPDATE jobs SET stage = ?, updated = ?
+                  WHERE archive_no = ?""",
+               (stage, time.time(), archive_no))
+    aux.archive_status(archive_no, stage=stage)
+
+
+def finish(db, archive_no, error=None):
+    """Mark a job done or failed and forget the session it ran under."""
+    state = 'failed' if error else 'done'
+
+    row = db.execute('SELECT payload FROM jobs WHERE archive_no = ?',
+                     (archive_no,)).fetchone()
+    payload = json.loads(row[0]) if row else dict()
+    payload.pop('session_id', None)
+
+    db.execute("""UPDATE jobs SET state = ?, error = ?, payload = ?,
+                                  updated = ?
+                  WHERE archive_no = ?""",
+               (state, error, json.dumps(payload), time.time(), archive_no))
+
+
+def backoff(attempts):
+    """Seconds to wait before retrying after a number of failed attempts."""
+    base = float(aux.get_config('job_retry_base', 60))
+    return min(base * 2 ** (attempts - 1), 3600)
+
+
+def retry(db, archive_no, attempts, error):
+    """Queue a job again after a transient failure.
+
+    Returns False, leaving the job alone, once job_max_attempts is reached.
+    """
+    if attempts >= int(aux.get_config('job_max_attempts', 3)):
+        return False
+
+    now = time.time()
+    db.execute("""UPDATE jobs SET state = 'queued', stage = 'queued',
+                                  worker = NULL, error = ?,
+                                  next_attempt = ?, updated = ?
+                  WHERE archive_no = ?""",
+               (error, now + backoff(attempts), now, archive_no))
+    aux.archive_status(archive_no, stage='queued')
+    return True
+
+
+def transient(error):
+    """Whether a failed job may succeed if it is tried again."""
+    if isinstance(error, JobError):
+        return False
+    if isinstance(error, pipeline.PipelineError):
+        return isinstance(error.__cause__, upstream.UpstreamError)
+    return True
+
+
+def recover(db):
+    """Requeue jobs left running by processes on this host that died.
+
+    A job that has already used its attempts, e.g. one whose archive keeps
+    killing the worker, is failed instead.
+    """
+    host = socket.gethostname()
+    rows = db.execute("""SELECT archive_no, worker, attempts
+                         FROM jobs
+                         WHERE state = 'running'""").fetchall()
+
+    for archive_no, worker, attempts in rows:
+        worker_host, _, pid = (worker or '').rpartition(':')
+        if worker_host != host:
+            continue
+        try:
+            os.kill(int(pid), 0)
+            continue
+        except (OSError, ValueError):
+            pass
+
+        if retry(db, archive_no, attempts, 'Worker died'):
+            logger.info(f'Requeueing orphaned job {archive_no}')
+        else:
+            logger.info(f'Archive {archive_no}: worker died on the last '
+                        'attempt')
+            aux.archive_status(archive_no=archive_no, success=False)
+            finish(db, archive_no, 'Error')
+
+
+def fetch_data(db, archive_no, job):
+    """Fetch and store an archive's data, sharing identical fetches.
+
+    Returns the integrity.Checksums of the stored archive.
+    """
+    import shutil
+
+    codec = job.get('codec')
+    headerpath, archivepath = pipeline.archive_paths(archive_no, codec)
+
+    # Coalesce with concurrent jobs for the same query and visibility
+    key = coalesce.query_key(job['uri'], job.get('auth', job['session_id']),
+                             codec)
+
+    # Any identical fetch finished since this job was queued will do
+    row = db.execute('SELECT created FROM jobs WHERE archive_no = ?',
+                     (archive_no,)).fetchone()
+    queued_at = row[0] if row else time.time()
+
+    with coalesce.flight(key):
+        shared = coalesce.finished_since(key, queued_at)
+        if shared:
+            try:
+                if blobs.link(archivepath, shared['digest'], codec):
+                    shutil.copyfile(shared['headerpath'], headerpath)
+                    logger.info(f'Archive {archive_no}: shared fetch of '
+                                f'archive {shared["archive_no"]}')
+                    file_sha256, file_size = integrity.file_digest(
+                        archivepath)
+                    return integrity.Checksums(shared['digest'],
+                                               shared.get('content_size'),
+                                               file_sha256, file_size)
+            except OSError as e:
+                logger.info(f'Archive {archive_no}: cannot share fetch: {e}')
+
+        # Stream the data service response straight into the compressed file
+        bytes_in, bytes_out, digest, file_sha256 = pipeline.fetch_archive(
+            archive_no, job['uri'], job['session_id'],
+            progress=heartbeat(db, archive_no), codec=codec,
+            user=job.get('auth', job['session_id']))
+        logger.info(f'Archive {archive_no}: {bytes_in} bytes in, '
+                    f'{bytes_out} bytes written')
+
+        # Share storage with any archive holding identical data
+        saved = blobs.store(archivepath, digest, codec)
+        if saved:
+            logger.info(f'Archive {archive_no}: deduplicated, '
+                        f'{saved} bytes saved')
+            # The stored blob may have been compressed differently
+            file_sha256, bytes_out = integrity.file_digest(archivepath)
+
+        coalesce.record(key, archive_no=archive_no, digest=digest,
+                        content_size=bytes_in, headerpath=headerpath)
+
+    return integrity.Checksums(digest, bytes_in, file_sha256, bytes_out)
+
+
+def build_archive(db, archive_no, job):
+    """Download, compress and announce one archive."""
+    from datetime import datetime as dt
+
+    set_stage(db, archive_no, 'downloading')
+    checksums = fetch_data(db, archive_no, job)
+
+    # Store repeated queries as a delta of the previous archive
+    set_stage(db, archive_no, 'compressing')
+    with metrics.STAGE_SECONDS.time(stage='delta'):
+        checksums = delta.store(archive_no, job.get('codec'), checksums)
+    aux.set_checksums(archive_no, *checksums)
+
+    # Archive was successfully created on disk
+    logger.info('Created archive number: {0:d}'.format(archive_no))
+    aux.archive_status(archive_no=archive_no, success=True)
+    tiers.created(archive_no)
+
+    # Queue the email requesting a DOI; the mail sender delivers it
+    try:
+        with metrics.STAGE_SECONDS.time(stage='email'):
+            message_id = aux.request_doi(archive_no, job['title'],
+                                         dt.now().year, job['authors'],
+                                         job['ent'], job.get('email'))
+        logger.info(f'DOI email queued as outbox message {message_id}')
+    except Exception as e:
+        logger.info(f'Server error - Email: {e}')
+
+
+def heartbeat(db, archive_no, interval=10.0):
+    """Return a progress callback that refreshes the job timestamp."""
+    last = [time.monotonic()]
+
+    def progress(bytes_in):
+        now = time.monotonic()
+        if now - last[0] >= interval:
+            last[0] = now
+            db.execute("""UPDATE jobs SET updated = ?
+                          WHERE archive_no = ?""",
+                       (time.time(), archive_no))
+
+    return progress
+
+
+def run_one(db):
+    """Claim and run a single job; return False if the queue was empty."""
+    claimed = claim(db)
+    if claimed is None:
+        return False
+
+    archive_no, job, attempts = claimed
+    try:
+        build_archive(db, archive_no, job)
+        finish(db, archive_no)
+        metrics.JOBS.inc(result='done')
+
+    except (JobError, pipeline.PipelineError) as e:
+        logger.info(f'Archive {archive_no}: {e}')
+        if transient(e) and retry(db, archive_no, attempts, str(e)):
+            metrics.JOBS.inc(result='retry')
+        else:
+            aux.archive_status(archive_no=archive_no, success=False)
+            finish(db, archive_no, str(e))
+            metrics.JOBS.inc(result='failed')
+
+    except Exception as e:
+        logger.error(e)
+        logger.error(traceback.format_exc())
+        if retry(db, archive_no, attempts, 'Error'):
+            metrics.JOBS.inc(result='retry')
+        else:
+            aux.archive_status(archive_no=archive_no, success=False)
+            finish(db, archive_no, 'Error')
+            metrics.JOBS.inc(result='error')
+
+    # Workers may run in processes that are not serving requests
+    metrics.flush()
+
+    return True
+
+
+def work():
+    """Worker thread main loop."""
+    poll = float(aux.get_config('job_poll_interval', 2))
+    db = connect()
+
+    while True:
+        try:
+            if run_one(db):
+                continue
+        except Exception as e:
+            logger.error(e)
+            logger.error(traceback.format_exc())
+
+        with _wakeup:
+            _wakeup.wait(poll)
+
+
+_wakeup = threading.Condition()
+_started_pid = None
+_start_lock = threading.Lock()
+
+
+def ensure_workers():
+    """Start this process's worker threads if they are not running yet."""
+    global _started_pid
+
+    if _started_pid == os.getpid():
+        return
+
+    with _start_lock:
+        if _started_pid == os.getpid():
+            return
+
+        db = connect()
+        try:
+            recover(db)
+        finally:
+            db.close()
+
+        n_workers = int(aux.get_config('job_workers', 2))
+        for i in range(n_workers):
+            thread = threading.Thread(target=work,
+                                      name=f'archive-worker-{i}',
+                                      daemon=True)
+            thread.start()
+
+        _started_pid = os.getpid()
+        logger.info(f'Started {n_workers} archive workers')
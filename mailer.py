@@ -0,0 +1,350 @@
+"""Persistent outbox and background sender for notification email.
+
+Messages are written to an outbox table in the local job queue database and
+sent by a background thread in each uwsgi process, so nothing on the request
+or job path waits on the mail server. The sender claims due messages in
+batches and delivers each batch over one transport session, retrying
+failures with exponential backoff. Pending mail survives restarts.
+
+The transport is chosen with mail_transport in settings.cnf:
+
+    sendmail  pipe each message to mail_sendmail (default /usr/sbin/sendmail)
+    smtp      one connection per batch to mail_smtp_host:mail_smtp_port
+    file      write each message to mail_file_dir (for tests and development)
+"""
+
+import json
+import logging
+import os
+import smtplib
+import subprocess
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from email.mime.text import MIMEText
+
+import aux
+import jobs
+import metrics
+
+
+logger = logging.getLogger('archiver.mailer')
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                archive_no INTEGER,
+                recipients TEXT NOT NULL,
+                message TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'queued',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL,
+                worker TEXT,
+                error TEXT,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            )"""
+
+SENDER = 'do-not-reply@paleobiodb.org'
+
+class SendmailTransport:
+    """Pipe each message to a local sendmail binary."""
+
+    def __init__(self, path='/usr/sbin/sendmail'):
+        self.path = path
+
+    @contextmanager
+    def session(self):
+        yield self.send
+
+    def send(self, recipients, message):
+        proc = subprocess.run([self.path, '-oi', '--'] + recipients,
+                              input=message.encode(), capture_output=True,
+                              timeout=60)
+        if proc.returncode:
+            raise OSError(f'sendmail exited {proc.returncode}: '
+                          f'{proc.stderr.decode(errors="replace").strip()}')
+
+
+class SMTPTransport:
+    """Deliver a batch of messages over one SMTP connection."""
+
+    def __init__(self, host='localhost', port=25, starttls=False,
+                 username=None, password=None, timeout=30):
+        self.host = host
+        self.port = port
+        self.starttls = starttls
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+
+    @contextmanager
+    def session(self):
+        with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as smtp:
+            if self.starttls:
+                smtp.starttls()
+            if self.username:
+                smtp.login(self.username, self.password)
+
+            def send(recipients, message):
+                smtp.sendmail(SENDER, recipients, message)
+
+            yield send
+
+
+class FileTransport:
+    """Write each message to its own file in a directory."""
+
+    def __init__(self, directory='mail'):
+        self.directory = directory
+
+    @contextmanager
+    def session(self):
+        os.makedirs(self.directory, exist_ok=True)
+        yield self.send
+
+    def send(self, recipients, message):
+        name = f'{time.time():.6f}-{os.getpid()}-{threading.get_ident()}.eml'
+        path = os.path.join(self.directory, name)
+        with open(path + '.part', 'w') as f:
+            f.write(message)
+        os.replace(path + '.part', path)
+
+
+def get_transport():
+    """Build the transport selected in settings."""
+    kind = aux.get_config('mail_transport', 'sendmail')
+
+    if kind == 'sendmail':
+        return SendmailTransport(aux.get_config('mail_sendmail',
+                                                '/usr/sbin/sendmail'))
+    if kind == 'smtp':
+        username = aux.get_config('mail_smtp_user', '') or None
+        return SMTPTransport(
+            host=aux.get_config('mail_smtp_host', 'localhost'),
+            port=int(aux.get_config('mail_smtp_port', 25)),
+            starttls=aux.get_config('mail_smtp_starttls', 'no') == 'yes',
+            username=username,
+            password=aux.get_config('mail_smtp_password', '') or None)
+    if kind == 'file':
+        return FileTransport(aux.get_config('mail_file_dir', 'mail'))
+
+    raise ValueError(f'Unknown mail_transport: {kind}')
+
+
+def connect():
+    """Open the queue database with the outbox table in place."""
+    db = jobs.connect()
+    db.execute(SCHEMA)
+    return db
+
+
+def enqueue(recipients, msg, archive_no=None):
+    """Persist a message for the background sender; return its outbox id."""
+    now = time.time()
+
+    db = connect()
+    try:
+        cursor = db.execute("""INSERT INTO outbox
+                               (archive_no, recipients, message,
+                                next_attempt, created, updated)
+                               VALUES (?, ?, ?, ?, ?, ?)""",
+                            (archive_no, json.dumps(recipients),
+                             msg.as_string(), now, now, now))
+        message_id = cursor.lastrowid
+    finally:
+        db.close()
+
+    with _wakeup:
+        _wakeup.notify()
+
+    return message_id
+
+
+def doi_request(archive_no, title, yr, authors, recipients):
+    """Build the DOI request message for an archive."""
+    base = aux.get_config('base')
+
+    body = f'URL: {base}/classic/app/archive/view?id={archive_no}\n'
+    body += f'Creators: {authors}\n'
+    body += f'Title: {title}\n'
+    body += 'Publisher: Paleobiology Database\n'
+    body += f'Publication Year: {yr}\n'
+    body += 'Resource Type: Dataset\n'
+    body += '========\n'
+    body += f'PBDB Archive ID Number: {archive_no}\n'
+    body += 'DOI: Pending\n'
+
+    msg = MIMEText(body)
+
+    msg['From'] = SENDER
+    msg['To'] = ','.join(recipients)
+    msg['Subject'] = 'PBDB archive DOI request'
+
+    return msg
+
+
+def claim(db, batch_size):
+    """Move up to batch_size due messages to sending and return them."""
+    now = time.time()
+
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        rows = db.execute("""SELECT id, recipients, message, attempts
+                             FROM outbox
+                             WHERE state = 'queued' AND next_attempt <= ?
+                             ORDER BY next_attempt
+                             LIMIT ?""", (now, batch_size)).fetchall()
+        db.executemany("""UPDATE outbox
+                          SET state = 'sending', worker = ?,
+                              attempts = attempts + 1, updated = ?
+                          WHERE id = ?""",
+                       [(jobs.worker_id(), now, row[0]) for row in rows])
+        db.execute('COMMIT')
+    except Exception:
+        db.execute('ROLLBACK')
+        raise
+
+    return [(message_id, json.loads(recipients), message, attempts + 1)
+            for message_id, recipients, message, attempts in rows]
+
+
+def backoff(attempts):
+    """Seconds to wait before retrying after a number of failed attempts."""
+    base = float(aux.get_config('mail_retry_base', 60))
+    return min(base * 2 ** (attempts - 1), 6 * 3600)
+
+
+def mark_sent(db, message_id):
+    db.execute("""UPDATE outbox SET state = 'sent', error = NULL, updated = ?
+                  WHERE id = ?""", (time.time(), message_id))
+
+
+def mark_failed(db, message_id, attempts, error):
+    """Schedule a retry, or give up after mail_max_attempts."""
+    now = time.time()
+    max_attempts = int(aux.get_config('mail_max_attempts', 8))
+
+    if attempts >= max_attempts:
+        logger.error(f'Giving up on outbox message {message_id}: {error}')
+        db.execute("""UPDATE outbox SET state = 'failed', error = ?,
+                                        updated = ?
+                      WHERE id = ?""", (error, now, message_id))
+    else:
+        db.execute("""UPDATE outbox SET state = 'queued', error = ?,
+                                        next_attempt = ?, updated = ?
+                      WHERE id = ?""",
+                   (error, now + backoff(attempts), now, message_id))
+
+
+def recover(db):
+    """Requeue messages left sending by dead processes on this host."""
+    rows = db.execute("""SELECT id, worker
+                         FROM outbox
+                         WHERE state = 'sending'""").fetchall()
+
+    host = jobs.worker_id().rpartition(':')[0]
+    for message_id, worker in rows:
+        worker_host, _, pid = (worker or '').rpartition(':')
+        if worker_host != host:
+            continue
+        try:
+            os.kill(int(pid), 0)
+            continue
+        except (OSError, ValueError):
+            pass
+
+        db.execute("""UPDATE outbox SET state = 'queued', worker = NULL
+                      WHERE id = ? AND state = 'sending'""", (message_id,))
+
+
+def send_batch(db, transport, batch_size=None):
+    """Deliver one batch of due messages; return how many were claimed."""
+    if batch_size is None:
+        batch_size = int(aux.get_config('mail_batch_size', 20))
+
+    batch = claim(db, batch_size)
+    if not batch:
+        return 0
+
+    try:
+        with transport.session() as send:
+            for n, (message_id, recipients, message, attempts) in \
+                    enumerate(batch):
+                try:
+                    send(recipients, message)
+                except Exception as e:
+                    metrics.MAIL_SENT.inc(result='retry')
+                    mark_failed(db, message_id, attempts, str(e))
+                else:
+                    metrics.MAIL_SENT.inc(result='sent')
+                    mark_sent(db, message_id)
+                    logger.info(f'Sent outbox message {message_id}')
+    except Exception as e:
+        # The session itself failed; retry whatever was not attempted
+        for message_id, recipients, message, attempts in batch:
+            row = db.execute('SELECT state FROM outbox WHERE id = ?',
+                             (message_id,)).fetchone()
+            if row and row[0] == 'sending':
+                metrics.MAIL_SENT.inc(result='retry')
+                mark_failed(db, message_id, attempts, str(e))
+
+    return len(batch)
+
+
+def pending():
+    """Return outbox message counts by state."""
+    db = connect()
+    try:
+        return dict(db.execute("""SELECT state, COUNT(*)
+                                  FROM outbox
+                                  GROUP BY state""").fetchall())
+    finally:
+        db.close()
+
+
+def work():
+    """Sender thread main loop."""
+    poll = float(aux.get_config('mail_poll_interval', 5))
+    db = connect()
+
+    while True:
+        try:
+            if send_batch(db, get_transport()):
+                continue
+        except Exception as e:
+            logger.error(e)
+            logger.error(traceback.format_exc())
+
+        with _wakeup:
+            _wakeup.wait(poll)
+
+
+_wakeup = threading.Condition()
+_started_pid = None
+_start_lock = threading.Lock()
+
+
+def ensure_sender():
+    """Start this process's sender thread if it is not running yet."""
+    global _started_pid
+
+    if _started_pid == os.getpid():
+        return
+
+    with _start_lock:
+        if _started_pid == os.getpid():
+            return
+
+        db = connect()
+        try:
+            recover(db)
+        finally:
+            db.close()
+
+        thread = threading.Thread(target=work, name='mail-sender',
+                                  daemon=True)
+        thread.start()
+
+        _started_pid = os.getpid()
+        logger.info('Started mail sender')
@@ -0,0 +1,314 @@
+"""Maintenance commands for the PBDB data archive store.
+
+Usage:
+
+    python manage.py reencode --codec zstd [--from bz2] [archive_no ...]
+    python manage.py dedup-report
+    python manage.py bulk-create --session-id ID [--wait] archives.csv
+    python manage.py scrub [--deep] [--rate MB/s] [--flag] [--backfill]
+    python manage.py tiers [--evict] [--limit BYTES] [--promote archive_no ...]
+    python manage.py flush-sessions
+
+Run from the application directory so settings.cnf is found.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aux
+import blobs
+import bulk
+import compression
+import integrity
+import jobs
+import pipeline
+import sessions
+import tiers
+
+
+def drain(reader):
+    """Read a stream to the end and return the number of bytes."""
+    total = 0
+    while True:
+        chunk = reader.read(pipeline.CHUNK_SIZE)
+        if not chunk:
+            return total
+        total += len(chunk)
+
+
+def timed_decompress(path, archive_codec):
+    """Return the seconds needed to decompress an archive file."""
+    start = time.perf_counter()
+    with open(path, 'rb') as f, archive_codec.open_reader(f) as reader:
+        drain(reader)
+    return time.perf_counter() - start
+
+
+def reencode_archive(archive_no, target):
+    """Rewrite one archive with another codec and report the difference."""
+    realpath = '/'.join([aux.get_config('storage'), str(archive_no)])
+    realpath = realpath.replace('//', '/')
+
+    old = compression.get(aux.archive_format(archive_no)[1])
+    new = compression.get(target)
+    if old.name == new.name:
+        return {'archive_no': archive_no, 'skipped': 'already ' + new.name}
+
+    srcpath = realpath + old.extension
+    destpath = realpath + new.extension
+
+    # Archives evicted to the cold tier are rewritten from a local copy
+    if not os.path.exists(srcpath):
+        tiers.promote(archive_no)
+
+    old_decompress = timed_decompress(srcpath, old)
+
+    start = time.perf_counter()
+    file_sha256 = hashlib.sha256()
+    with open(srcpath, 'rb') as f, old.open_reader(f) as reader:
+        raw_size, _ = pipeline.compress_stream(reader, destpath,
+                                               codec=new.name,
+                                               sha256=file_sha256)
+    compress_seconds = time.perf_counter() - start
+
+    new_decompress = timed_decompress(destpath, new)
+
+    file_sha256 = file_sha256.hexdigest()
+    digest = aux.get_content_hash(archive_no)
+    if digest and blobs.store(destpath, digest, new.name):
+        file_sha256 = integrity.file_digest(destpath)[0]
+    aux.set_checksums(archive_no, content_size=raw_size)
+
+    # Switch readers over before the old file disappears
+    aux.set_codec(archive_no, new.name, file_sha256,
+                  os.path.getsize(destpath))
+    old_size = os.path.getsize(srcpath)
+    blobs.release(srcpath, digest, old.name)
+    tiers.discard(archive_no, old.name)
+
+    new_size = os.path.getsize(destpath)
+    return {'archive_no': archive_no,
+            'from': old.name,
+            'to': new.name,
+            'raw_bytes': raw_size,
+            'old_bytes': old_size,
+            'new_bytes': new_size,
+            'size_change': round(new_size / old_size - 1, 4),
+            'compress_seconds': round(compress_seconds, 3),
+            'old_decompress_seconds': round(old_decompress, 3),
+            'new_decompress_seconds': round(new_decompress, 3)}
+
+
+def reencode(opts):
+    """Re-encode archives and print a JSON report."""
+    if opts.codec not in compression.CODECS:
+        sys.exit(f'Unsupported codec: {opts.codec}')
+
+    archive_nos = opts.archive_no or aux.archives_by_codec(opts.source)
+
+    def run(archive_no):
+        try:
+            return reencode_archive(archive_no, opts.codec)
+        except Exception as e:
+            return {'archive_no': archive_no, 'error': str(e)}
+
+    with ThreadPoolExecutor(max_workers=opts.workers) as executor:
+        results = list(executor.map(run, archive_nos))
+
+    done = [r for r in results if 'new_bytes' in r]
+    summary = {'archives': len(results),
+               'reencoded': len(done),
+               'errors': sum(1 for r in results if 'error' in r),
+               'old_bytes': sum(r['old_bytes'] for r in done),
+               'new_bytes': sum(r['new_bytes'] for r in done),
+               'old_decompress_seconds': round(
+                   sum(r['old_decompress_seconds'] for r in done), 3),
+               'new_decompress_seconds': round(
+                   sum(r['new_decompress_seconds'] for r in done), 3)}
+
+    print(json.dumps({'summary': summary, 'archives': results}, indent=2))
+
+
+def dedup_report(opts):
+    """Print how much storage the blob store saves."""
+    print(json.dumps(blobs.report(), indent=2))
+
+
+def bulk_create(opts):
+    """Queue archives from a CSV or JSON file and report per-item results."""
+    content_type = 'text/csv' if opts.file.endswith('.csv') else 'json'
+    with open(opts.file, 'rb') as f:
+        specs = bulk.parse(f.read(), content_type)
+
+    try:
+        principal = sessions.get(opts.session_id)
+    except KeyError:
+        sys.exit('Unknown session ID')
+
+    try:
+        batch, results = bulk.create(principal, opts.session_id, specs,
+                                     opts.concurrency)
+    except bulk.BulkError as e:
+        sys.exit(str(e))
+    report = {'batch': batch, 'archives': results}
+
+    if batch and opts.wait:
+        # Work the queue from this process too, so no server is needed
+        jobs.ensure_workers()
+        while True:
+            progress = bulk.progress(batch)
+            states = progress['states']
+            if not states.get('queued') and not states.get('running'):
+                break
+            time.sleep(opts.poll)
+        report['progress'] = progress
+
+    print(json.dumps(report, indent=2))
+
+
+def scrub(opts):
+    """Verify every archive file and print a JSON report."""
+    rows = aux.integrity_index()
+    rate = opts.rate * 1024 * 1024 if opts.rate else None
+
+    report = integrity.scrub(rows, aux.get_config('storage'),
+                             workers=opts.workers, rate=rate, deep=opts.deep,
+                             bases=aux.delta_bases(),
+                             cold=tiers.backend().inventory()
+                             if tiers.enabled() else None)
+    results = report.pop('results')
+
+    if opts.flag or opts.backfill:
+        recorded = {row[0]: integrity.Checksums(*row[3:]) for row in rows}
+        states = dict()
+        backfill = list()
+
+        for result in results:
+            if opts.flag:
+                states[result['archive_no']] = result['state']
+            if opts.backfill and result['state'] == 'ok' and \
+                    'file_sha256' in result:
+                values = integrity.Checksums(result.get('content_sha256'),
+                                             result.get('content_size'),
+                                             result['file_sha256'],
+                                             result['file_size'])
+                if values != recorded[result['archive_no']]:
+                    backfill.append((result['archive_no'], values))
+
+        aux.record_scrub(states, backfill)
+        report['flagged'] = len(states)
+        report['backfilled'] = len(backfill)
+
+    if opts.all:
+        report['results'] = results
+
+    print(json.dumps(report, indent=2))
+    if report['mismatch'] or report['corrupt'] or report['missing']:
+        sys.exit(1)
+
+
+def tier_report(opts):
+    """Evict or promote archives and print the use of both tiers."""
+    if not tiers.enabled():
+        sys.exit('No cold_storage configured')
+
+    report = dict()
+    for archive_no in opts.promote:
+        entry = tiers.promote(archive_no)
+        report.setdefault('promoted', []).append(
+            archive_no if entry is not None and not entry.cold else None)
+    if opts.evict:
+        report['evicted_to_bytes'] = tiers.evict(opts.limit)
+
+    report.update(tiers.report())
+    print(json.dumps(report, indent=2))
+
+
+def flush_sessions(opts):
+    """Forget cached session principals in every server process."""
+    sessions.invalidate()
+    print('Session cache flushed')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nice', type=int, default=10,
+                        help='lower the process priority by this much')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    cmd = commands.add_parser('reencode',
+                              help='rewrite archives with another codec')
+    cmd.add_argument('--codec', required=True,
+                     help=f'target codec ({", ".join(compression.CODECS)})')
+    cmd.add_argument('--from', dest='source',
+                     help='only archives currently using this codec')
+    cmd.add_argument('--workers', type=int, default=1)
+    cmd.add_argument('archive_no', type=int, nargs='*')
+    cmd.set_defaults(func=reencode)
+
+    cmd = commands.add_parser('dedup-report',
+                              help='report storage saved by deduplication')
+    cmd.set_defaults(func=dedup_report)
+
+    cmd = commands.add_parser('bulk-create',
+                              help='queue many archives from a CSV or '
+                                   'JSON file')
+    cmd.add_argument('--session-id', required=True,
+                     help='session whose authorizer and enterer own the '
+                          'archives')
+    cmd.add_argument('--concurrency', type=int,
+                     help='archives of this batch to build at once')
+    cmd.add_argument('--wait', action='store_true',
+                     help='build the archives here and wait for them')
+    cmd.add_argument('--poll', type=float, default=2.0)
+    cmd.add_argument('file')
+    cmd.set_defaults(func=bulk_create)
+
+    cmd = commands.add_parser('scrub',
+                              help='verify archive files against their '
+                                   'checksums')
+    cmd.add_argument('--workers', type=int,
+                     help='processes to check with (default: all cores)')
+    cmd.add_argument('--rate', type=float,
+                     help='total read limit in MB per second')
+    cmd.add_argument('--deep', action='store_true',
+                     help='also decompress and check the content SHA-256')
+    cmd.add_argument('--flag', action='store_true',
+                     help='record each outcome in the integrity column')
+    cmd.add_argument('--backfill', action='store_true',
+                     help='record checksums for archives that have none')
+    cmd.add_argument('--all', action='store_true',
+                     help='include every archive in the report')
+    cmd.set_defaults(func=scrub)
+
+    cmd = commands.add_parser('tiers',
+                              help='report on, evict from or promote to '
+                                   'the hot storage tier')
+    cmd.add_argument('--evict', action='store_true',
+                     help='evict archives until the hot tier fits')
+    cmd.add_argument('--limit', type=int,
+                     help='hot tier size to evict to, in bytes '
+                          '(default: hot_tier_bytes)')
+    cmd.add_argument('--promote', type=int, nargs='*', default=[],
+                     metavar='ARCHIVE_NO',
+                     help='copy archives back into the hot tier')
+    cmd.set_defaults(func=tier_report)
+
+    cmd = commands.add_parser('flush-sessions',
+                              help='forget cached session principals, e.g. '
+                                   'after a role or ORCID change')
+    cmd.set_defaults(func=flush_sessions)
+
+    opts = parser.parse_args(argv)
+    if opts.nice:
+        os.nice(opts.nice)
+    opts.func(opts)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,365 @@
+"""Prometheus-style metrics for the archive API.
+
+Counters, gauges and histograms live in each process. Every process writes
+a snapshot of its values to <metrics_dir>/<pid>.json at most once a second,
+and /metrics merges the snapshots of all live processes on this host, so a
+scrape through uwsgi's load balancing sees the whole service rather than
+whichever worker answered. Counters and histograms are summed across
+processes; gauges, which may be settings or per-process levels, are
+exported for each process with a pid label.
+"""
+
+import bisect
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0, 300.0, 900.0)
+
+_registry = []
+_collectors = []
+_lock = threading.Lock()
+
+
+class Metric:
+    """Base class holding labelled values for one metric family."""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = dict()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        with _lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with _lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with _lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with _lock:
+            return [[list(key), [list(v[0]), v[1], v[2]]]
+                    for key, v in self._values.items()]
+
+    def time(self, **labels):
+        """Context manager observing the duration of a block."""
+        return _Timer(self, labels)
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start,
+                               **self.labels)
+
+
+def collector(func):
+    """Register a function returning extra metric families at scrape time.
+
+    The function returns a list of (name, documentation, {labels: value})
+    tuples, where labels is a tuple of (labelname, value) pairs. Families
+    are gauges unless a fourth element gives the kind 'counter'.
+    """
+    _collectors.append(func)
+    return func
+
+
+# Request handling
+REQUEST_SECONDS = Histogram('archiver_http_request_duration_seconds',
+                            'Time to build a response, by route',
+                            ['route', 'method', 'status'])
+IN_FLIGHT = Gauge('archiver_http_requests_in_flight',
+                  'Requests currently being handled', ['route'])
+
+# Archive creation
+STAGE_SECONDS = Histogram('archiver_create_stage_duration_seconds',
+                          'Time spent in each archive creation stage',
+                          ['stage'])
+JOBS = Counter('archiver_jobs_total', 'Archive jobs finished, by result',
+               ['result'])
+BYTES_DOWNLOADED = Counter('archiver_bytes_downloaded_total',
+                           'Uncompressed bytes read from the data service')
+BYTES_WRITTEN = Counter('archiver_bytes_written_total',
+                        'Compressed archive bytes written to storage')
+COMPRESSION_RATIO = Histogram('archiver_compression_ratio',
+                              'Uncompressed over compressed archive size',
+                              buckets=(1, 2, 3, 4, 5, 7.5, 10, 15, 20, 50))
+
+# Data service fetches
+FETCH_TRIES = Counter('archiver_fetch_tries_total',
+                      'Data service requests, by outcome', ['outcome'])
+FETCH_RESUMES = Counter('archiver_fetch_resumes_total',
+                        'Interrupted fetch bodies, by whether a Range '
+                        'request resumed them', ['result'])
+FETCH_IN_FLIGHT = Gauge('archiver_fetches_in_flight',
+                        'Fetches holding a concurrency slot')
+FETCH_SLOT_SECONDS = Histogram('archiver_fetch_slot_wait_seconds',
+                               'Time waiting for a fetch slot, by scope',
+                               ['scope'])
+FETCH_SLOT_TIMEOUTS = Counter('archiver_fetch_slot_timeouts_total',
+                              'Fetches that found no free slot in time, '
+                              'by scope', ['scope'])
+BREAKER_OPEN = Gauge('archiver_fetch_breaker_open',
+                     'Processes whose data service circuit is open')
+BREAKER_REJECTIONS = Counter('archiver_fetch_breaker_rejections_total',
+                             'Fetches failed fast by an open circuit')
+
+# Storage tiers
+TIER_READS = Counter('archiver_tier_reads_total',
+                     'Archive downloads, by the tier they were served from',
+                     ['tier'])
+TIER_MOVES = Counter('archiver_tier_moves_total',
+                     'Archives promoted to or evicted from the hot tier',
+                     ['direction'])
+TIER_BYTES = Counter('archiver_tier_bytes_total',
+                     'Bytes copied between storage tiers', ['direction'])
+
+# Outgoing mail
+MAIL_SENT = Counter('archiver_mail_total',
+                    'Outbox delivery attempts, by result', ['result'])
+
+# Database
+DB_SECONDS = Histogram('archiver_db_query_duration_seconds',
+                       'Database helper call duration, by function',
+                       ['function'])
+
+
+def db_timer(func):
+    """Time calls to a database helper, including generator helpers."""
+    labels = {'function': f'{func.__module__}.{func.__name__}'}
+
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with DB_SECONDS.time(**labels):
+                yield from func(*args, **kwargs)
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with DB_SECONDS.time(**labels):
+                return func(*args, **kwargs)
+
+    return wrapper
+
+
+def snapshot():
+    """Return this process's metric values as a JSON-friendly dict."""
+    families = dict()
+
+    for metric in _registry:
+        families[metric.name] = {'kind': metric.kind,
+                                 'doc': metric.documentation,
+                                 'labels': list(metric.labelnames),
+                                 'buckets': list(getattr(metric, 'buckets',
+                                                         [])),
+                                 'samples': metric.samples()}
+
+    for func in _collectors:
+        try:
+            extra = func()
+        except Exception:
+            continue
+        for name, documentation, values, *kind in extra:
+            labelnames = [k for k, _ in next(iter(values), ())]
+            families[name] = {'kind': kind[0] if kind else 'gauge',
+                              'doc': documentation,
+                              'labels': labelnames,
+                              'buckets': [],
+                              'samples': [[[v for _, v in labels], value]
+                                          for labels, value in values.items()]}
+
+    return families
+
+
+def metrics_dir():
+    import aux
+
+    return aux.get_config('metrics_dir', 'metrics')
+
+
+_last_flush = 0.0
+
+
+def flush(force=False):
+    """Write this process's snapshot, at most once a second."""
+    global _last_flush
+
+    now = time.monotonic()
+    if not force and now - _last_flush < 1.0:
+        return
+    _last_flush = now
+
+    path = metrics_dir()
+    target = os.path.join(path, f'{os.getpid()}.json')
+    tmp = f'{target}.{threading.get_ident()}'
+    try:
+        os.makedirs(path, exist_ok=True)
+        with open(tmp, 'w') as f:
+            json.dump(snapshot(), f)
+        os.replace(tmp, target)
+    except OSError:
+        # Metrics must never fail a request or a job
+        pass
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError:
+        return False
+
+
+def merged():
+    """Merge the snapshots of every live process on this host."""
+    flush(force=True)
+
+    families = dict()
+    path = metrics_dir()
+    try:
+        names = os.listdir(path)
+    except OSError:
+        # No snapshot could be written, e.g. metrics_dir is not writable
+        return families
+
+    for name in names:
+        pid, _, ext = name.partition('.')
+        if ext != 'json' or not pid.isdigit():
+            continue
+        if not _alive(int(pid)):
+            continue
+        try:
+            with open(os.path.join(path, name)) as f:
+                snap = json.load(f)
+        except (OSError, ValueError):
+            continue
+
+        for metric, family in snap.items():
+            gauge = family['kind'] == 'gauge'
+            labelnames = family['labels'] + (['pid'] if gauge else [])
+            target = families.setdefault(metric, dict(family, samples={},
+                                                      labels=labelnames))
+            for labels, value in family['samples']:
+                key = tuple(labels) + ((pid,) if gauge else ())
+                if gauge:
+                    target['samples'][key] = value
+                elif family['kind'] == 'histogram':
+                    current = target['samples'].get(key)
+                    if current is None:
+                        target['samples'][key] = value
+                    else:
+                        current[0] = [a + b for a, b in zip(current[0],
+                                                            value[0])]
+                        current[1] += value[1]
+                        current[2] += value[2]
+                else:
+                    target['samples'][key] = \
+                        target['samples'].get(key, 0) + value
+
+    return families
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    body = ','.join('{0}="{1}"'.format(
+        k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in pairs)
+    return '{' + body + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    """Render the merged metrics in the Prometheus text exposition format."""
+    lines = list()
+
+    for name, family in sorted(merged().items()):
+        lines.append(f'# HELP {name} {family["doc"]}')
+        lines.append(f'# TYPE {name} {family["kind"]}')
+        names = family['labels']
+
+        for key, value in sorted(family['samples'].items()):
+            if family['kind'] != 'histogram':
+                lines.append(f'{name}{_labels(names, key)} {_number(value)}')
+                continue
+
+            counts, total, count = value
+            cumulative = 0
+            for bound, n in zip(family['buckets'], counts):
+                cumulative += n
+                le = _labels(names, key, [('le', _number(float(bound)))])
+                lines.append(f'{name}_bucket{le} {cumulative}')
+            le = _labels(names, key, [('le', '+Inf')])
+            lines.append(f'{name}_bucket{le} {count}')
+            lines.append(f'{name}_sum{_labels(names, key)} {_number(total)}')
+            lines.append(f'{name}_count{_labels(names, key)} {count}')
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,5 @@
+-- Record the compression codec each archive file is stored with.
+-- Existing archives were all written by bzip2.
+
+ALTER TABLE data_archives
+    ADD COLUMN codec VARCHAR(10) NOT NULL DEFAULT 'bz2';
@@ -0,0 +1,6 @@
+-- SHA-256 of each archive's uncompressed data. Archives with the same hash
+-- and codec share one file in the blob store under <storage>/blobs/.
+
+ALTER TABLE data_archives
+    ADD COLUMN content_sha256 CHAR(64) NULL,
+    ADD INDEX content_sha256 (content_sha256);
@@ -0,0 +1,9 @@
+-- Sizes and SHA-256 of each archive's uncompressed data and compressed file,
+-- recorded at creation, and the outcome of the last storage scrub.
+
+ALTER TABLE data_archives
+    ADD COLUMN content_size BIGINT NULL,
+    ADD COLUMN file_size BIGINT NULL,
+    ADD COLUMN file_sha256 CHAR(64) NULL,
+    ADD COLUMN integrity VARCHAR(10) NULL,
+    ADD COLUMN verified DATETIME NULL;
@@ -0,0 +1,8 @@
+-- Archives stored as a delta of an earlier archive of the same query:
+-- the base archive and how many deltas deep the chain to a full file is.
+
+ALTER TABLE data_archives
+    ADD COLUMN base_archive_no INT NULL,
+    ADD COLUMN delta_depth TINYINT NOT NULL DEFAULT 0,
+    ADD INDEX base_archive_no (base_archive_no),
+    ADD INDEX uri_path (uri_path(100));
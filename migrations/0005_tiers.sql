@@ -0,0 +1,6 @@
+-- Archives copied to the cold storage tier. The local copy in the hot tier
+-- may have been evicted since; the cold copy stays until the archive is
+-- deleted or rewritten.
+
+ALTER TABLE data_archives
+    ADD COLUMN cold_copy TINYINT NOT NULL DEFAULT 0;
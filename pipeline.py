@@ -0,0 +1,279 @@
+"""Streaming download and compression of data service responses.
+
+The response body is read in fixed-size chunks and compressed as it
+arrives, so an archive is written in a single pass with bounded memory and
+no uncompressed copy on disk. The response status line and headers are
+written to the .header sidecar in the same layout curl -D produced.
+
+With compress_workers > 1 the stream is cut into fixed-size blocks that are
+compressed in a process pool and written back in order as concatenated
+streams (the pbzip2 layout), which the stock bunzip2, gunzip, xz and zstd
+tools all decompress unchanged.
+"""
+
+import collections
+import hashlib
+import os
+import threading
+import time
+
+import compression
+import metrics
+import upstream
+
+
+CHUNK_SIZE = 1 << 20
+BLOCK_SIZE = 900000 * 4
+
+
+class PipelineError(Exception):
+    """Raised when an archive could not be fetched or written."""
+
+
+def archive_paths(archive_no, codec=None):
+    """Return the header and compressed data paths for an archive."""
+    import aux
+
+    datapath = aux.get_config('storage')
+
+    # Append the data path and remove extra "/" if one was added in config
+    realpath = '/'.join([datapath, str(archive_no)])
+    realpath = realpath.replace('//', '/')
+
+    return realpath + '.header', realpath + compression.get(codec).extension
+
+
+class HashingReader:
+    """Wrap a readable stream, hashing, counting and timing its reads."""
+
+    def __init__(self, source):
+        self.source = source
+        self.sha256 = hashlib.sha256()
+        self.bytes_read = 0
+        self.read_seconds = 0.0
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        chunk = self.source.read(size)
+        self.read_seconds += time.perf_counter() - start
+        self.sha256.update(chunk)
+        self.bytes_read += len(chunk)
+        return chunk
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+
+def write_header(headerpath, response):
+    """Write the status line and headers of a response to disk."""
+    version = {10: 'HTTP/1.0', 11: 'HTTP/1.1'}.get(response.version,
+                                                   'HTTP/1.1')
+    lines = [f'{version} {response.status} {response.reason}']
+    lines += [f'{key}: {value}' for key, value in response.headers.items()]
+
+    with open(headerpath, 'w') as f:
+        f.write('\r\n'.join(lines) + '\r\n\r\n')
+
+
+def compress_stream(source, destpath, chunk_size=CHUNK_SIZE, progress=None,
+                    codec=None, sha256=None):
+    """Compress a readable binary stream into destpath in one pass.
+
+    The output is written to a temporary name and renamed into place only
+    once the stream has been fully consumed. Returns the number of bytes
+    read and written; sha256, if given, is updated with the bytes written.
+    """
+    partpath = destpath + '.part'
+    compressor = compression.get(codec).compressor()
+    bytes_in = bytes_out = 0
+
+    try:
+        with open(partpath, 'wb') as out:
+            while True:
+                chunk = source.read(chunk_size)
+                if not chunk:
+                    break
+                bytes_in += len(chunk)
+                block = compressor.compress(chunk)
+                if block:
+                    out.write(block)
+                    bytes_out += len(block)
+                    if sha256:
+                        sha256.update(block)
+                if progress:
+                    progress(bytes_in)
+
+            block = compressor.flush()
+            out.write(block)
+            bytes_out += len(block)
+            if sha256:
+                sha256.update(block)
+
+        os.replace(partpath, destpath)
+
+    except BaseException:
+        if os.path.exists(partpath):
+            os.remove(partpath)
+        raise
+
+    return bytes_in, bytes_out
+
+
+def read_block(source, size):
+    """Read up to size bytes, looping over short reads until EOF."""
+    parts = []
+    remaining = size
+    while remaining > 0:
+        chunk = source.read(remaining)
+        if not chunk:
+            break
+        parts.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(parts)
+
+
+_executor = None
+_executor_key = None
+_executor_lock = threading.Lock()
+
+
+def get_executor(workers):
+    """Return this process's compression pool, creating it on first use."""
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    global _executor, _executor_key
+
+    key = (os.getpid(), workers)
+    with _executor_lock:
+        if _executor_key != key:
+            # Spawn rather than fork: the caller is a threaded uwsgi worker
+            _executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn'))
+            _executor_key = key
+
+    return _executor
+
+
+def parallel_compress_stream(source, destpath, workers,
+                             block_size=BLOCK_SIZE, progress=None, codec=None,
+                             sha256=None):
+    """Compress a stream as independent blocks across processes.
+
+    At most 2 * workers blocks are in flight at once, so memory stays
+    bounded regardless of the stream size. Returns the number of bytes
+    read and written; sha256, if given, is updated with the bytes written.
+    """
+    compress_block = compression.get(codec).compress_block
+    executor = get_executor(workers)
+    partpath = destpath + '.part'
+    pending = collections.deque()
+    bytes_in = bytes_out = 0
+
+    try:
+        with open(partpath, 'wb') as out:
+            while True:
+                block = read_block(source, block_size)
+                if block:
+                    bytes_in += len(block)
+                    pending.append(executor.submit(compress_block, block))
+                    if progress:
+                        progress(bytes_in)
+
+                while pending and (not block or len(pending) >= 2 * workers):
+                    compressed = pending.popleft().result()
+                    out.write(compressed)
+                    bytes_out += len(compressed)
+                    if sha256:
+                        sha256.update(compressed)
+
+                if not block:
+                    break
+
+        os.replace(partpath, destpath)
+
+    except BaseException:
+        for future in pending:
+            future.cancel()
+        if os.path.exists(partpath):
+            os.remove(partpath)
+        raise
+
+    return bytes_in, bytes_out
+
+
+def compress(source, destpath, progress=None, codec=None, sha256=None):
+    """Compress a stream with the engine selected in settings."""
+    import aux
+
+    workers = int(aux.get_config('compress_workers', 1))
+    if workers > 1:
+        block_size = int(aux.get_config('compress_block_size', BLOCK_SIZE))
+        return parallel_compress_stream(source, destpath, workers,
+                                        block_size=block_size,
+                                        progress=progress, codec=codec,
+                                        sha256=sha256)
+
+    return compress_stream(source, destpath, progress=progress, codec=codec,
+                           sha256=sha256)
+
+
+def fetch_archive(archive_no, uri, session_id, progress=None, codec=None,
+                  user=None):
+    """Stream a data service response into the archive files on disk.
+
+    The fetch goes through upstream.Fetch, within the concurrency slots of
+    the user (the authorizer whose data is fetched) and of the host. A
+    body that is cut off and cannot be resumed is fetched again from the
+    start while tries remain.
+
+    Returns the bytes read and written and the SHA-256 of the uncompressed
+    response body and of the compressed file.
+    """
+    headerpath, archivepath = archive_paths(archive_no, codec)
+    headers = {'Cookie': '='.join(['session_id', session_id])}
+
+    try:
+        with upstream.Fetch(uri, headers, user) as fetch:
+            while True:
+                try:
+                    with fetch.open() as response:
+                        write_header(headerpath, response)
+                        if response.status != 200:
+                            raise PipelineError('Server error - Data service')
+
+                        source = HashingReader(response)
+                        file_sha256 = hashlib.sha256()
+                        start = time.perf_counter()
+                        try:
+                            bytes_in, bytes_out = compress(
+                                source, archivepath, progress=progress,
+                                codec=codec, sha256=file_sha256)
+                        except OSError as e:
+                            raise PipelineError(
+                                'Server error - File retrieval') from e
+                        elapsed = time.perf_counter() - start
+                    break
+
+                except upstream.Interrupted:
+                    if not fetch.backoff():
+                        raise
+
+    except upstream.CircuitOpen as e:
+        raise PipelineError('Server error - Data service unavailable') from e
+    except upstream.SlotTimeout as e:
+        raise PipelineError('Server error - Data service busy') from e
+    except upstream.UpstreamError as e:
+        raise PipelineError('Server error - File retrieval') from e
+
+    # Time blocked reading the data service is download, the rest compression
+    metrics.STAGE_SECONDS.observe(source.read_seconds, stage='download')
+    metrics.STAGE_SECONDS.observe(max(elapsed - source.read_seconds, 0.0),
+                                  stage='compress')
+    metrics.BYTES_DOWNLOADED.inc(bytes_in)
+    metrics.BYTES_WRITTEN.inc(bytes_out)
+    if bytes_out:
+        metrics.COMPRESSION_RATIO.observe(bytes_in / bytes_out)
+
+    return bytes_in, bytes_out, source.hexdigest(), file_sha256.hexdigest()
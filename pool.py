@@ -0,0 +1,219 @@
+"""Process-wide MySQL connection pool used by the aux.py database helpers."""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection could be borrowed within the timeout."""
+
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of DB-API connections.
+
+    Connections are created lazily up to ``size``, borrowed in LIFO order so
+    that idle surplus connections age out, and pinged on borrow when they
+    have been idle longer than ``ping_after`` seconds. The pool remembers the
+    pid that created it; after a fork (uwsgi preforks from the master) the
+    inherited connections are dropped without being closed so the child
+    never shares a socket with its parent.
+    """
+
+    def __init__(self, connect, size=4, timeout=10.0, ping_after=5.0,
+                 recycle=3600.0):
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self.recycle = recycle
+
+        self._cond = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        """Forget all connections and counters (new pool or new process)."""
+        self._pid = os.getpid()
+        self._idle = []
+        self._born = dict()
+        self._in_use = 0
+        self._counters = {'created': 0,
+                          'closed': 0,
+                          'borrowed': 0,
+                          'waits': 0,
+                          'timeouts': 0,
+                          'health_failures': 0,
+                          'wait_seconds_total': 0.0,
+                          'wait_seconds_max': 0.0}
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _close(self, conn):
+        self._born.pop(id(conn), None)
+        self._counters['closed'] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _healthy(self, conn, idle_since):
+        """Return False if the connection is too old or fails a ping."""
+        now = time.monotonic()
+        if now - self._born.get(id(conn), now) > self.recycle:
+            return False
+        if now - idle_since < self.ping_after:
+            return True
+        try:
+            conn.ping()
+            return True
+        except Exception:
+            return False
+
+    def acquire(self):
+        """Borrow a connection, waiting up to the pool timeout."""
+        start = time.monotonic()
+        deadline = start + self.timeout
+        waited = False
+
+        with self._cond:
+            self._check_pid()
+            while True:
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                    break
+                if self._in_use < self.size:
+                    conn, idle_since = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._counters['timeouts'] += 1
+                    raise PoolTimeout('No database connection available '
+                                      f'after {self.timeout:.1f}s')
+                waited = True
+                self._cond.wait(remaining)
+
+            self._in_use += 1
+            self._counters['borrowed'] += 1
+            if waited:
+                elapsed = time.monotonic() - start
+                self._counters['waits'] += 1
+                self._counters['wait_seconds_total'] += elapsed
+                self._counters['wait_seconds_max'] = max(
+                    self._counters['wait_seconds_max'], elapsed)
+
+        try:
+            if conn is not None and not self._healthy(conn, idle_since):
+                with self._cond:
+                    self._counters['health_failures'] += 1
+                    self._close(conn)
+                conn = None
+
+            if conn is None:
+                conn = self._connect()
+                with self._cond:
+                    self._born[id(conn)] = time.monotonic()
+                    self._counters['created'] += 1
+
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        return conn
+
+    def release(self, conn, discard=False):
+        """Return a borrowed connection, ending any open transaction."""
+        if not discard:
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            self._in_use -= 1
+            if discard:
+                self._close(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of a with-block."""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            # Also reached when a streaming generator is closed early
+            self.release(conn)
+
+    def stats(self):
+        """Return a snapshot of pool usage counters."""
+        with self._cond:
+            self._check_pid()
+            snapshot = dict(self._counters)
+            snapshot.update(size=self.size,
+                            in_use=self._in_use,
+                            idle=len(self._idle),
+                            pid=self._pid)
+        return snapshot
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _mysql_connect():
+    """Open a new MySQL connection from the [client] section of settings."""
+    import MySQLdb
+
+    return MySQLdb.connect(read_default_file='./settings.cnf')
+
+
+def _build(connect=None, **kwargs):
+    import aux
+
+    options = {'size': int(aux.get_config('db_pool_size', 4)),
+               'timeout': float(aux.get_config('db_pool_timeout', 10)),
+               'ping_after': float(aux.get_config('db_pool_ping_after', 5))}
+    options.update(kwargs)
+
+    return ConnectionPool(connect or _mysql_connect, **options)
+
+
+def configure(connect=None, **kwargs):
+    """Replace the process-wide pool, e.g. to point it at a stand-in DB."""
+    global _pool
+
+    with _pool_lock:
+        _pool = _build(connect, **kwargs)
+
+    return _pool
+
+
+def get_pool():
+    """Return the process-wide pool, creating it on first use."""
+    global _pool
+
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = _build()
+
+    return _pool
+
+
+def connection():
+    """Borrow a connection from the process-wide pool."""
+    return get_pool().connection()
+
+
+def stats():
+    """Return usage counters for the process-wide pool."""
+    return get_pool().stats()
@@ -0,0 +1,99 @@
+"""Cache of session principals for authorization checks.
+
+A principal gathers everything the API needs to know about a browser
+session (authorizer and enterer numbers, admin flag, ORCID presence and
+email) from one joined query, and is kept in a small TTL/LRU cache keyed by
+session_id so repeated calls from the same session skip the database.
+Cached principals live at most session_cache_ttl seconds; invalidate()
+forgets them in every process at once through the session_stamp file, for
+when a session ends or a user's role or ORCID changes.
+"""
+
+from collections import namedtuple
+
+import cache
+import metrics
+import pool
+
+
+Principal = namedtuple('Principal', ['authorizer_no', 'enterer_no', 'admin',
+                                     'has_orcid', 'email'])
+
+principals = cache.TTLCache(maxsize=1024, ttl=60)
+
+
+def stamp_path():
+    import aux
+
+    return aux.get_config('session_stamp', 'session.stamp')
+
+
+_stamp = cache.Stamp(lambda: stamp_path())
+_stamp.register(principals)
+
+
+def configure():
+    """Apply session cache size and TTL from settings."""
+    import aux
+
+    principals.maxsize = int(aux.get_config('session_cache_size', 1024))
+    principals.ttl = float(aux.get_config('session_cache_ttl', 60))
+
+
+@metrics.db_timer
+def load(session_id):
+    """Read the principal for a session from the database."""
+    with pool.connection() as db:
+        cursor = db.cursor()
+
+        sql = """SELECT s.authorizer_no, s.enterer_no, a.admin,
+                        e.orcid, e.email
+                 FROM session_data AS s
+                 LEFT JOIN pbdb_wing.users AS a ON a.id = s.user_id
+                 LEFT JOIN pbdb_wing.users AS e ON e.person_no = s.enterer_no
+                 WHERE s.session_id = %s
+                 LIMIT 1
+              """
+
+        cursor.execute(sql, (session_id,))
+
+        row = cursor.fetchone()
+
+    if row is None:
+        return None
+
+    authorizer_no, enterer_no, admin, orcid, email = row
+    return Principal(authorizer_no=authorizer_no,
+                     enterer_no=enterer_no,
+                     admin=bool(admin),
+                     has_orcid=bool(orcid),
+                     email=email)
+
+
+def get(session_id):
+    """Return the principal for a session, raising KeyError if unknown."""
+    if not session_id:
+        raise KeyError('No session_id')
+
+    _stamp.check()
+    principal = principals.get(session_id)
+    if principal is None:
+        stamp = _stamp.current
+        principal = load(session_id)
+        if principal is None:
+            raise KeyError(f'Unknown session_id {session_id}')
+        # Do not keep a principal read across a concurrent invalidation
+        if _stamp.read() == stamp:
+            principals.set(session_id, principal)
+
+    return principal
+
+
+def invalidate():
+    """Forget cached principals in this and every other process."""
+    _stamp.invalidate()
+
+
+def stats():
+    """Return size and hit/miss counters for the session cache."""
+    return principals.stats()
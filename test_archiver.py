@@ -15,6 +15,8 @@ SESSION =  # Browser session ID
 REC = 1
 SERVER = 'https://paleobiodb.org'
 INFILE = 'archive_drivers.csv'
+POLL_INTERVAL = 5
+POLL_LIMIT = 120
 
 @pytest.fixture()
 def load_metadata():
@@ -76,10 +78,9 @@ def test_create_archives(load_metadata):
         try:
             # Create archive
             rc = requests.post(f'{SERVER}/archives/create', json=archive)
-            assert rc.status_code == 200
+            assert rc.status_code == 202
             resp_c = rc.json()
-            assert rc.status_code == 200
-            assert resp_c.get('message') == 'success'
+            assert resp_c.get('message') == 'accepted'
             assert 'pbdb_id' in resp_c
             pbdb_id = resp_c.get('pbdb_id')
             print(f'Created Archive ID {pbdb_id}')
@@ -87,6 +88,15 @@ def test_create_archives(load_metadata):
             assert pbdb_id is not None
             assert pbdb_id > 0
 
+            # Wait for the background job to finish
+            for _ in range(POLL_LIMIT):
+                rs = requests.get(f'{SERVER}/archives/status/{pbdb_id}')
+                assert rs.status_code == 200
+                if rs.json().get('status') in ('complete', 'fail'):
+                    break
+                time.sleep(POLL_INTERVAL)
+            assert rs.json().get('status') == 'complete'
+
             # View archive
             rv = requests.get(f'{SERVER}/archives/view/{pbdb_id}')
             assert rv.status_code == 200
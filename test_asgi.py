@@ -0,0 +1,199 @@
+"""Test the ASGI serving mode: the WSGI bridge and native status polls."""
+
+import asyncio
+import bz2
+import json
+import time
+
+import pytest
+from flask import Flask, Response, jsonify, request
+
+import asgi
+import jobs
+import metrics
+from conftest import add_archive
+
+
+def http_scope(path, method='GET', query=b'', headers=()):
+    return {'type': 'http', 'method': method, 'path': path,
+            'query_string': query, 'headers': list(headers),
+            'http_version': '1.1', 'scheme': 'http',
+            'server': ('testserver', 80), 'client': ('127.0.0.1', 5000)}
+
+
+def call(app, scope, body=b''):
+    """Drive an ASGI app; returns (status, headers, body chunks)."""
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = list()
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        # Servers only answer again once the client has gone
+        await asyncio.Event().wait()
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+
+    start = sent[0]
+    chunks = [m['body'] for m in sent[1:] if m.get('body')]
+    assert not sent[-1].get('more_body')
+    return start['status'], dict(start['headers']), chunks
+
+
+@pytest.fixture()
+def flask_app():
+    app = Flask(__name__)
+    closed = list()
+
+    @app.route('/echo', methods=['POST'])
+    def echo():
+        return jsonify({'json': request.json, 'arg': request.args.get('a'),
+                        'cookie': request.cookies.get('session_id')})
+
+    @app.route('/stream')
+    def stream():
+        def body():
+            try:
+                for i in range(3):
+                    yield f'chunk{i};'.encode()
+            finally:
+                closed.append(True)
+        return Response(body(), mimetype='text/plain')
+
+    app.closed = closed
+    return app
+
+
+def test_bridge_passes_requests_and_streams_bodies(flask_app):
+    async def wsgi(scope, receive, send):
+        return await asgi.call_wsgi(flask_app, scope, receive, send)
+
+    status, headers, chunks = call(
+        wsgi, http_scope('/echo', 'POST', b'a=1',
+                         [(b'content-type', b'application/json'),
+                          (b'cookie', b'session_id=s1')]),
+        body=b'{"x": 2}')
+    assert status == 200
+    assert json.loads(b''.join(chunks)) == {'json': {'x': 2}, 'arg': '1',
+                                            'cookie': 's1'}
+
+    status, headers, chunks = call(wsgi, http_scope('/stream'))
+    assert headers[b'content-type'].startswith(b'text/plain')
+    assert chunks == [b'chunk0;', b'chunk1;', b'chunk2;']
+    assert flask_app.closed == [True]
+
+
+def test_unstarted_responses_and_disconnects(flask_app):
+    def silent(environ, start_response):
+        return []
+
+    async def wsgi(scope, receive, send):
+        return await asgi.call_wsgi(silent, scope, receive, send)
+
+    status, headers, chunks = call(wsgi, http_scope('/silent'))
+    assert status == 500
+    assert json.loads(b''.join(chunks)) == {'message': 'Error',
+                                            'status': 500}
+
+    # A client that leaves before sending its body gets nothing back
+    sent = list()
+
+    async def receive():
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    assert asyncio.run(asgi.call_wsgi(flask_app, http_scope('/echo', 'POST'),
+                                      receive, send)) is None
+    assert sent == []
+
+
+def test_slow_clients_do_not_hold_threads(flask_app, monkeypatch):
+    monkeypatch.setattr(asgi, '_executor',
+                        asgi.ThreadPoolExecutor(max_workers=2))
+
+    async def many():
+        async def one():
+            sent = list()
+
+            messages = [{'type': 'http.request', 'body': b''}]
+
+            async def receive():
+                if messages:
+                    return messages.pop(0)
+                await asyncio.Event().wait()
+
+            async def send(message):
+                sent.append(message)
+                await asyncio.sleep(0.05)
+
+            await asgi.call_wsgi(flask_app, http_scope('/stream'), receive,
+                                 send)
+            return sent
+
+        return await asyncio.gather(*[one() for _ in range(40)])
+
+    start = time.perf_counter()
+    results = asyncio.run(many())
+    # 40 requests x 5 sends x 50 ms, far beyond two threads run serially
+    assert time.perf_counter() - start < 2
+    assert all(len(sent) == 5 for sent in results)
+
+
+def test_native_status(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, 'metrics_dir', lambda: str(tmp_path))
+    rows = {5: ('downloading',)}
+
+    async def fetch_one(sql, params):
+        return rows.get(params[0])
+
+    monkeypatch.setattr(asgi, 'fetch_one', fetch_one)
+    monkeypatch.setattr(jobs, 'job_info', lambda n: {'state': 'running'})
+
+    status, headers, chunks = call(asgi.app, http_scope('/archives/status/5'))
+    assert status == 200
+    assert headers[b'access-control-allow-origin'] == b'*'
+    assert json.loads(b''.join(chunks)) == {'archive_no': 5,
+                                            'status': 'downloading',
+                                            'job': {'state': 'running'}}
+
+    status, headers, chunks = call(asgi.app, http_scope('/archives/status/6'))
+    assert status == 404
+    assert json.loads(b''.join(chunks)) == {'message': 'Archive not found',
+                                            'status': 404, 'pbdb_id': 6}
+
+
+def test_abandoned_downloads_stop_streaming(client, monkeypatch):
+    monkeypatch.setattr(asgi, '_executor',
+                        asgi.ThreadPoolExecutor(max_workers=2))
+    content = b'occurrence_no,taxon_name\n' * (8 << 20 >> 5)
+    archive_no = add_archive(data=bz2.compress(content))
+    messages = [{'type': 'http.request', 'body': b''}]
+    gone = asyncio.Event()
+    sent = list()
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await gone.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+        # The client leaves after the first chunk of the body
+        if message.get('body'):
+            gone.set()
+            await asyncio.sleep(0.01)
+
+    scope = http_scope(f'/archives/retrieve/{archive_no}', query=b'format=raw')
+    assert asyncio.run(asgi.call_wsgi(asgi.flask_app(), scope, receive,
+                                      send)) == 200
+
+    assert sent[0]['status'] == 200
+    received = sum(len(m.get('body', b'')) for m in sent[1:])
+    assert 0 < received < len(content)
+    assert sent[-1].get('more_body')
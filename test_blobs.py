@@ -0,0 +1,42 @@
+"""Test the content-addressed blob store."""
+
+import os
+
+import pytest
+
+import blobs
+
+
+@pytest.fixture()
+def storage(tmp_path, monkeypatch):
+    monkeypatch.setattr(blobs, 'blob_root', lambda: str(tmp_path / 'blobs'))
+    return tmp_path
+
+
+def test_identical_payloads_share_one_blob(storage):
+    """A second identical archive becomes a link and the last delete
+    removes the blob."""
+
+    digest = 'ab' * 32
+    first, second = storage / '1.bz2', storage / '2.bz2'
+    first.write_bytes(b'x' * 1000)
+    second.write_bytes(b'x' * 1000)
+
+    assert blobs.store(str(first), digest) == 0
+    assert blobs.store(str(second), digest) == 1000
+
+    blob = blobs.blob_path(digest)
+    assert os.stat(blob).st_nlink == 3
+    assert os.path.samefile(first, second)
+
+    report = blobs.report()
+    assert report['blobs'] == 1
+    assert report['references'] == 2
+    assert report['saved_bytes'] == 1000
+
+    blobs.release(str(first), digest)
+    assert os.path.exists(blob)
+    assert second.read_bytes() == b'x' * 1000
+
+    blobs.release(str(second), digest)
+    assert not os.path.exists(blob)
@@ -0,0 +1,119 @@
+"""Test bulk spec parsing and batch scheduling in the job queue."""
+
+import json
+
+import pytest
+
+import aux
+import bulk
+import jobs
+import sessions
+from conftest import SESSION_ID
+
+
+CSV = b"""title,authors,uri
+Legacy one,A. Author,https://paleobiodb.org/data1.2/occs/list.csv?base_name=Canis
+Legacy two,,https://paleobiodb.org/data1.2/colls/list.csv?interval=Jurassic
+"""
+
+
+@pytest.fixture()
+def queue(tmp_path, monkeypatch):
+    settings = {'queue_db': str(tmp_path / 'queue.sqlite')}
+    monkeypatch.setattr(aux, 'get_config',
+                        lambda setting, default=None:
+                            settings.get(setting, default))
+    monkeypatch.setattr(aux, 'archive_status', lambda *a, **k: None)
+    db = jobs.connect()
+    yield db
+    db.close()
+
+
+def test_csv_rows_become_specs():
+    specs = bulk.parse(CSV, 'text/csv')
+    assert len(specs) == 2
+
+    spec = bulk.normalise(specs[1], 42)
+    assert spec['uri_path'] == '/data1.2/colls/list.csv'
+    assert spec['uri_args'] == 'interval=Jurassic'
+    assert spec['authors'] == 'Enter No. 42'
+    assert spec['codec'] == 'bz2'
+
+
+def test_invalid_specs_are_reported():
+    specs = bulk.parse(b'{"archives": [{"title": "t", "uri_path": "x",'
+                       b' "uri_args": "a=1"}, {"uri_path": "/x"}]}')
+
+    with pytest.raises(ValueError, match='preceeded'):
+        bulk.normalise(specs[0], 1)
+    with pytest.raises(ValueError, match='Missing title'):
+        bulk.normalise(specs[1], 1)
+    with pytest.raises(bulk.BulkError):
+        bulk.parse(b'[]')
+
+
+def test_non_string_fields_are_reported(monkeypatch):
+    monkeypatch.setattr(aux, 'create_records',
+                        lambda auth, ent, specs: [100 + i
+                                                  for i in range(len(specs))])
+    monkeypatch.setattr(aux, 'get_config', lambda setting, default=None:
+                        'http://api' if setting == 'dataservice' else default)
+    monkeypatch.setattr(jobs, 'enqueue_batch', lambda *args: None)
+
+    specs = bulk.parse(json.dumps([
+        {'title': 't', 'uri_path': 5, 'uri_args': 'a=1'},
+        {'title': 't', 'uri_path': '/x', 'uri_args': ['a=1']},
+        {'title': 7, 'uri_path': '/x', 'uri_args': 'a=1'},
+        {'title': 't', 'uri_path': '/x', 'uri_args': 'a=1',
+         'codec': ['bz2']},
+        {'title': 't', 'uri_path': '/x', 'uri_args': 'a=1'}]))
+    principal = sessions.Principal(1, 1, False, True, 'a@example.org')
+
+    batch, results = bulk.create(principal, 's1', specs)
+    assert [r.get('error') for r in results] == [
+        'uri_path must be a string', 'uri_args must be a string',
+        'title must be a string', 'codec must be a string', None]
+    assert results[4]['archive_no'] == 100
+
+
+def test_concurrency_is_capped(monkeypatch):
+    settings = {'bulk_max_concurrency': '4'}
+    monkeypatch.setattr(aux, 'get_config',
+                        lambda setting, default=None:
+                            settings.get(setting, default))
+    principal = sessions.Principal(1, 1, False, True, 'a@example.org')
+    specs = bulk.parse(CSV, 'text/csv')
+
+    with pytest.raises(bulk.BulkError, match='at most 4'):
+        bulk.create(principal, 's1', specs, 5)
+    with pytest.raises(bulk.BulkError, match='at least 1'):
+        bulk.create(principal, 's1', specs, 0)
+
+
+def test_batches_are_limited_and_yield_to_single_jobs(queue):
+    jobs.enqueue_batch('b1', [(n, {'n': n}) for n in (1, 2, 3)], 2)
+    jobs.enqueue(10, {'n': 10})
+
+    claimed = [jobs.claim(queue)[0] for _ in range(3)]
+    assert claimed == [10, 1, 2]
+
+    # Two of the batch are running, so the third waits
+    assert jobs.claim(queue) is None
+
+    jobs.finish(queue, 1)
+    assert jobs.claim(queue)[0] == 3
+
+    info = jobs.batch_info('b1')
+    assert info[1]['state'] == 'done'
+    assert info[3]['state'] == 'running'
+
+
+def test_bulk_endpoint_rejects_excess_concurrency(client):
+    r = client.post('/archives/bulk?concurrency=100',
+                    json={'session_id': SESSION_ID,
+                          'archives': [{'title': 't',
+                                        'uri_path': '/data1.2/occs/list.csv',
+                                        'uri_args': 'base_name=Canis'}]})
+    assert r.status_code == 400
+    assert r.json['message'] == 'Parameter error - concurrency must be ' \
+                                'at most 4'
@@ -0,0 +1,60 @@
+"""Test streamed zip and tar bundles of archive files."""
+
+import io
+import json
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+import aux
+import bundle
+import catalog
+
+
+@pytest.fixture()
+def entries(tmp_path, monkeypatch):
+    monkeypatch.setattr(aux, 'get_content_hash', lambda n: f'{n:064x}')
+
+    result = list()
+    for archive_no, size in ((7, 3000), (3, 700000)):
+        path = tmp_path / f'{archive_no}.bz2'
+        path.write_bytes(os.urandom(size))
+        os.utime(path, (1600000000, 1600000000))
+        if archive_no == 3:
+            (tmp_path / '3.header').write_bytes(b'HTTP/1.1 200 OK\r\n\r\n')
+        st = os.stat(path)
+        result.append(catalog.Entry(archive_no, '.csv', 'bz2', 'complete',
+                                    str(path), st.st_size, st.st_mtime, st))
+    return result
+
+
+def test_tar_bundle(entries):
+    members = bundle.open_members(entries)
+    expected = bundle.tar_size(members)
+    data = b''.join(bundle.stream_tar(members))
+    assert len(data) == expected
+
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        names = tar.getnames()
+        assert names == ['MANIFEST.json', 'pbdb_archive_3.csv.bz2',
+                         'pbdb_archive_3.header', 'pbdb_archive_7.csv.bz2']
+        body = tar.extractfile('pbdb_archive_7.csv.bz2').read()
+        assert body == open(entries[0].path, 'rb').read()
+
+        manifest = json.load(tar.extractfile('MANIFEST.json'))
+        assert [a['archive_no'] for a in manifest['archives']] == [3, 7]
+        assert manifest['archives'][1]['header'] is None
+
+
+def test_zip_bundle_is_deterministic(entries):
+    first = b''.join(bundle.stream_zip(bundle.open_members(entries)))
+    second = b''.join(bundle.stream_zip(bundle.open_members(entries)))
+    assert first == second
+
+    with zipfile.ZipFile(io.BytesIO(first)) as zf:
+        assert zf.testzip() is None
+        info = zf.getinfo('pbdb_archive_3.csv.bz2')
+        assert info.compress_type == zipfile.ZIP_STORED
+        assert zf.read(info) == open(entries[1].path, 'rb').read()
@@ -0,0 +1,42 @@
+"""Test the TTL cache and its stamp-file invalidation."""
+
+import time
+
+import cache
+
+
+def test_ttl_and_lru():
+    """Entries expire after the TTL and the oldest is evicted when full."""
+
+    c = cache.TTLCache(maxsize=2, ttl=0.05)
+    c.set('a', 1)
+    c.set('b', 2)
+    assert c.get('a') == 1
+    c.set('c', 3)
+    assert c.get('b') is None
+    assert c.get('a') == 1
+
+    time.sleep(0.06)
+    assert c.get('a') is None
+    assert c.stats()['hits'] == 2
+
+
+def test_invalidation_seen_through_stamp(tmp_path, monkeypatch):
+    """A stamp written by another process clears local entries."""
+
+    stamp = tmp_path / 'cache.stamp'
+    monkeypatch.setattr(cache, 'stamp_path', lambda: str(stamp))
+    c = cache.register(cache.TTLCache())
+
+    cache.check()
+    c.set('list', b'[]')
+    cache.check()
+    assert c.get('list') == b'[]'
+
+    stamp.write_text('from another worker')
+    cache.check()
+    assert c.get('list') is None
+
+    c.set('list', b'[]')
+    cache.invalidate()
+    assert c.get('list') is None
@@ -0,0 +1,82 @@
+"""Test the archive index and the answers retrieve gives from it."""
+
+import bz2
+import hashlib
+
+import aux
+import catalog
+from conftest import add_archive
+
+
+DATA = bz2.compress(b'occurrence_no,accepted_name\n1,Canis\n' * 100)
+
+
+def test_lookup_hit(client):
+    archive_no = add_archive(data=DATA, file_size=len(DATA),
+                             file_sha256=hashlib.sha256(DATA).hexdigest(),
+                             uri_path='/data1.2/occs/list.json')
+
+    entry = catalog.lookup(archive_no)
+    assert entry.archive_no == archive_no
+    assert (entry.file_type, entry.codec, entry.status) == \
+        ('.json', 'bz2', 'complete')
+    assert entry.size == entry.expected_size == len(DATA)
+    assert entry.file_sha256 == hashlib.sha256(DATA).hexdigest()
+    assert not catalog.damaged(entry)
+
+    # Served from the index without reloading it
+    loads = catalog.archives.loads
+    assert catalog.lookup(archive_no) == entry
+    assert catalog.archives.loads == loads
+
+
+def test_unknown_failed_and_incomplete_archives(client):
+    failed = add_archive(status='fail', data=DATA)
+    missing = add_archive()
+    # Written but not yet through delta encoding and completion
+    unfinished = {status: add_archive(status=status, data=DATA)
+                  for status in ('queued', 'downloading', 'compressing')}
+
+    for archive_no in [999999, failed, missing] + list(unfinished.values()):
+        assert catalog.lookup(archive_no) is None
+
+        r = client.get(f'/archives/retrieve/{archive_no}')
+        assert r.status_code == 404
+        assert r.json['message'] == 'Archive not found'
+
+
+def test_damaged_archives_are_not_served(client):
+    truncated = add_archive(data=DATA[:-10], file_size=len(DATA))
+    corrupt = add_archive(data=DATA, file_size=len(DATA), integrity='corrupt')
+    good = add_archive(data=DATA, file_size=len(DATA))
+
+    for archive_no in (truncated, corrupt):
+        r = client.get(f'/archives/retrieve/{archive_no}')
+        assert r.status_code == 500
+        assert r.json['message'] == 'Archive damaged'
+
+    r = client.get(f'/archives/retrieve/{good}')
+    assert r.status_code == 200
+    assert r.data == DATA
+
+
+def test_only_download_changes_reload_the_index(client):
+    building = add_archive(status='queued', data=DATA)
+    done = add_archive(data=DATA)
+    assert catalog.lookup(done) is not None
+    loads = catalog.archives.loads
+
+    # Job progress and metadata edits do not touch what downloads use
+    aux.archive_status(building, stage='downloading')
+    aux.archive_status(building, stage='compressing')
+    aux.update_record(done, 'New title', None, None, None)
+    assert catalog.lookup(done) is not None
+    assert catalog.archives.loads == loads
+
+    aux.archive_status(building, success=True)
+    assert catalog.lookup(building).status == 'complete'
+    assert catalog.archives.loads == loads + 1
+
+    aux.record_scrub({done: 'corrupt'})
+    assert catalog.damaged(catalog.lookup(done))
+    assert catalog.archives.loads == loads + 2
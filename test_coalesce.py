@@ -0,0 +1,32 @@
+"""Test query keys and result hand-off for coalesced fetches."""
+
+import time
+
+import coalesce
+
+
+def test_query_key_normalisation():
+    """Argument order does not matter; visibility and codec do."""
+
+    key = coalesce.query_key('http://api:3000/data1.2/occs/list.csv?'
+                             'base_name=Canis&show=coords', 5, 'bz2')
+
+    assert key == coalesce.query_key('http://api:3000/data1.2/occs/list.csv?'
+                                     'show=coords&base_name=Canis', 5, 'bz2')
+    assert key != coalesce.query_key('http://api:3000/data1.2/occs/list.csv?'
+                                     'show=coords&base_name=Canis', 6, 'bz2')
+    assert key != coalesce.query_key('http://api:3000/data1.2/occs/list.csv?'
+                                     'show=coords&base_name=Canis', 5, 'xz')
+
+
+def test_only_results_finished_since_the_cutoff_are_shared(tmp_path,
+                                                           monkeypatch):
+    monkeypatch.setattr(coalesce, 'flight_root', lambda: str(tmp_path))
+
+    before = time.time()
+    with coalesce.flight('k'):
+        coalesce.record('k', archive_no=1, digest='d', headerpath='h')
+
+    assert coalesce.finished_since('k', before)['archive_no'] == 1
+    assert coalesce.finished_since('k', time.time() + 1) is None
+    assert coalesce.finished_since('other', before) is None
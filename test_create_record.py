@@ -0,0 +1,101 @@
+"""Test archive_no allocation under concurrent creates.
+
+Runs against a local MySQL or MariaDB stand-in. Point ARCHIVER_TEST_DB at
+an option file with a [client] section for a scratch database, e.g.
+
+    ARCHIVER_TEST_DB=./test-db.cnf python -m pytest test_create_record.py
+
+The test creates a data_archives table in that database if it is missing.
+"""
+
+import os
+import threading
+
+import pytest
+
+MySQLdb = pytest.importorskip('MySQLdb')
+
+import aux
+import cache
+import catalog
+import pool
+
+
+OPTION_FILE = os.environ.get('ARCHIVER_TEST_DB')
+N_CREATES = 40
+ENTERER = 999999
+
+pytestmark = pytest.mark.skipif(not OPTION_FILE,
+                                reason='ARCHIVER_TEST_DB not set')
+
+
+@pytest.fixture()
+def database(tmp_path, monkeypatch):
+    """Route the pool to the stand-in database."""
+
+    monkeypatch.setattr(cache, 'stamp_path',
+                        lambda: str(tmp_path / 'cache.stamp'))
+    monkeypatch.setattr(catalog, 'stamp_path',
+                        lambda: str(tmp_path / 'catalog.stamp'))
+    # Put the process-wide pool back for the tests that run afterwards
+    monkeypatch.setattr(pool, '_pool', None)
+    pool.configure(connect=lambda: MySQLdb.connect(
+        read_default_file=OPTION_FILE), size=8)
+
+    with pool.connection() as db:
+        cursor = db.cursor()
+        cursor.execute("""CREATE TABLE IF NOT EXISTS data_archives (
+                              archive_no INT AUTO_INCREMENT PRIMARY KEY,
+                              authorizer_no INT, enterer_no INT,
+                              authors VARCHAR(255), title VARCHAR(255),
+                              description TEXT, doi VARCHAR(100),
+                              uri_path VARCHAR(255), uri_args TEXT,
+                              status VARCHAR(20),
+                              codec VARCHAR(10) NOT NULL DEFAULT 'bz2',
+                              created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                              modified TIMESTAMP NULL)""")
+        cursor.execute('DELETE FROM data_archives WHERE enterer_no = %s',
+                       (ENTERER,))
+        db.commit()
+
+    yield
+
+    with pool.connection() as db:
+        cursor = db.cursor()
+        cursor.execute('DELETE FROM data_archives WHERE enterer_no = %s',
+                       (ENTERER,))
+        db.commit()
+
+
+def test_parallel_creates_get_their_own_archive_no(database):
+    """Each concurrent create for one enterer gets its own row back."""
+
+    results = dict()
+    errors = list()
+    start = threading.Barrier(N_CREATES)
+
+    def create(i):
+        try:
+            start.wait()
+            results[i] = aux.create_record(1, ENTERER, 'Tester', f'title {i}',
+                                           'concurrency test', '/x.csv',
+                                           'n=1')
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=create, args=(i,))
+               for i in range(N_CREATES)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert not errors
+    assert len(set(results.values())) == N_CREATES
+
+    with pool.connection() as db:
+        cursor = db.cursor()
+        for i, archive_no in results.items():
+            cursor.execute("""SELECT title FROM data_archives
+                              WHERE archive_no = %s""", (archive_no,))
+            assert cursor.fetchone()[0] == f'title {i}'
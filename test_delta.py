@@ -0,0 +1,85 @@
+"""Test delta archives: encoding, chained rebuilds and scrubbing."""
+
+import bz2
+import hashlib
+import os
+
+import pytest
+
+import blobs
+import delta
+import integrity
+
+
+def rows(numbers, changed=()):
+    return b''.join(b'%d,Taxon %d,%s\n' % (n, n, b'new' if n in changed
+                                          else b'old') for n in numbers)
+
+
+BASE = b'occurrence_no,accepted_name,note\n' + rows(range(1, 5001))
+
+# Rows dropped, changed and added, and no final newline
+REVISION = (b'occurrence_no,accepted_name,note\n' +
+            rows(range(1, 2000)) + rows(range(2500, 5001), changed={3000}) +
+            rows(range(5001, 5100)) + b'footer')
+
+
+def chunked(data, size=1000):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def test_encode_and_apply_round_trip():
+    index = delta.index_lines(chunked(BASE))
+    ops = b''.join(delta.encode(chunked(REVISION, 777), index, 1, 'ab' * 32))
+    assert len(ops) < len(REVISION) / 10
+
+    reader = delta.lines([ops])
+    assert b''.join(delta.apply(reader, chunked(BASE))) == REVISION
+
+
+def test_apply_rejects_a_base_that_is_too_short():
+    index = delta.index_lines([BASE])
+    ops = b''.join(delta.encode([REVISION], index, 1, 'ab' * 32))
+
+    with pytest.raises(delta.DeltaError):
+        b''.join(delta.apply(delta.lines([ops]), [BASE[:1000]]))
+
+
+@pytest.fixture()
+def storage(tmp_path, monkeypatch):
+    monkeypatch.setattr(blobs, 'blob_root', lambda: str(tmp_path / 'blobs'))
+    return tmp_path
+
+
+def test_chain_rebuild_and_scrub(storage):
+    third = REVISION.replace(b'Taxon 42,', b'Taxon 42 sp.,')
+
+    (storage / '1.bz2').write_bytes(bz2.compress(BASE))
+    base_links = [(str(storage / '1.bz2'), 'bz2')]
+    links = list()
+    for archive_no, data in ((2, REVISION), (3, third)):
+        path = str(storage / f'{archive_no}.delta.bz2')
+        delta.write(path, 'bz2', chunked(data), base_links, archive_no - 1,
+                    hashlib.sha256(b'').hexdigest())
+        links = [(path, 'bz2')] + base_links
+        base_links = links
+
+    assert len(links) == 3
+    assert b''.join(delta.rebuild(links)) == third
+    assert bz2.decompress(b''.join(delta.compressed(links, 'bz2'))) == third
+
+    rows = list()
+    for archive_no, data in ((1, BASE), (2, REVISION), (3, third)):
+        name = f'{archive_no}.bz2' if archive_no == 1 else \
+            f'{archive_no}.delta.bz2'
+        file_data = (storage / name).read_bytes()
+        rows.append((archive_no, 'bz2', 'complete',
+                     hashlib.sha256(data).hexdigest(), len(data),
+                     hashlib.sha256(file_data).hexdigest(), len(file_data)))
+    (storage / '2.bz2').write_bytes(bz2.compress(REVISION))
+
+    report = integrity.scrub(rows, str(storage), workers=1, deep=True,
+                             bases={2: 1, 3: 2})
+    assert report['ok'] == 3
+    assert [(os.path.basename(o['path']), o['reason'])
+            for o in report['orphans']] == [('2.bz2', 'stale file')]
@@ -0,0 +1,120 @@
+"""Test conditional and byte-range archive downloads."""
+
+import os
+import time
+
+import pytest
+from flask import Flask
+
+import download
+
+
+DATA = bytes(range(256)) * 40
+
+
+@pytest.fixture()
+def client(tmp_path):
+    """Serve one archive file from a throwaway Flask app."""
+
+    path = tmp_path / '5.bz2'
+    path.write_bytes(DATA)
+
+    app = Flask(__name__)
+
+    @app.route('/archives/retrieve/5')
+    def retrieve():
+        return download.send_archive(str(path), 5, 'pbdb_archive_5.csv.bz2',
+                                     'application/x-compressed')
+
+    return app.test_client()
+
+
+def test_full_download(client):
+    r = client.get('/archives/retrieve/5')
+    assert r.status_code == 200
+    assert r.data == DATA
+    assert int(r.headers['Content-Length']) == len(DATA)
+    assert r.headers['Accept-Ranges'] == 'bytes'
+    assert 'pbdb_archive_5.csv.bz2' in r.headers['Content-Disposition']
+
+
+def test_conditional_get(client):
+    etag = client.get('/archives/retrieve/5').headers['ETag']
+    r = client.get('/archives/retrieve/5', headers={'If-None-Match': etag})
+    assert r.status_code == 304
+    assert r.data == b''
+
+
+def test_single_and_suffix_range(client):
+    r = client.get('/archives/retrieve/5', headers={'Range': 'bytes=100-'})
+    assert r.status_code == 206
+    assert r.data == DATA[100:]
+    assert r.headers['Content-Range'] == f'bytes 100-{len(DATA) - 1}/{len(DATA)}'
+
+    r = client.get('/archives/retrieve/5', headers={'Range': 'bytes=-10'})
+    assert r.data == DATA[-10:]
+
+
+def test_multiple_ranges(client):
+    r = client.get('/archives/retrieve/5',
+                   headers={'Range': 'bytes=0-9,20-29'})
+    assert r.status_code == 206
+    assert r.mimetype == 'multipart/byteranges'
+    assert int(r.headers['Content-Length']) == len(r.data)
+    assert DATA[0:10] in r.data and DATA[20:30] in r.data
+
+
+def test_unsatisfiable_and_stale_if_range(client):
+    r = client.get('/archives/retrieve/5',
+                   headers={'Range': f'bytes={len(DATA)}-'})
+    assert r.status_code == 416
+
+    r = client.get('/archives/retrieve/5',
+                   headers={'Range': 'bytes=0-9', 'If-Range': '"stale"'})
+    assert r.status_code == 200
+    assert r.data == DATA
+
+
+def test_if_range_dates_must_match(client, tmp_path):
+    hour_ago = time.time() - 3600
+    os.utime(tmp_path / '5.bz2', (hour_ago, hour_ago))
+    r = client.get('/archives/retrieve/5')
+    last_modified = r.headers['Last-Modified']
+    newer = r.last_modified.timestamp() + 60
+
+    r = client.get('/archives/retrieve/5',
+                   headers={'Range': 'bytes=0-9',
+                            'If-Range': last_modified})
+    assert r.status_code == 206
+    assert r.data == DATA[:10]
+
+    r = client.get('/archives/retrieve/5',
+                   headers={'Range': 'bytes=0-9',
+                            'If-Range': time.strftime(
+                                '%a, %d %b %Y %H:%M:%S GMT',
+                                time.gmtime(newer))})
+    assert r.status_code == 200
+    assert r.data == DATA
+
+    # A file changed within the last second has only a weak date
+    os.utime(tmp_path / '5.bz2')
+    last_modified = client.get('/archives/retrieve/5').headers['Last-Modified']
+    r = client.get('/archives/retrieve/5',
+                   headers={'Range': 'bytes=0-9',
+                            'If-Range': last_modified})
+    assert r.status_code == 200
+
+
+def test_offload_headers(tmp_path):
+    """Offloaded responses carry no body, only the proxy header."""
+
+    app = Flask(__name__)
+    path = str(tmp_path / '5.bz2')
+
+    with app.test_request_context('/archives/retrieve/5'):
+        r = download.offload_archive(path, '5.bz2', 'pbdb_archive_5.csv.bz2',
+                                     'application/x-compressed',
+                                     mode='x-sendfile')
+        assert r.headers['X-Sendfile'] == path
+        assert r.get_data() == b''
+        assert 'pbdb_archive_5.csv.bz2' in r.headers['Content-Disposition']
@@ -0,0 +1,86 @@
+"""Test archive checksums and the storage scrubber."""
+
+import bz2
+import hashlib
+import os
+import time
+
+import pytest
+
+import blobs
+import integrity
+
+
+PAYLOAD = b'occurrence_no,accepted_name\n' + b'1,Canis\n' * 5000
+
+
+@pytest.fixture()
+def storage(tmp_path, monkeypatch):
+    monkeypatch.setattr(blobs, 'blob_root', lambda: str(tmp_path / 'blobs'))
+    return tmp_path
+
+
+def write_archive(storage, archive_no, payload=PAYLOAD):
+    data = bz2.compress(payload)
+    (storage / f'{archive_no}.bz2').write_bytes(data)
+    (storage / f'{archive_no}.header').write_bytes(b'HTTP/1.1 200 OK\r\n\r\n')
+    return (archive_no, 'bz2', 'complete',
+            hashlib.sha256(payload).hexdigest(), len(payload),
+            hashlib.sha256(data).hexdigest(), len(data))
+
+
+def test_scrub_finds_damage_and_orphans(storage):
+    rows = [write_archive(storage, n) for n in (1, 2, 3, 4)]
+
+    # 2 is truncated, 3 is rewritten with different content of the same
+    # size, 4 has lost its file
+    path = storage / '2.bz2'
+    path.write_bytes(path.read_bytes()[:-10])
+    path = storage / '3.bz2'
+    path.write_bytes(bz2.compress(PAYLOAD.replace(b'Canis', b'Felis')))
+    rows[2] = rows[2][:5] + (None, None)
+    os.remove(storage / '4.bz2')
+
+    rows.append((5, 'bz2', 'queued', None, None, None, None))
+    # 7 is being delta encoded; its checksums are recorded once it is done
+    rows.append(write_archive(storage, 7)[:2] + ('compressing',) +
+                rows[0][3:])
+    path = storage / '7.bz2'
+    path.write_bytes(path.read_bytes()[:-10])
+    (storage / '9.bz2').write_bytes(b'stray')
+    (storage / '1.gz').write_bytes(b'left over from a re-encode')
+    (storage / '6.bz2.part').write_bytes(b'')
+
+    report = integrity.scrub(rows, str(storage), workers=2, deep=True)
+
+    assert report['checked'] == 4
+    assert report['ok'] == 1
+    assert [r['archive_no'] for r in report['mismatch']] == [2]
+    assert [r['archive_no'] for r in report['corrupt']] == [3]
+    assert [r['archive_no'] for r in report['missing']] == [4]
+    assert sorted((os.path.basename(o['path']), o['reason'])
+                  for o in report['orphans']) == [
+        ('1.gz', 'stale codec'),
+        ('6.bz2.part', 'partial write'),
+        ('9.bz2', 'no archive row')]
+
+
+def test_shallow_check_skips_decompression(storage):
+    row = write_archive(storage, 1)
+    expected = integrity.Checksums(*row[3:])
+
+    result = integrity.check_file(1, str(storage / '1.bz2'), 'bz2', expected)
+    assert result['state'] == 'ok'
+    assert 'content_sha256' not in result
+
+    result = integrity.check_file(1, str(storage / '1.bz2'), 'bz2',
+                                  expected._replace(file_size=1), deep=True)
+    assert result['state'] == 'mismatch'
+    assert result['content_size'] == len(PAYLOAD)
+
+
+def test_throttle_limits_read_rate():
+    throttle = integrity.Throttle(rate=4 * 1024 * 1024)
+    for _ in range(4):
+        throttle(512 * 1024)
+    assert time.monotonic() - throttle.start >= 0.45
@@ -0,0 +1,182 @@
+"""Test the archive job queue: claims, retries, recovery and status."""
+
+import json
+import os
+
+import pytest
+
+import aux
+import jobs
+import metrics
+import pipeline
+import upstream
+from conftest import add_archive
+
+
+@pytest.fixture()
+def statuses(monkeypatch):
+    """Collect the data_archives status updates made by the queue."""
+    statuses = list()
+    monkeypatch.setattr(aux, 'archive_status',
+                        lambda archive_no, success=None, stage=None:
+                            statuses.append((archive_no, stage or success)))
+    return statuses
+
+
+@pytest.fixture()
+def queue(tmp_path, monkeypatch, statuses):
+    settings = {'queue_db': str(tmp_path / 'queue.sqlite'),
+                'storage': str(tmp_path / 'storage'),
+                'job_max_attempts': '2', 'job_retry_base': '60'}
+    monkeypatch.setattr(aux, 'get_config',
+                        lambda setting, default=None:
+                            settings.get(setting, default))
+    monkeypatch.setattr(jobs, 'worker_id', lambda: 'here:1')
+    monkeypatch.setattr(metrics, 'metrics_dir',
+                        lambda: str(tmp_path / 'metrics'))
+    db = jobs.connect()
+    yield db
+    db.close()
+
+
+def payload(db, archive_no):
+    row = db.execute('SELECT payload FROM jobs WHERE archive_no = ?',
+                     (archive_no,)).fetchone()
+    return json.loads(row[0])
+
+
+def test_enqueue_claim_finish(queue):
+    jobs.enqueue(1, {'session_id': 's1', 'auth': 7, 'uri': '/x'})
+    jobs.enqueue(2, {'session_id': 's2', 'auth': 7, 'uri': '/y'})
+
+    archive_no, job, attempts = jobs.claim(queue)
+    assert (archive_no, job['uri'], attempts) == (1, '/x', 1)
+    assert jobs.job_info(1)['state'] == 'running'
+
+    # Finished jobs keep no session cookie on disk
+    jobs.finish(queue, 1)
+    assert jobs.job_info(1)['state'] == 'done'
+    assert payload(queue, 1) == {'auth': 7, 'uri': '/x'}
+
+    assert jobs.claim(queue)[0] == 2
+    jobs.finish(queue, 2, 'Server error - Data service')
+    info = jobs.job_info(2)
+    assert (info['state'], info['error']) == ('failed',
+                                              'Server error - Data service')
+    assert 'session_id' not in payload(queue, 2)
+    assert jobs.claim(queue) is None
+
+
+def test_transient_failures_are_retried(queue, statuses, monkeypatch):
+    def unavailable(db, archive_no, job):
+        raise pipeline.PipelineError('Server error - Data service '
+                                     'unavailable') from \
+            upstream.CircuitOpen('open')
+
+    monkeypatch.setattr(jobs, 'build_archive', unavailable)
+    jobs.enqueue(1, {'session_id': 's1'})
+
+    assert jobs.run_one(queue)
+    info = jobs.job_info(1)
+    assert (info['state'], info['attempts']) == ('queued', 1)
+    assert payload(queue, 1)['session_id'] == 's1'
+
+    # Not due until the backoff has passed
+    assert jobs.claim(queue) is None
+    queue.execute('UPDATE jobs SET next_attempt = 0')
+
+    # The second failure uses up job_max_attempts
+    assert jobs.run_one(queue)
+    info = jobs.job_info(1)
+    assert (info['state'], info['attempts']) == ('failed', 2)
+    assert statuses[-1] == (1, False)
+
+
+def test_client_errors_are_not_retried(queue, monkeypatch):
+    def rejected(db, archive_no, job):
+        raise pipeline.PipelineError('Server error - Data service')
+
+    monkeypatch.setattr(jobs, 'build_archive', rejected)
+    jobs.enqueue(1, {'session_id': 's1'})
+
+    assert jobs.run_one(queue)
+    assert jobs.job_info(1)['state'] == 'failed'
+
+
+def test_recover_requeues_claims_of_dead_workers(queue, statuses,
+                                                  monkeypatch):
+    for archive_no in (1, 2, 3):
+        jobs.enqueue(archive_no, {'session_id': 's1'})
+        jobs.claim(queue)
+
+    # 1 was claimed by a dead process, 2 by this live one and 3 elsewhere
+    dead = os.fork()
+    if dead == 0:
+        os._exit(0)
+    os.waitpid(dead, 0)
+    queue.execute("UPDATE jobs SET worker = ? WHERE archive_no = 1",
+                  (f'here:{dead}',))
+    queue.execute("UPDATE jobs SET worker = ? WHERE archive_no = 2",
+                  (f'here:{os.getpid()}',))
+    queue.execute("UPDATE jobs SET worker = 'there:1' WHERE archive_no = 3")
+
+    monkeypatch.setattr(jobs.socket, 'gethostname', lambda: 'here')
+    jobs.recover(queue)
+    assert [jobs.job_info(n)['state'] for n in (1, 2, 3)] == \
+        ['queued', 'running', 'running']
+
+    # A job whose worker died on its last attempt is failed instead
+    queue.execute('UPDATE jobs SET next_attempt = 0')
+    jobs.claim(queue)
+    queue.execute("UPDATE jobs SET worker = ? WHERE archive_no = 1",
+                  (f'here:{dead}',))
+    jobs.recover(queue)
+    assert jobs.job_info(1)['state'] == 'failed'
+    assert statuses[-1] == (1, False)
+
+
+def test_identical_jobs_share_a_finished_fetch(queue, tmp_path,
+                                               monkeypatch):
+    os.mkdir(tmp_path / 'storage')
+    fetches = list()
+
+    def fetch_archive(archive_no, uri, session_id, progress=None,
+                      codec=None, user=None):
+        fetches.append(archive_no)
+        headerpath, archivepath = pipeline.archive_paths(archive_no, codec)
+        with open(headerpath, 'w') as f:
+            f.write('HTTP/1.1 200 OK\n')
+        with open(archivepath, 'wb') as f:
+            f.write(b'compressed')
+        return 4, 10, 'ab' * 32, 'cd' * 32
+
+    monkeypatch.setattr(pipeline, 'fetch_archive', fetch_archive)
+    for archive_no in (1, 2):
+        jobs.enqueue(archive_no, {'session_id': 's1', 'auth': 7,
+                                  'uri': '/occs/list.csv?base_name=Canis',
+                                  'codec': 'bz2'})
+
+    # The second job is only claimed once the first has finished
+    for archive_no in (1, 2):
+        assert jobs.claim(queue)[0] == archive_no
+        checksums = jobs.fetch_data(queue, archive_no, payload(queue,
+                                                               archive_no))
+        assert checksums.content_sha256 == 'ab' * 32
+
+    assert fetches == [1]
+    assert os.path.samefile(tmp_path / 'storage' / '1.bz2',
+                            tmp_path / 'storage' / '2.bz2')
+
+
+def test_status_endpoint(client):
+    archive_no = add_archive(status='downloading')
+    jobs.enqueue(archive_no, {'session_id': 's1'})
+
+    r = client.get(f'/archives/status/{archive_no}')
+    assert r.status_code == 200
+    assert r.json['status'] == 'queued'
+    assert r.json['job']['state'] == 'queued'
+
+    r = client.get('/archives/status/999999')
+    assert r.status_code == 404
+    assert r.json['message'] == 'Archive not found'
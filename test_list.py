@@ -0,0 +1,75 @@
+"""Test /archives/list: keyset pages, filters and streamed output."""
+
+import json
+
+import pytest
+
+import aux
+from conftest import add_archive
+
+
+ENTERER = 701
+
+
+@pytest.fixture()
+def archives(client):
+    """Five archives of one enterer, the last two with a DOI."""
+    return [add_archive(enterer_no=ENTERER, title=f'Listed {i}',
+                        doi='10.5072/t.{i}' if i >= 3 else None)
+            for i in range(5)]
+
+
+def test_filters_are_parameterised():
+    sql, params = aux.list_query(limit=10, after_archive_no=5, enterer_no=3,
+                                 status="x' OR '1'='1",
+                                 created_after='2024-01-01', has_doi=True)
+    assert "x' OR" not in sql
+    assert sql.count('%s') == len(params)
+    assert params == [5, 3, "x' OR '1'='1", '2024-01-01', 10]
+    assert sql.rstrip().endswith('ORDER BY archive_no LIMIT %s')
+
+
+def test_keyset_pages(client, archives):
+    base = f'/archives/list?enterer_no={ENTERER}&limit=2'
+
+    first = client.get(base).json
+    assert [a['archive_no'] for a in first] == archives[:2]
+
+    # The last archive_no of a page is the cursor for the next one
+    second = client.get(f'{base}&after_archive_no={first[-1]["archive_no"]}')
+    assert [a['archive_no'] for a in second.json] == archives[2:4]
+
+    last = client.get(f'{base}&after_archive_no={archives[3]}').json
+    assert [a['archive_no'] for a in last] == archives[4:]
+    assert client.get(f'{base}&after_archive_no={archives[4]}').json == []
+
+
+def test_filters(client, archives):
+    base = f'/archives/list?enterer_no={ENTERER}'
+
+    r = client.get(base + '&doi=present')
+    assert [a['archive_no'] for a in r.json] == archives[3:]
+    r = client.get(base + '&doi=absent')
+    assert [a['archive_no'] for a in r.json] == archives[:3]
+
+    r = client.get(base + "&status=x'%20OR%20'1'='1")
+    assert r.status_code == 200 and r.json == []
+
+    for bad in ('limit=0', 'limit=x', 'doi=maybe', 'created_after=May'):
+        r = client.get(f'{base}&{bad}')
+        assert r.status_code == 400
+        assert r.json['message'].startswith('Parameter error')
+
+
+def test_ndjson_and_streamed_array(client, archives):
+    r = client.get(f'/archives/list?enterer_no={ENTERER}&format=ndjson')
+    assert r.mimetype == 'application/x-ndjson'
+    lines = r.get_data(as_text=True).splitlines()
+    rows = [json.loads(line) for line in lines]
+    assert [row['archive_no'] for row in rows] == archives
+    assert rows[0]['title'] == 'Listed 0'
+
+    r = client.get(f'/archives/list?enterer_no={ENTERER}&stream=1')
+    assert r.mimetype == 'application/json'
+    assert r.json == client.get(
+        f'/archives/list?enterer_no={ENTERER}').json
@@ -0,0 +1,107 @@
+"""Test the persistent outbox and batched mail sender."""
+
+import json
+from contextlib import contextmanager
+
+import pytest
+
+import aux
+import mailer
+
+
+SETTINGS = {'queue_db': 'queue.sqlite', 'mail_retry_base': '60',
+            'mail_max_attempts': '2', 'base': 'https://example.org',
+            'email': 'info@example.org, doi@example.org'}
+
+
+@pytest.fixture()
+def outbox(tmp_path, monkeypatch):
+    settings = dict(SETTINGS, queue_db=str(tmp_path / 'queue.sqlite'))
+    monkeypatch.setattr(aux, 'get_config',
+                        lambda setting, default=None:
+                            settings.get(setting, default))
+    db = mailer.connect()
+    yield db
+    db.close()
+
+
+class FlakyTransport:
+    """Count sessions and fail the first n sends."""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.sessions = 0
+        self.sent = []
+
+    @contextmanager
+    def session(self):
+        self.sessions += 1
+
+        def send(recipients, message):
+            if self.failures:
+                self.failures -= 1
+                raise OSError('mail server unavailable')
+            self.sent.append((recipients, message))
+
+        yield send
+
+
+def queue(n):
+    for i in range(n):
+        msg = mailer.doi_request(i, f'title {i}', 2024, 'A. Author',
+                                 ['info@example.org'])
+        mailer.enqueue(['info@example.org'], msg, archive_no=i)
+
+
+def test_messages_are_sent_in_batches(outbox):
+    queue(5)
+    transport = FlakyTransport()
+
+    assert mailer.send_batch(outbox, transport, batch_size=3) == 3
+    assert mailer.send_batch(outbox, transport, batch_size=3) == 2
+    assert mailer.send_batch(outbox, transport, batch_size=3) == 0
+
+    assert transport.sessions == 2
+    assert len(transport.sent) == 5
+    assert 'PBDB Archive ID Number: 4' in transport.sent[4][1]
+    assert mailer.pending() == {'sent': 5}
+
+
+def test_failures_back_off_then_give_up(outbox):
+    queue(1)
+    transport = FlakyTransport(failures=2)
+
+    assert mailer.send_batch(outbox, transport) == 1
+    assert mailer.pending() == {'queued': 1}
+
+    # Not due again until the backoff has passed
+    assert mailer.send_batch(outbox, transport) == 0
+    outbox.execute('UPDATE outbox SET next_attempt = 0')
+
+    assert mailer.send_batch(outbox, transport) == 1
+    assert mailer.pending() == {'failed': 1}
+    assert not transport.sent
+
+
+def test_file_transport_writes_messages(outbox, tmp_path):
+    queue(2)
+    transport = mailer.FileTransport(str(tmp_path / 'mail'))
+
+    assert mailer.send_batch(outbox, transport) == 2
+    files = sorted((tmp_path / 'mail').glob('*.eml'))
+    assert len(files) == 2
+    assert 'Subject: PBDB archive DOI request' in files[0].read_text()
+
+
+
+def test_doi_request_without_enterer_email(outbox, monkeypatch):
+    monkeypatch.setattr(aux, 'get_ent_email', lambda ent: None)
+
+    aux.request_doi(5, 'title', 2024, 'A. Author', 42)
+    aux.request_doi(6, 'title', 2024, 'A. Author', 42, 'ent@example.org')
+
+    rows = outbox.execute("""SELECT recipients FROM outbox
+                             ORDER BY archive_no""").fetchall()
+    assert [json.loads(row[0]) for row in rows] == [
+        ['info@example.org', 'doi@example.org'],
+        ['info@example.org', 'doi@example.org', 'ent@example.org']]
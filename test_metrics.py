@@ -0,0 +1,123 @@
+"""Unit tests for metric collection, merging and exposition."""
+
+import json
+import os
+
+import pytest
+
+import metrics
+
+
+@pytest.fixture()
+def metrics_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, 'metrics_dir', lambda: str(tmp_path))
+    return tmp_path
+
+
+def test_histogram_buckets_are_cumulative(metrics_dir):
+    hist = metrics.Histogram('test_latency_seconds', 'Test latency',
+                             ['route'], buckets=(0.1, 1.0))
+    try:
+        for value in (0.05, 0.5, 0.5, 5.0):
+            hist.observe(value, route='/x')
+
+        text = metrics.render()
+        assert 'test_latency_seconds_bucket{route="/x",le="0.1"} 1' in text
+        assert 'test_latency_seconds_bucket{route="/x",le="1.0"} 3' in text
+        assert 'test_latency_seconds_bucket{route="/x",le="+Inf"} 4' in text
+        assert 'test_latency_seconds_count{route="/x"} 4' in text
+        assert 'test_latency_seconds_sum{route="/x"} 6.05' in text
+    finally:
+        metrics._registry.remove(hist)
+
+
+def test_db_timer_counts_calls_and_generators(metrics_dir):
+    @metrics.db_timer
+    def lookup(n):
+        return n * 2
+
+    @metrics.db_timer
+    def rows(n):
+        yield from range(n)
+
+    assert lookup(2) == 4
+    assert list(rows(3)) == [0, 1, 2]
+
+    text = metrics.render()
+    name = 'archiver_db_query_duration_seconds_count'
+    assert f'{name}{{function="test_metrics.lookup"}} 1' in text
+    assert f'{name}{{function="test_metrics.rows"}} 1' in text
+
+
+def test_snapshots_of_live_processes_are_merged(metrics_dir):
+    counter = metrics.Counter('test_things_total', 'Things', ['kind'])
+    try:
+        counter.inc(2, kind='a')
+        metrics.flush(force=True)
+
+        # Another live process (our parent) and a dead one
+        other = metrics.snapshot()
+        other['test_things_total']['samples'] = [[['a'], 3], [['b'], 1]]
+        for pid in (os.getppid(), 2 ** 22 + 1):
+            with open(metrics_dir / f'{pid}.json', 'w') as f:
+                json.dump(other, f)
+
+        text = metrics.render()
+        assert 'test_things_total{kind="a"} 5' in text
+        assert 'test_things_total{kind="b"} 1' in text
+        assert '# TYPE test_things_total counter' in text
+    finally:
+        metrics._registry.remove(counter)
+
+
+def test_collector_families_are_exported(metrics_dir):
+    @metrics.collector
+    def extra():
+        return [('test_pool', 'Pool levels',
+                 {(('stat', 'in_use'),): 2, (('stat', 'idle'),): 1}),
+                ('test_pool_total', 'Pool counters',
+                 {(('stat', 'borrowed'),): 7}, 'counter')]
+
+    try:
+        text = metrics.render()
+        assert '# TYPE test_pool gauge' in text
+        assert f'test_pool{{stat="in_use",pid="{os.getpid()}"}} 2' in text
+        assert '# TYPE test_pool_total counter' in text
+        assert 'test_pool_total{stat="borrowed"} 7' in text
+    finally:
+        metrics._collectors.remove(extra)
+
+
+def test_gauges_are_reported_per_process(metrics_dir):
+    gauge = metrics.Gauge('test_ttl_seconds', 'A setting')
+    try:
+        gauge.set(60)
+        metrics.flush(force=True)
+        with open(metrics_dir / f'{os.getppid()}.json', 'w') as f:
+            json.dump(metrics.snapshot(), f)
+
+        text = metrics.render()
+        assert f'test_ttl_seconds{{pid="{os.getpid()}"}} 60' in text
+        assert f'test_ttl_seconds{{pid="{os.getppid()}"}} 60' in text
+        assert len([line for line in text.splitlines()
+                    if line.startswith('test_ttl_seconds{')]) == 2
+    finally:
+        metrics._registry.remove(gauge)
+
+
+def test_missing_snapshot_directory(tmp_path, monkeypatch):
+    # Snapshots cannot be written beneath a file, so none exist
+    (tmp_path / 'file').write_text('')
+    monkeypatch.setattr(metrics, 'metrics_dir',
+                        lambda: str(tmp_path / 'file' / 'metrics'))
+    assert metrics.merged() == {}
+
+
+def test_service_stats_split_counters_from_settings(client):
+    text = client.get('/metrics').get_data(as_text=True)
+    ttl = [line for line in text.splitlines()
+           if line.startswith('archiver_response_cache{stat="ttl"')]
+    assert ttl == [f'archiver_response_cache{{stat="ttl",'
+                   f'pid="{os.getpid()}"}} 60.0']
+    assert '# TYPE archiver_response_cache_total counter' in text
+    assert 'archiver_response_cache_total{stat="misses"}' in text
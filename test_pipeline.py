@@ -0,0 +1,55 @@
+"""Test the streaming compression pipeline on local files."""
+
+import bz2
+import io
+import os
+
+import pipeline
+
+
+def test_compress_stream_round_trip(tmp_path):
+    """Compressed output matches the input and no partial file remains."""
+
+    payload = b''.join(b'%d,occurrence,taxon\n' % i for i in range(50000))
+    dest = str(tmp_path / '1.bz2')
+
+    bytes_in, bytes_out = pipeline.compress_stream(io.BytesIO(payload), dest,
+                                                   chunk_size=4096)
+
+    assert bytes_in == len(payload)
+    assert bytes_out == os.path.getsize(dest)
+    assert bz2.decompress(open(dest, 'rb').read()) == payload
+    assert not os.path.exists(dest + '.part')
+
+
+def test_compress_stream_failure_cleans_up(tmp_path):
+    """A source error leaves neither the archive nor a partial file."""
+
+    class Broken(io.RawIOBase):
+        def read(self, size=-1):
+            raise OSError('connection reset')
+
+    dest = str(tmp_path / '2.bz2')
+
+    try:
+        pipeline.compress_stream(Broken(), dest)
+    except OSError:
+        pass
+
+    assert os.listdir(tmp_path) == []
+
+
+def test_parallel_compress_is_multistream_bz2(tmp_path):
+    """Block-parallel output decompresses to the original bytes."""
+
+    payload = os.urandom(1000) * 300
+    dest = str(tmp_path / '3.bz2')
+
+    bytes_in, bytes_out = pipeline.parallel_compress_stream(
+        io.BytesIO(payload), dest, workers=2, block_size=50000)
+
+    assert bytes_in == len(payload)
+    assert bytes_out == os.path.getsize(dest)
+    data = open(dest, 'rb').read()
+    assert data.count(b'BZh9') >= len(payload) // 50000
+    assert bz2.decompress(data) == payload
@@ -0,0 +1,85 @@
+"""Test the MySQL connection pool with in-memory connection objects."""
+
+import threading
+import time
+
+import pytest
+
+from pool import ConnectionPool, PoolTimeout
+
+
+class FakeConnection:
+    """Minimal DB-API connection that records pings and closes."""
+
+    def __init__(self):
+        self.pings = 0
+        self.closed = False
+        self.alive = True
+
+    def ping(self):
+        self.pings += 1
+        if not self.alive:
+            raise OSError('gone away')
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def test_reuse_and_limit():
+    """Connections are reused and the size limit is enforced."""
+
+    pool = ConnectionPool(FakeConnection, size=2, timeout=0.1)
+
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        assert second is first
+
+    a = pool.acquire()
+    b = pool.acquire()
+    with pytest.raises(PoolTimeout):
+        pool.acquire()
+    pool.release(a)
+    pool.release(b)
+
+    stats = pool.stats()
+    assert stats['created'] == 2
+    assert stats['in_use'] == 0
+    assert stats['idle'] == 2
+    assert stats['timeouts'] == 1
+
+
+def test_waiter_gets_released_connection():
+    """A blocked borrower is handed the next returned connection."""
+
+    pool = ConnectionPool(FakeConnection, size=1, timeout=5)
+    held = pool.acquire()
+
+    def give_back():
+        time.sleep(0.05)
+        pool.release(held)
+
+    threading.Thread(target=give_back).start()
+    with pool.connection() as conn:
+        assert conn is held
+
+    stats = pool.stats()
+    assert stats['waits'] == 1
+    assert stats['wait_seconds_max'] > 0
+
+
+def test_health_check_replaces_dead_connection():
+    """A connection that fails its ping is closed and replaced."""
+
+    pool = ConnectionPool(FakeConnection, size=1, ping_after=0)
+    with pool.connection() as conn:
+        conn.alive = False
+
+    with pool.connection() as fresh:
+        assert fresh is not conn
+
+    assert conn.closed
+    assert pool.stats()['health_failures'] == 1
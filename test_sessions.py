@@ -0,0 +1,97 @@
+"""Test the session principal cache against the stand-in database."""
+
+import os
+import time
+
+import pytest
+
+import aux
+import pool
+import sessions
+from bench import standin
+
+
+@pytest.fixture()
+def database(tmp_path, monkeypatch):
+    settings = {'session_stamp': str(tmp_path / 'session.stamp')}
+    monkeypatch.setattr(aux, 'get_config',
+                        lambda setting, default=None:
+                            settings.get(setting, default))
+    monkeypatch.setattr(pool, '_pool', None)
+    pool.configure(connect=standin.create(
+        str(tmp_path / 'db.sqlite'),
+        users=[('admin-session', 10, True, '0000-0000-0000-0010',
+                'admin@example.org'),
+               ('user-session', 20, False, '', 'user@example.org')]))
+
+    monkeypatch.setattr(sessions.principals, 'ttl', 60)
+    monkeypatch.setattr(sessions.principals, 'hits', 0)
+    monkeypatch.setattr(sessions.principals, 'misses', 0)
+    sessions.principals.clear()
+    yield
+    sessions.principals.clear()
+
+
+def set_admin(person_no, admin):
+    with pool.connection() as db:
+        db.cursor().execute('UPDATE pbdb_wing.users SET admin = %s '
+                            'WHERE person_no = %s', (int(admin), person_no))
+        db.commit()
+
+
+def test_principals(database):
+    admin = sessions.get('admin-session')
+    assert admin == sessions.Principal(authorizer_no=10, enterer_no=10,
+                                       admin=True, has_orcid=True,
+                                       email='admin@example.org')
+
+    user = sessions.get('user-session')
+    assert (user.admin, user.has_orcid) == (False, False)
+    assert aux.user_info('user-session') == (20, 20)
+    assert not aux.admin_check('user-session')
+
+    for session_id in (None, '', 'no-such-session'):
+        with pytest.raises(KeyError):
+            sessions.get(session_id)
+
+
+def test_hits_and_misses(database):
+    sessions.get('user-session')
+    set_admin(20, True)
+
+    # Served from the cache, so the change is not seen yet
+    assert not sessions.get('user-session').admin
+    assert not sessions.get('user-session').admin
+
+    stats = sessions.stats()
+    assert (stats['hits'], stats['misses'], stats['size']) == (2, 1, 1)
+
+
+def test_ttl_expiry(database, monkeypatch):
+    monkeypatch.setattr(sessions.principals, 'ttl', 0.05)
+    sessions.get('user-session')
+    set_admin(20, True)
+
+    time.sleep(0.06)
+    assert sessions.get('user-session').admin
+    assert sessions.stats()['misses'] == 2
+
+
+def test_invalidation_from_another_process(database):
+    sessions.get('user-session')
+    set_admin(20, True)
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            sessions.invalidate()
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+
+    assert sessions.get('user-session').admin
+
+    # And from this process
+    set_admin(20, False)
+    sessions.invalidate()
+    assert not sessions.get('user-session').admin
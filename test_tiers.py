@@ -0,0 +1,137 @@
+"""Test tiered storage: access scores, eviction and promotion."""
+
+import bz2
+import hashlib
+import os
+
+import pytest
+
+import aux
+import blobs
+import catalog
+import conftest
+import pool
+import tiers
+from bench import standin
+
+
+@pytest.fixture()
+def store(tmp_path, monkeypatch):
+    settings = {'storage': str(tmp_path / 'hot'),
+                'cold_storage': str(tmp_path / 'cold'),
+                'queue_db': str(tmp_path / 'queue.sqlite'),
+                'cache_stamp': str(tmp_path / 'cache.stamp'),
+                'catalog_stamp': str(tmp_path / 'catalog.stamp'),
+                'hot_tier_bytes': '0'}
+    os.makedirs(settings['storage'])
+    monkeypatch.setattr(aux, 'get_config',
+                        lambda setting, default=None:
+                            settings.get(setting, default))
+    monkeypatch.setattr(tiers, '_settings', None)
+    monkeypatch.setattr(tiers, '_backend', None)
+    monkeypatch.setattr(pool, '_pool', None)
+    pool.configure(connect=standin.create(str(tmp_path / 'db.sqlite')))
+    catalog.archives.clear()
+    yield tmp_path
+    catalog.archives.clear()
+
+
+def add_archive(store, data):
+    """Write a complete bz2 archive and its row; return its number."""
+    content_sha256 = hashlib.sha256(data).hexdigest()
+    compressed = bz2.compress(data)
+
+    with pool.connection() as db:
+        cursor = db.cursor()
+        cursor.execute("""INSERT INTO data_archives
+                          (uri_path, status, codec, content_sha256,
+                           content_size, file_sha256, file_size)
+                          VALUES ('/data1.2/occs/list.csv', 'complete',
+                                  'bz2', %s, %s, %s, %s)""",
+                       (content_sha256, len(data),
+                        hashlib.sha256(compressed).hexdigest(),
+                        len(compressed)))
+        archive_no = cursor.lastrowid
+        db.commit()
+
+    path = str(store / 'hot' / f'{archive_no}.bz2')
+    with open(path, 'wb') as f:
+        f.write(compressed)
+    blobs.store(path, content_sha256, 'bz2')
+    catalog.archives.clear()
+    return archive_no
+
+
+def test_scores_decay_and_credit_bases(store):
+    day = 24 * 3600
+    tiers.record({1: 4, 2: 1}, now=1000.0)
+    tiers.record({1: 2}, now=1000.0 + 7 * day)
+
+    scores = tiers.scores(now=1000.0 + 14 * day)
+    assert scores[1] == (pytest.approx((4 / 2 + 2) / 2), 1000.0 + 7 * day)
+    assert scores[2][0] == pytest.approx(1 / 4)
+
+    # Bases are credited with the scores of the deltas stored against them
+    scores = tiers.scores(bases={3: 2, 2: 1}, now=1000.0 + 14 * day)
+    assert scores[1][0] == pytest.approx(2 + 1 / 4)
+    assert 3 not in scores
+
+
+def test_evict_and_promote(store):
+    popular = add_archive(store, b'a,b\n' + b'1,2\n' * 5000)
+    shared = b'a,b\n' + b'3,4\n' * 5000
+    first, second = add_archive(store, shared), add_archive(store, shared)
+    tiers.record({popular: 10, second: 1})
+
+    # Evicting one of two archives sharing a blob frees nothing
+    single = os.path.getsize(store / 'hot' / f'{popular}.bz2')
+    assert tiers.evict(limit=single) == single
+    assert set(os.listdir(store / 'hot')) == {'.tiers', 'blobs',
+                                              f'{popular}.bz2'}
+    assert sorted(os.listdir(store / 'cold')) == [f'{first}.bz2',
+                                                  f'{second}.bz2']
+
+    entry = catalog.lookup(first)
+    assert entry.cold and entry.stat is None
+    assert entry.size == entry.expected_size
+    assert b''.join(tiers.read_cold(entry)) == bz2.compress(shared)
+
+    # Promotion verifies the cold copy and shares the blob again
+    entry = tiers.local(entry)
+    assert not entry.cold
+    tiers.promote(second)
+    assert os.stat(entry.path).st_nlink == 3
+
+    # Cold copies are kept, so evicting again only copies the new one
+    assert tiers.evict(limit=0) == 0
+    assert tiers.report()['cold_only'] == 3
+
+
+def test_promotion_rejects_a_damaged_cold_copy(store):
+    archive_no = add_archive(store, b'a,b\n' + b'5,6\n' * 5000)
+    tiers.evict(limit=0)
+
+    cold = store / 'cold' / f'{archive_no}.bz2'
+    cold.write_bytes(cold.read_bytes()[:-10] + b'0123456789')
+
+    with pytest.raises(tiers.TierError):
+        tiers.promote(archive_no)
+    assert catalog.lookup(archive_no).cold
+    assert [name for name in os.listdir(store / 'hot')
+            if name.endswith('.part')] == []
+
+
+def test_cold_archives_without_a_cold_tier(client, monkeypatch):
+    monkeypatch.setattr(tiers, '_settings', None)
+    monkeypatch.setattr(tiers, '_backend', None)
+    archive_no = conftest.add_archive(cold_copy=1, file_size=100)
+
+    with pytest.raises(tiers.TierError):
+        tiers.backend()
+
+    r = client.get(f'/archives/retrieve/{archive_no}')
+    assert r.status_code == 503
+    assert r.json['message'] == 'Archive unavailable'
+
+    # Downloads are not counted when there is nothing to evict to
+    assert not tiers._hits
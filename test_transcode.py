@@ -0,0 +1,86 @@
+"""Test decompressed and converted archive retrieval."""
+
+import bz2
+import io
+import json
+import os
+
+import pytest
+
+import catalog
+import transcode
+
+
+ROWS = 2500
+
+
+@pytest.fixture()
+def entry(tmp_path, monkeypatch):
+    monkeypatch.setattr(transcode, 'cache_dir',
+                        lambda: str(tmp_path / 'derived'))
+
+    lines = ['occurrence_no,accepted_name,max_ma']
+    lines += [f'{i},"Canis, sp. {i}",{i / 10}' for i in range(ROWS)]
+    path = tmp_path / '5.bz2'
+    path.write_bytes(bz2.compress(('\n'.join(lines) + '\n').encode()))
+
+    st = os.stat(path)
+    return catalog.Entry(5, '.csv', 'bz2', 'complete', str(path),
+                         st.st_size, st.st_mtime, st)
+
+
+def test_ndjson_is_cached_after_conversion(entry):
+    path = transcode.cache_path(entry, 'ndjson')
+    data = b''.join(transcode.convert(entry, 'ndjson', path))
+
+    rows = [json.loads(line) for line in data.splitlines()]
+    assert len(rows) == ROWS
+    assert rows[7] == {'occurrence_no': '7', 'accepted_name': 'Canis, sp. 7',
+                       'max_ma': '0.7'}
+
+    st = transcode.cached(path)
+    assert st.st_size == len(data)
+    assert not [name for name in os.listdir(os.path.dirname(path))
+                if name.endswith('.part')]
+
+
+def test_json_archives_cannot_be_converted(entry):
+    transcode.check(entry._replace(file_type='.json'), 'raw')
+    with pytest.raises(transcode.Unsupported):
+        transcode.check(entry._replace(file_type='.json'), 'ndjson')
+    with pytest.raises(transcode.Unsupported):
+        transcode.check(entry, 'xlsx')
+
+
+def test_least_recently_used_files_are_evicted(entry, tmp_path):
+    root = tmp_path / 'derived'
+    root.mkdir()
+    for i, name in enumerate(('old', 'idle', 'new')):
+        path = root / name
+        path.write_bytes(b'x' * 100)
+        os.utime(path, (1000 + i, 1000 + i))
+
+    # Reading marks a file as used without changing its mtime
+    st = transcode.cached(str(root / 'old'))
+    assert st.st_mtime == 1000
+    assert os.stat(root / 'old').st_mtime == 1000
+
+    assert transcode.evict(limit=200) == 200
+    assert sorted(os.listdir(root)) == ['.lock', 'new', 'old']
+
+
+@pytest.mark.skipif(transcode.pyarrow is None, reason='pyarrow not installed')
+def test_arrow_and_parquet(entry):
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    data = b''.join(transcode.convert(entry, 'arrow',
+                                      transcode.cache_path(entry, 'arrow')))
+    table = pyarrow.ipc.open_stream(data).read_all()
+    assert table.num_rows == ROWS
+    assert table.column('accepted_name')[3].as_py() == 'Canis, sp. 3'
+
+    data = b''.join(transcode.convert(entry, 'parquet',
+                                      transcode.cache_path(entry, 'parquet')))
+    table = pyarrow.parquet.read_table(io.BytesIO(data))
+    assert table.num_rows == ROWS
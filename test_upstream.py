@@ -0,0 +1,172 @@
+"""Test the data service client: resumes, restarts, slots and breaker."""
+
+import bz2
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import aux
+import metrics
+import pipeline
+import upstream
+
+
+BODY = b'occurrence_no,accepted_name\n' + b''.join(
+    b'%d,Taxon %d\n' % (n, n) for n in range(20000))
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, self.headers.get('Range')))
+        calls = sum(1 for path, _ in server.requests if path == self.path)
+
+        server.cookies.append(self.headers.get('Cookie'))
+
+        if self.path == '/slow':
+            time.sleep(0.5)
+        elif self.path == '/error':
+            self.send_error(500)
+            return
+        elif self.path.startswith('/moved'):
+            # The same server under another host name
+            self.send_response(302)
+            self.send_header('Location', self.path[len('/moved'):] or
+                             f'http://localhost:{server.server_address[1]}'
+                             f'/data')
+            self.end_headers()
+            return
+
+        start = 0
+        byte_range = self.headers.get('Range')
+        if byte_range and self.headers.get('If-Range') == '"v1"':
+            start = int(byte_range[len('bytes='):-1])
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             f'bytes {start}-{len(BODY) - 1}/{len(BODY)}')
+        else:
+            self.send_response(200)
+        if self.path != '/cut-no-etag':
+            self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(BODY) - start))
+        self.end_headers()
+
+        # The first response of /cut* stops half way
+        end = len(BODY) // 2 if self.path.startswith('/cut') and \
+            calls == 1 else len(BODY)
+        try:
+            self.wfile.write(BODY[start:end])
+        except ConnectionError:
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture()
+def service(tmp_path, monkeypatch):
+    settings = {'storage': str(tmp_path), 'fetch_retry_base': '0.01',
+                'fetch_read_timeout': '0.2', 'fetch_attempts': '3',
+                'fetch_max_concurrent': '1', 'fetch_slot_timeout': '0.3',
+                'fetch_breaker_failures': '2', 'fetch_breaker_reset': '60'}
+    monkeypatch.setattr(aux, 'get_config',
+                        lambda setting, default=None:
+                            settings.get(setting, default))
+    monkeypatch.setattr(upstream, '_settings', None)
+    monkeypatch.setattr(upstream, '_breaker', None)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    server.requests = []
+    server.cookies = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.url = f'http://127.0.0.1:{server.server_address[1]}'
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def read_all(response):
+    parts = list()
+    while True:
+        chunk = response.read(4096)
+        if not chunk:
+            return b''.join(parts)
+        parts.append(chunk)
+
+
+def test_interrupted_body_resumes_with_range(service):
+    with upstream.Fetch(service.url + '/cut', user=7) as fetch:
+        with fetch.open() as response:
+            assert read_all(response) == BODY
+
+    assert service.requests == [('/cut', None),
+                                ('/cut', f'bytes={len(BODY) // 2}-')]
+
+
+def test_fetch_starts_over_without_a_validator(service, tmp_path):
+    bytes_in, _, _, _ = pipeline.fetch_archive(
+        1, service.url + '/cut-no-etag', 's1', codec='bz2')
+    assert bytes_in == len(BODY)
+    assert bz2.decompress((tmp_path / '1.bz2').read_bytes()) == BODY
+    assert [r for _, r in service.requests] == [None, None]
+
+
+def test_slots_are_bounded(service):
+    with upstream.Fetch(service.url + '/cut', user=1):
+        with pytest.raises(upstream.SlotTimeout):
+            with upstream.Fetch(service.url + '/cut', user=2):
+                pass
+
+
+def test_breaker_fails_fast_after_timeouts(service):
+    # Two timeouts open the breaker, which rejects the third try
+    with pytest.raises(upstream.CircuitOpen):
+        with upstream.Fetch(service.url + '/slow') as fetch:
+            fetch.open()
+    assert len(service.requests) == 2
+
+    rejected = metrics.BREAKER_REJECTIONS._values[()]
+    start = time.monotonic()
+    with pytest.raises(upstream.CircuitOpen):
+        with upstream.Fetch(service.url + '/cut') as fetch:
+            fetch.open()
+    assert time.monotonic() - start < 0.1
+    assert metrics.BREAKER_REJECTIONS._values[()] == rejected + 1
+
+    with pytest.raises(pipeline.PipelineError,
+                       match='Data service unavailable'):
+        pipeline.fetch_archive(2, service.url + '/cut', 's1')
+
+
+def test_server_errors_count_against_the_breaker(service):
+    failed = metrics.FETCH_TRIES._values.get(('server_error',), 0)
+
+    # 500 is not retried, but two of them still open the breaker
+    for _ in range(2):
+        with upstream.Fetch(service.url + '/error') as fetch:
+            with fetch.open() as response:
+                assert response.status == 500
+    assert metrics.FETCH_TRIES._values[('server_error',)] == failed + 2
+
+    with pytest.raises(upstream.CircuitOpen):
+        with upstream.Fetch(service.url + '/cut') as fetch:
+            fetch.open()
+    assert len(service.requests) == 2
+
+
+def test_credentials_stay_with_the_data_service(service):
+    headers = {'Cookie': 'session_id=s1'}
+    with upstream.Fetch(service.url + '/moved/data',
+                        headers=headers) as fetch:
+        with fetch.open() as response:
+            assert read_all(response) == BODY
+    assert service.cookies == ['session_id=s1', 'session_id=s1']
+
+    service.cookies.clear()
+    with upstream.Fetch(service.url + '/moved', headers=headers) as fetch:
+        with fetch.open() as response:
+            assert read_all(response) == BODY
+    assert service.cookies == ['session_id=s1', None]
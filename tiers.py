@@ -0,0 +1,680 @@
+"""Tiered archive storage: a hot local tier and a cold backend.
+
+The storage directory is the hot tier. With cold_storage set, archive files
+are also kept in a cold tier: a directory on a second mounted filesystem,
+or an S3-compatible object store given as s3://bucket/prefix (this needs
+the optional boto3 package; cold_s3_endpoint points it at a local stand-in
+such as MinIO). When the archive files in the hot tier take more than
+hot_tier_bytes, the archives least likely to be downloaded are copied to
+the cold tier, if they are not there already, and removed locally.
+
+Every download counts as an access. Hits are batched in memory and folded
+into a score per archive in the local queue database, decaying with a half
+life of tier_half_life seconds, so archives popular now stay hot while
+ones that were popular once drift to the cold tier. The base of a delta
+archive (see delta.py) adds its dependents' scores to its own, as serving
+them needs it, and a new archive starts with one access.
+
+The first download of a cold archive is served from the cold tier while it
+is copied back to the hot tier in the background (promoted), checked
+against its recorded file checksums. Conversions, bundles and delta
+rebuilds need the file itself and promote it before reading. The cold copy
+is kept, so evicting a promoted archive again is only a local delete; it
+is removed when the archive is deleted or rewritten. Header files always
+stay in the hot tier.
+"""
+
+import collections
+import fcntl
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import aux
+import compression
+import metrics
+from download import CHUNK_SIZE
+
+try:
+    import boto3
+    import botocore.exceptions
+except ImportError:
+    boto3 = None
+
+
+logger = logging.getLogger('archiver.tiers')
+
+ACCESS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS access (
+    archive_no INTEGER PRIMARY KEY,
+    hits INTEGER NOT NULL,
+    score REAL NOT NULL,
+    last_access REAL NOT NULL
+)
+"""
+
+# Moves of the same archive are serialised over this many lock files
+LOCK_BUCKETS = 64
+
+
+class TierError(OSError):
+    """Raised when an archive cannot be moved between storage tiers."""
+
+
+class DirectoryBackend:
+    """Cold tier in a directory, usually on another mounted filesystem.
+
+    Copies keep their modification time, so download ETags and range
+    resumes stay valid whichever tier an archive is served from.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def put(self, name, path):
+        partpath = f'{self.path(name)}.{os.getpid()}.part'
+        try:
+            shutil.copy2(path, partpath)
+            with open(partpath, 'rb') as f:
+                os.fsync(f.fileno())
+            os.replace(partpath, self.path(name))
+        finally:
+            if os.path.exists(partpath):
+                os.remove(partpath)
+
+    def fetch(self, name, path):
+        shutil.copy2(self.path(name), path)
+
+    def open(self, name):
+        return open(self.path(name), 'rb')
+
+    def size(self, name):
+        try:
+            return os.path.getsize(self.path(name))
+        except FileNotFoundError:
+            return None
+
+    def delete(self, name):
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            pass
+
+    def inventory(self):
+        """Map the name of every stored file to its size."""
+        sizes = dict()
+        for name in os.listdir(self.root):
+            if name.endswith('.part'):
+                continue
+            try:
+                sizes[name] = os.path.getsize(self.path(name))
+            except FileNotFoundError:
+                pass
+        return sizes
+
+    def local_path(self, name):
+        """Return a path the file can be served from directly."""
+        return self.path(name)
+
+
+class S3Backend:
+    """Cold tier in an S3-compatible bucket."""
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None,
+                 access_key=None, secret_key=None):
+        if boto3 is None:
+            raise TierError('An S3 cold tier needs the boto3 package')
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.client = boto3.client('s3', endpoint_url=endpoint_url,
+                                   region_name=region,
+                                   aws_access_key_id=access_key,
+                                   aws_secret_access_key=secret_key)
+
+    def key(self, name):
+        return self.prefix + name
+
+    def put(self, name, path):
+        self.client.upload_file(path, self.bucket, self.key(name))
+
+    def fetch(self, name, path):
+        self.client.download_file(self.bucket, self.key(name), path)
+
+    def open(self, name):
+        try:
+            return self.client.get_object(Bucket=self.bucket,
+                                          Key=self.key(name))['Body']
+        except self.client.exceptions.NoSuchKey:
+            raise FileNotFoundError(name)
+
+    def size(self, name):
+        try:
+            head = self.client.head_object(Bucket=self.bucket,
+                                           Key=self.key(name))
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404',
+                                                           'NoSuchKey'):
+                return None
+            raise
+        return head['ContentLength']
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+
+    def inventory(self):
+        """Map the name of every stored object to its size."""
+        sizes = dict()
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket,
+                                       Prefix=self.prefix):
+            for obj in page.get('Contents', []):
+                sizes[obj['Key'][len(self.prefix):]] = obj['Size']
+        return sizes
+
+    def local_path(self, name):
+        return None
+
+
+def open_backend(location):
+    """Return the cold tier backend for a cold_storage setting."""
+    if location.startswith('s3://'):
+        bucket, _, prefix = location[len('s3://'):].partition('/')
+        return S3Backend(bucket, prefix,
+                         endpoint_url=aux.get_config('cold_s3_endpoint',
+                                                     '') or None,
+                         region=aux.get_config('cold_s3_region', '') or None,
+                         access_key=aux.get_config('cold_s3_access_key',
+                                                   '') or None,
+                         secret_key=aux.get_config('cold_s3_secret_key',
+                                                   '') or None)
+    return DirectoryBackend(location)
+
+
+_settings = None
+_backend = None
+_settings_lock = threading.Lock()
+
+
+def settings():
+    """Return the tier settings, read once per process."""
+    global _settings
+
+    if _settings is None:
+        with _settings_lock:
+            if _settings is None:
+                _settings = {
+                    'storage': aux.get_config('storage'),
+                    'cold_storage': aux.get_config('cold_storage', ''),
+                    'hot_tier_bytes': int(aux.get_config(
+                        'hot_tier_bytes', 100 * 1024 ** 3)),
+                    'half_life': float(aux.get_config(
+                        'tier_half_life', 7 * 24 * 3600)),
+                    'flush_interval': float(aux.get_config(
+                        'tier_flush_interval', 10)),
+                    'promote_workers': int(aux.get_config(
+                        'tier_promote_workers', 2))}
+    return _settings
+
+
+def enabled():
+    """Whether a cold tier is configured."""
+    return bool(settings()['cold_storage'])
+
+
+def backend():
+    """Return this process's cold tier backend.
+
+    Raises TierError when no cold tier is configured, e.g. for archives
+    recorded as cold before cold_storage was unset.
+    """
+    global _backend
+
+    if not enabled():
+        raise TierError('No cold tier is configured (cold_storage)')
+
+    if _backend is None:
+        with _settings_lock:
+            if _backend is None:
+                _backend = open_backend(settings()['cold_storage'])
+    return _backend
+
+
+def file_name(archive_no, codec=None, delta=False):
+    """Return the name of an archive file in either tier."""
+    return (str(archive_no) + ('.delta' if delta else '') +
+            compression.get(codec).extension)
+
+
+@contextmanager
+def locked(name, blocking=True):
+    """Hold a lock file in <storage>/.tiers; yields False if it is busy."""
+    root = os.path.join(settings()['storage'], '.tiers')
+    os.makedirs(root, exist_ok=True)
+
+    with open(os.path.join(root, name), 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking
+                        else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def archive_lock(archive_no):
+    return locked(f'archive-{archive_no % LOCK_BUCKETS}.lock')
+
+
+# Access tracking
+
+_hits = collections.Counter()
+_hits_lock = threading.Lock()
+_last_flush = 0.0
+
+
+def connect():
+    """Open the queue database with the access table in place."""
+    import jobs
+
+    db = jobs.connect()
+    db.execute(ACCESS_SCHEMA)
+    return db
+
+
+def touch(archive_no):
+    """Count a download of an archive; only needed with a cold tier."""
+    if not enabled():
+        return
+
+    with _hits_lock:
+        _hits[archive_no] += 1
+    flush()
+
+
+def decayed(score, since, now, half_life):
+    """Return a score as it stands at now, halving every half_life."""
+    return score * 0.5 ** (max(now - since, 0) / half_life)
+
+
+def flush(force=False):
+    """Record batched hits, at most once per tier_flush_interval."""
+    global _last_flush
+
+    now = time.monotonic()
+    with _hits_lock:
+        if not _hits or (not force and now - _last_flush <
+                         settings()['flush_interval']):
+            return
+        _last_flush = now
+        hits = dict(_hits)
+        _hits.clear()
+
+    try:
+        record(hits)
+    except sqlite3.Error as e:
+        # Access counts must never fail a download
+        logger.info(f'Cannot record archive accesses: {e}')
+
+
+def record(hits, now=None):
+    """Add hit counts to the decayed access scores of archives."""
+    now = now or time.time()
+    half_life = settings()['half_life']
+
+    db = connect()
+    try:
+        db.execute('BEGIN IMMEDIATE')
+        for archive_no, count in hits.items():
+            row = db.execute("""SELECT hits, score, last_access FROM access
+                                WHERE archive_no = ?""",
+                             (archive_no,)).fetchone()
+            total, score = count, float(count)
+            if row is not None:
+                total += row[0]
+                score += decayed(row[1], row[2], now, half_life)
+            db.execute("""INSERT OR REPLACE INTO access
+                          (archive_no, hits, score, last_access)
+                          VALUES (?, ?, ?, ?)""",
+                       (archive_no, total, score, now))
+        db.execute('COMMIT')
+    except BaseException:
+        db.execute('ROLLBACK')
+        raise
+    finally:
+        db.close()
+
+
+def scores(bases=None, now=None):
+    """Map archives to their current (score, last access).
+
+    bases maps delta archives to their base; each base is credited with
+    the scores of the archives stored against it.
+    """
+    now = now or time.time()
+    half_life = settings()['half_life']
+    bases = bases or dict()
+
+    db = connect()
+    try:
+        rows = db.execute("""SELECT archive_no, score, last_access
+                             FROM access""").fetchall()
+    finally:
+        db.close()
+
+    own = {archive_no: (decayed(score, last_access, now, half_life),
+                        last_access)
+           for archive_no, score, last_access in rows}
+    result = dict(own)
+
+    for archive_no, (score, last_access) in own.items():
+        seen = {archive_no}
+        base = bases.get(archive_no)
+        while base is not None and base not in seen:
+            base_score, base_access = result.get(base, (0.0, 0.0))
+            result[base] = (base_score + score,
+                            max(base_access, last_access))
+            seen.add(base)
+            base = bases.get(base)
+
+    return result
+
+
+# Moving archives between tiers
+
+_executor = None
+_promoting = set()
+_promoting_lock = threading.Lock()
+_evict_pending = threading.Event()
+
+
+def executor():
+    """Return this process's thread pool for background moves."""
+    global _executor
+
+    if _executor is None:
+        with _settings_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings()['promote_workers'],
+                    thread_name_prefix='tiers')
+    return _executor
+
+
+def _promote(entry):
+    """Copy a cold archive file back into the hot tier."""
+    import blobs
+    import integrity
+
+    content_sha256, _, file_sha256, file_size = \
+        aux.get_checksums(entry.archive_no) or (None,) * 4
+    shared = entry.base is None and content_sha256
+
+    # Another hot archive may hold the same file
+    if shared and os.path.exists(blobs.blob_path(content_sha256,
+                                                 entry.codec)):
+        blob = blobs.blob_path(content_sha256, entry.codec)
+        if integrity.file_digest(blob)[0] == file_sha256 and \
+                blobs.link(entry.path, content_sha256, entry.codec):
+            logger.info(f'Archive {entry.archive_no}: promoted by linking '
+                        'a stored copy')
+            return 0
+        shared = False
+
+    name = os.path.basename(entry.path)
+    partpath = f'{entry.path}.{os.getpid()}.{threading.get_ident()}.part'
+    try:
+        backend().fetch(name, partpath)
+        digest, size = integrity.file_digest(partpath)
+        if (file_sha256 and digest != file_sha256) or \
+                (file_size is not None and size != file_size):
+            raise TierError(f'Cold copy of archive {entry.archive_no} does '
+                            'not match its checksums')
+        os.replace(partpath, entry.path)
+    finally:
+        if os.path.exists(partpath):
+            os.remove(partpath)
+
+    if shared:
+        blobs.store(entry.path, content_sha256, entry.codec)
+
+    return size
+
+
+def promote(archive_no):
+    """Bring a cold archive into the hot tier; return its catalog entry."""
+    import catalog
+
+    entry = catalog.lookup(archive_no)
+    if entry is None or not entry.cold:
+        return entry
+
+    start = time.perf_counter()
+    with archive_lock(archive_no):
+        # Another thread or process may have promoted it meanwhile
+        if not os.path.exists(entry.path):
+            size = _promote(entry)
+            metrics.TIER_MOVES.inc(direction='promote')
+            metrics.TIER_BYTES.inc(size, direction='promote')
+            logger.info(f'Archive {archive_no}: promoted to the hot tier, '
+                        f'{size} bytes in '
+                        f'{time.perf_counter() - start:.2f} s')
+
+    return catalog.lookup(archive_no)
+
+
+def local(entry):
+    """Return a catalog entry whose file is in the hot tier.
+
+    A cold archive is promoted first, which may take a while.
+    """
+    if entry is None or not entry.cold:
+        return entry
+
+    promoted = promote(entry.archive_no)
+    if promoted is None or promoted.cold:
+        raise TierError(f'Archive {entry.archive_no} could not be promoted')
+    return promoted
+
+
+def _promote_in_background(archive_no):
+    try:
+        promote(archive_no)
+        evict()
+    except Exception as e:
+        logger.error(f'Archive {archive_no}: promotion failed: {e}')
+    finally:
+        with _promoting_lock:
+            _promoting.discard(archive_no)
+
+
+def promote_soon(archive_no):
+    """Promote an archive in the background unless that is under way."""
+    with _promoting_lock:
+        if archive_no in _promoting:
+            return
+        _promoting.add(archive_no)
+    executor().submit(_promote_in_background, archive_no)
+
+
+def read_cold(entry):
+    """Yield an archive file from the cold tier in chunks."""
+    f = backend().open(os.path.basename(entry.path))
+    try:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        f.close()
+
+
+def cold_path(entry):
+    """Return a path a cold archive can be served from directly, or None."""
+    return backend().local_path(os.path.basename(entry.path))
+
+
+def hot_files(storage):
+    """Map archive files in the hot tier to (inode, size)."""
+    import integrity
+
+    files = dict()
+    for name in os.listdir(storage):
+        match = integrity.ARCHIVE_FILE.match(name)
+        if match is None or match.group(3) or match.group(2) == '.header':
+            continue
+        try:
+            st = os.stat(os.path.join(storage, name))
+        except FileNotFoundError:
+            continue
+        files[name] = ((st.st_dev, st.st_ino), st.st_size)
+    return files
+
+
+def usage(files):
+    """Return the bytes used by hot files, counting shared blobs once."""
+    return sum(dict(files.values()).values())
+
+
+def evict(limit=None):
+    """Move the least used archives out of the hot tier until it fits.
+
+    Returns the bytes left in the hot tier, or None when there is no cold
+    tier or another process is already evicting.
+    """
+    import blobs
+
+    conf = settings()
+    if not conf['cold_storage']:
+        return None
+    if limit is None:
+        limit = conf['hot_tier_bytes']
+    storage = conf['storage']
+
+    with locked('evict.lock', blocking=False) as acquired:
+        if not acquired:
+            return None
+
+        files = hot_files(storage)
+        total = usage(files)
+        if total <= limit:
+            return total
+
+        flush(force=True)
+        rows = aux.tier_index()
+        bases = {row[0]: row[3] for row in rows if row[3] is not None}
+        ranking = scores(bases)
+
+        # Plan the evictions, freeing a shared file with its last link
+        links = collections.Counter(key for key, _ in files.values())
+        victims = list()
+        for row in sorted(rows, key=lambda row: ranking.get(row[0], (0, 0))
+                          + (row[0],)):
+            if total <= limit:
+                break
+            archive_no, codec, status, base = row[:4]
+            name = file_name(archive_no, codec, base is not None)
+            if status != 'complete' or name not in files:
+                continue
+            victims.append((row, name))
+            key, size = files[name]
+            links[key] -= 1
+            if not links[key]:
+                total -= size
+
+        # Every victim has a cold copy before any local file goes away
+        copied = list()
+        for row, name in victims:
+            archive_no, cold_copy = row[0], row[7]
+            path = os.path.join(storage, name)
+            try:
+                size = os.path.getsize(path)
+                if not cold_copy or backend().size(name) != size:
+                    backend().put(name, path)
+                    if backend().size(name) != size:
+                        raise TierError(f'Cold copy of archive {archive_no} '
+                                        'is incomplete')
+                    metrics.TIER_BYTES.inc(size, direction='evict')
+                copied.append((row, name))
+            except Exception as e:
+                logger.error(f'Archive {archive_no}: cannot copy to the '
+                             f'cold tier: {e}')
+
+        aux.set_cold_copy(row[0] for row, _ in copied if not row[7])
+
+        for row, name in copied:
+            archive_no, codec, _, base, content_sha256 = row[:5]
+            with archive_lock(archive_no):
+                blobs.release(os.path.join(storage, name),
+                              None if base is not None else content_sha256,
+                              codec)
+            metrics.TIER_MOVES.inc(direction='evict')
+
+        remaining = usage(hot_files(storage))
+        logger.info(f'Evicted {len(copied)} archives to the cold tier, '
+                    f'{remaining} bytes left in the hot tier')
+        return remaining
+
+
+def _evict_in_background():
+    _evict_pending.clear()
+    try:
+        evict()
+    except Exception as e:
+        logger.error(f'Eviction failed: {e}')
+
+
+def evict_soon():
+    """Evict in the background unless an eviction is already queued."""
+    if not enabled() or _evict_pending.is_set():
+        return
+    _evict_pending.set()
+    executor().submit(_evict_in_background)
+
+
+def created(archive_no):
+    """Give a new archive its first access and keep the hot tier bounded."""
+    if not enabled():
+        return
+    touch(archive_no)
+    evict_soon()
+
+
+def discard(archive_no, codec=None):
+    """Remove an archive's cold copies, full or delta, if any."""
+    if not enabled():
+        return
+
+    for delta in (False, True):
+        backend().delete(file_name(archive_no, codec, delta))
+    aux.set_cold_copy([archive_no], False)
+
+
+def report():
+    """Summarise the use of both tiers."""
+    conf = settings()
+    files = hot_files(conf['storage'])
+    result = {'hot_archives': len(files),
+              'hot_bytes': usage(files),
+              'hot_limit_bytes': conf['hot_tier_bytes'],
+              'cold_storage': conf['cold_storage'] or None}
+
+    if conf['cold_storage']:
+        inventory = backend().inventory()
+        result.update(cold_archives=len(inventory),
+                      cold_bytes=sum(inventory.values()),
+                      cold_only=len(set(inventory) - set(files)))
+
+    return result
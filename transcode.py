@@ -0,0 +1,287 @@
+"""Decompressed and converted forms of archive files.
+
+format=raw streams the archive decompressed. The other formats convert the
+decompressed data as it is read: CSV, TSV and TXT archives can be served as
+NDJSON, and, when the optional pyarrow package is installed, as an Arrow IPC
+stream or Parquet. Converted output is streamed to the client and written
+to an on-disk cache at the same time, so the next request for that archive
+and format is a plain file download (with ranges and revalidation).
+
+The cache lives in derived_cache_dir (default <storage>/.derived) and is
+kept under derived_cache_bytes by evicting the least recently used files.
+Entries are keyed by the SHA-256 of the uncompressed data where it is
+known, so identical archives share them and re-encoding does not
+invalidate them.
+"""
+
+import csv
+import fcntl
+import io
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import compression
+from download import CHUNK_SIZE, ChunkWriter
+
+try:
+    import pyarrow
+    import pyarrow.csv
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# Rows per NDJSON chunk
+ROW_BATCH = 1000
+
+TEXT_TYPES = {'.csv': ('text/csv', ','),
+              '.txt': ('text/plain', ','),
+              '.tsv': ('text/tab-separated-values', '\t'),
+              '.json': ('application/json', None)}
+
+
+class Unsupported(ValueError):
+    """Raised for a format that cannot be produced from an archive."""
+
+
+def decompressed(path, codec):
+    """Yield the uncompressed contents of an archive file in chunks."""
+    with open(path, 'rb') as f, \
+            compression.get(codec).open_reader(f) as reader:
+        while True:
+            chunk = reader.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+def content(entry):
+    """Return the uncompressed contents of a catalog entry in chunks.
+
+    Delta archives are rebuilt from their chain while they are read, and
+    archives in the cold tier are promoted first.
+    """
+    import tiers
+
+    entry = tiers.local(entry)
+    if entry.base is None:
+        return decompressed(entry.path, entry.codec)
+
+    import delta
+
+    return delta.rebuild(delta.chain(entry))
+
+
+class ChunkReader(io.RawIOBase):
+    """Binary file over an iterator of byte chunks."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            self.pending = next(self.chunks, b'')
+            if not self.pending:
+                return 0
+        n = min(len(buffer), len(self.pending))
+        buffer[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+
+def delimiter(file_type):
+    _, sep = TEXT_TYPES.get(file_type, (None, None))
+    if sep is None:
+        raise Unsupported(f'Cannot convert {file_type or "unknown"} archives')
+    return sep
+
+
+def ndjson(chunks, file_type):
+    """Convert delimited text to one JSON object per line."""
+    sep = delimiter(file_type)
+    text = io.TextIOWrapper(io.BufferedReader(ChunkReader(chunks)),
+                            encoding='utf-8', errors='replace', newline='')
+    reader = csv.reader(text, delimiter=sep)
+
+    header = next(reader, None)
+    if header is None:
+        return
+
+    lines = list()
+    for row in reader:
+        lines.append(json.dumps(dict(zip(header, row))))
+        if len(lines) >= ROW_BATCH:
+            yield ('\n'.join(lines) + '\n').encode()
+            lines.clear()
+
+    if lines:
+        yield ('\n'.join(lines) + '\n').encode()
+
+
+def _arrow_batches(chunks, file_type):
+    sep = delimiter(file_type)
+    source = io.BufferedReader(ChunkReader(chunks), CHUNK_SIZE)
+    return pyarrow.csv.open_csv(
+        source,
+        read_options=pyarrow.csv.ReadOptions(block_size=CHUNK_SIZE),
+        parse_options=pyarrow.csv.ParseOptions(delimiter=sep))
+
+
+def arrow(chunks, file_type):
+    """Convert delimited text to an Arrow IPC stream."""
+    batches = _arrow_batches(chunks, file_type)
+    sink = ChunkWriter()
+
+    with pyarrow.ipc.new_stream(sink, batches.schema) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+            yield sink.drain()
+
+    yield sink.drain()
+
+
+def parquet(chunks, file_type):
+    """Convert delimited text to Parquet."""
+    batches = _arrow_batches(chunks, file_type)
+    sink = ChunkWriter()
+
+    with pyarrow.parquet.ParquetWriter(sink, batches.schema) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+            yield sink.drain()
+
+    yield sink.drain()
+
+
+# format: (converter, mimetype, extension)
+FORMATS = {'ndjson': (ndjson, 'application/x-ndjson', '.ndjson')}
+
+if pyarrow is not None:
+    FORMATS['arrow'] = (arrow, 'application/vnd.apache.arrow.stream',
+                        '.arrows')
+    FORMATS['parquet'] = (parquet, 'application/vnd.apache.parquet',
+                          '.parquet')
+
+
+def check(entry, fmt):
+    """Raise Unsupported unless entry can be served in fmt."""
+    if fmt == 'raw':
+        return
+    if fmt not in FORMATS:
+        raise Unsupported(f'Unsupported format: {fmt}')
+    delimiter(entry.file_type)
+
+
+def raw_mimetype(file_type):
+    return TEXT_TYPES.get(file_type, ('application/octet-stream',))[0]
+
+
+def cache_dir():
+    import aux
+
+    return aux.get_config('derived_cache_dir',
+                          os.path.join(aux.get_config('storage'), '.derived'))
+
+
+def cache_path(entry, fmt, digest=None):
+    """Return the cache file for an archive in a format."""
+    if digest:
+        name = digest
+    else:
+        name = f'{entry.archive_no}-{entry.size:x}-{entry.stat.st_mtime_ns:x}'
+    return os.path.join(cache_dir(), name + FORMATS[fmt][2])
+
+
+def cached(path):
+    """Return the stat of a cached file and mark it used, or None.
+
+    Use is recorded in the access time; the modification time is left
+    alone so ETags, and with them range resumes, stay valid.
+    """
+    try:
+        st = os.stat(path)
+        os.utime(path, ns=(time.time_ns(), st.st_mtime_ns))
+    except FileNotFoundError:
+        return None
+    return st
+
+
+@contextmanager
+def locked():
+    """Serialise cache eviction across threads and processes."""
+    root = cache_dir()
+    os.makedirs(root, exist_ok=True)
+
+    with open(os.path.join(root, '.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def evict(limit=None):
+    """Remove least recently used files until the cache fits in limit."""
+    import aux
+
+    if limit is None:
+        limit = int(aux.get_config('derived_cache_bytes', 10 * 1024 ** 3))
+
+    root = cache_dir()
+    with locked():
+        files = list()
+        for name in os.listdir(root):
+            if name.startswith('.') or name.endswith('.part'):
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((st.st_atime, st.st_size, path))
+
+        total = sum(size for _, size, _ in files)
+        for atime, size, path in sorted(files):
+            if total <= limit:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    return total
+
+
+def convert(entry, fmt, path):
+    """Yield an archive converted to fmt while saving it to path.
+
+    The file only appears in the cache once the conversion finished, so an
+    interrupted request leaves nothing behind.
+    """
+    converter = FORMATS[fmt][0]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partpath = f'{path}.{os.getpid()}.{threading.get_ident()}.part'
+
+    try:
+        with open(partpath, 'wb') as out:
+            for chunk in converter(content(entry), entry.file_type):
+                if chunk:
+                    out.write(chunk)
+                    yield chunk
+
+        os.replace(partpath, path)
+
+    finally:
+        if os.path.exists(partpath):
+            os.remove(partpath)
+
+    evict()
@@ -0,0 +1,459 @@
+"""Client for fetches from the data service.
+
+Archive data is fetched with a Fetch, which adds to a plain GET:
+
+    timeouts    fetch_connect_timeout seconds to connect and
+                fetch_read_timeout seconds for each read, including the
+                wait for the response headers
+    retries     up to fetch_attempts tries in all for connection errors,
+                timeouts and 429, 502, 503 and 504 responses, backing off
+                from fetch_retry_base seconds or as Retry-After asks
+    resumes     a body cut off part way is continued with a Range request
+                when the response had an ETag or Last-Modified and the data
+                service answers 206; otherwise the fetch starts over
+    slots       at most fetch_max_concurrent fetches on this host and
+                fetch_max_per_user per authorizer, held as locked slot
+                files under <storage>/.fetch/ so the limits apply across
+                threads and uwsgi processes
+    breaker     after fetch_breaker_failures failed tries in a row, fetches
+                in this process fail at once for fetch_breaker_reset
+                seconds; then a single trial decides whether to resume
+"""
+
+import email.utils
+import fcntl
+import hashlib
+import http.client
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import urllib.parse
+from contextlib import ExitStack, contextmanager
+
+import metrics
+
+
+logger = logging.getLogger('archiver.upstream')
+
+RETRY_STATUS = (429, 502, 503, 504)
+REDIRECT_STATUS = (301, 302, 303, 307, 308)
+PRIVATE_HEADERS = ('authorization', 'cookie')
+MAX_REDIRECTS = 5
+
+# Seconds between scans for a free slot
+SLOT_POLL = 0.25
+
+
+class UpstreamError(Exception):
+    """Raised when the data service cannot be fetched from."""
+
+
+class CircuitOpen(UpstreamError):
+    """Raised while the circuit breaker rejects fetches."""
+
+
+class SlotTimeout(UpstreamError):
+    """Raised when no fetch slot became free in time."""
+
+
+class Interrupted(UpstreamError):
+    """Raised when a response body was cut off and could not be resumed."""
+
+
+_settings = None
+_settings_lock = threading.Lock()
+
+
+def settings():
+    """Return the fetch settings, read once per process."""
+    global _settings
+
+    if _settings is None:
+        import aux
+
+        with _settings_lock:
+            if _settings is None:
+                _settings = {
+                    'slot_dir': os.path.join(aux.get_config('storage'),
+                                             '.fetch'),
+                    'connect_timeout': float(aux.get_config(
+                        'fetch_connect_timeout', 10)),
+                    'read_timeout': float(aux.get_config(
+                        'fetch_read_timeout', 600)),
+                    'attempts': int(aux.get_config('fetch_attempts', 3)),
+                    'retry_base': float(aux.get_config('fetch_retry_base',
+                                                       2)),
+                    'max_concurrent': int(aux.get_config(
+                        'fetch_max_concurrent', 8)),
+                    'max_per_user': int(aux.get_config('fetch_max_per_user',
+                                                       2)),
+                    'slot_timeout': float(aux.get_config(
+                        'fetch_slot_timeout', 600)),
+                    'breaker_failures': int(aux.get_config(
+                        'fetch_breaker_failures', 5)),
+                    'breaker_reset': float(aux.get_config(
+                        'fetch_breaker_reset', 30))}
+    return _settings
+
+
+class Breaker:
+    """Circuit breaker over consecutive failed tries."""
+
+    def __init__(self, failures, reset):
+        self.threshold = failures
+        self.reset = reset
+        self.state = 'closed'
+        self.failures = 0
+        self.opened = 0.0
+        self.trial = False
+        self._lock = threading.Lock()
+
+    def rejecting(self):
+        """Whether fetches are failing fast without a try being due."""
+        with self._lock:
+            return self.state == 'open' and \
+                time.monotonic() - self.opened < self.reset
+
+    def allow(self):
+        """Whether a try may go ahead; claims the trial when half-open."""
+        with self._lock:
+            if self.state == 'open':
+                if time.monotonic() - self.opened < self.reset:
+                    return False
+                self.state, self.trial = 'half-open', False
+            if self.state == 'half-open':
+                if self.trial:
+                    return False
+                self.trial = True
+            return True
+
+    def success(self):
+        with self._lock:
+            if self.state != 'closed':
+                logger.info('Data service recovered, circuit closed')
+                metrics.BREAKER_OPEN.dec()
+            self.state, self.failures, self.trial = 'closed', 0, False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial = False
+            if self.state == 'half-open' or (
+                    self.state == 'closed' and self.threshold and
+                    self.failures >= self.threshold):
+                if self.state == 'closed':
+                    metrics.BREAKER_OPEN.inc()
+                    logger.error(f'Data service failed {self.failures} '
+                                 'times in a row, circuit opened')
+                self.state = 'open'
+                self.opened = time.monotonic()
+
+
+_breaker = None
+
+
+def breaker():
+    """Return this process's circuit breaker."""
+    global _breaker
+
+    if _breaker is None:
+        conf = settings()
+        with _settings_lock:
+            if _breaker is None:
+                _breaker = Breaker(conf['breaker_failures'],
+                                   conf['breaker_reset'])
+    return _breaker
+
+
+@contextmanager
+def slot(name, count, timeout):
+    """Hold one of count slot files, waiting up to timeout seconds."""
+    if count <= 0:
+        yield
+        return
+
+    root = settings()['slot_dir']
+    os.makedirs(root, exist_ok=True)
+    scope = name.split('-', 1)[0]
+    start = time.monotonic()
+
+    while True:
+        for i in range(count):
+            f = open(os.path.join(root, f'{name}-{i}.lock'), 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                continue
+
+            metrics.FETCH_SLOT_SECONDS.observe(time.monotonic() - start,
+                                               scope=scope)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+                f.close()
+            return
+
+        if time.monotonic() - start >= timeout:
+            metrics.FETCH_SLOT_TIMEOUTS.inc(scope=scope)
+            raise SlotTimeout(f'No free {scope} fetch slot after '
+                              f'{timeout:.0f} s')
+        time.sleep(SLOT_POLL)
+
+
+def user_slot_name(user):
+    return 'user-' + hashlib.sha256(str(user).encode()).hexdigest()[:16]
+
+
+class Fetch:
+    """A GET from the data service with its retry budget and slots.
+
+    Use as a context manager, which holds the slots, and call open() for
+    the response; open() again to start over after Interrupted.
+    """
+
+    def __init__(self, uri, headers=None, user=None):
+        self.uri = uri
+        self.headers = dict(headers or {})
+        self.user = user
+        self.tries = 0
+        self._slots = None
+
+    def __enter__(self):
+        conf = settings()
+        # Fail before queueing for a slot
+        if breaker().rejecting():
+            metrics.BREAKER_REJECTIONS.inc()
+            raise CircuitOpen('Data service circuit is open')
+
+        self._slots = ExitStack()
+        try:
+            if self.user is not None:
+                self._slots.enter_context(slot(user_slot_name(self.user),
+                                               conf['max_per_user'],
+                                               conf['slot_timeout']))
+            self._slots.enter_context(slot('global', conf['max_concurrent'],
+                                           conf['slot_timeout']))
+        except BaseException:
+            self._slots.close()
+            raise
+
+        metrics.FETCH_IN_FLIGHT.inc()
+        return self
+
+    def __exit__(self, *exc):
+        metrics.FETCH_IN_FLIGHT.dec()
+        self._slots.close()
+
+    def backoff(self, retry_after=None):
+        """Sleep before the next try; False if the budget is spent."""
+        if self.tries >= settings()['attempts']:
+            return False
+        delay = settings()['retry_base'] * 2 ** (self.tries - 1)
+        delay *= random.uniform(0.5, 1.0)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, 300))
+        time.sleep(delay)
+        return True
+
+    def _connect(self, uri, headers):
+        """Send one GET, following redirects; return the response."""
+        conf = settings()
+
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(uri)
+            if parts.scheme == 'https':
+                conn = http.client.HTTPSConnection(
+                    parts.hostname, parts.port,
+                    timeout=conf['connect_timeout'])
+            else:
+                conn = http.client.HTTPConnection(
+                    parts.hostname, parts.port,
+                    timeout=conf['connect_timeout'])
+
+            try:
+                conn.connect()
+            except socket.timeout as e:
+                conn.close()
+                raise _Failure('connect_timeout', e)
+            except OSError as e:
+                conn.close()
+                raise _Failure('connection_error', e)
+
+            conn.sock.settimeout(conf['read_timeout'])
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+            except socket.timeout as e:
+                conn.close()
+                raise _Failure('read_timeout', e)
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                raise _Failure('connection_error', e)
+
+            location = response.getheader('Location')
+            if response.status not in REDIRECT_STATUS or not location:
+                return Response(self, response, conn)
+            response.close()
+            conn.close()
+            uri = urllib.parse.urljoin(uri, location)
+
+            # Credentials are only for the data service itself
+            if urllib.parse.urlsplit(uri).hostname != parts.hostname:
+                headers = {name: value for name, value in headers.items()
+                           if name.lower() not in PRIVATE_HEADERS}
+
+        raise UpstreamError(f'Too many redirects for {self.uri}')
+
+    def open(self, offset=0, validator=None):
+        """Return a Response, retrying failed tries within the budget.
+
+        Responses with an error status are returned once retrying them is
+        no longer possible; the caller decides what they mean.
+        """
+        headers = dict(self.headers)
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+            headers['If-Range'] = validator
+
+        while True:
+            if not breaker().allow():
+                metrics.BREAKER_REJECTIONS.inc()
+                raise CircuitOpen('Data service circuit is open')
+            self.tries += 1
+
+            try:
+                response = self._connect(self.uri, headers)
+            except _Failure as e:
+                self.failed(e.outcome)
+                logger.info(f'Fetch try {self.tries} of {self.uri}: '
+                            f'{e.outcome} ({e.error})')
+                if not self.backoff():
+                    raise UpstreamError(f'Data service {e.outcome}') \
+                        from e.error
+                continue
+
+            if response.status in RETRY_STATUS or response.status >= 500:
+                self.failed('server_error')
+                if response.status in RETRY_STATUS and \
+                        self.backoff(response.retry_after()):
+                    response.close()
+                    continue
+                return response
+
+            breaker().success()
+            metrics.FETCH_TRIES.inc(outcome='ok')
+            return response
+
+    def failed(self, outcome):
+        """Count a failed try."""
+        breaker().failure()
+        metrics.FETCH_TRIES.inc(outcome=outcome)
+
+
+class _Failure(Exception):
+    def __init__(self, outcome, error):
+        super().__init__(outcome)
+        self.outcome = outcome
+        self.error = error
+
+
+class Response:
+    """A data service response whose body resumes after interruptions.
+
+    status, reason, version and headers are those of the first response,
+    as written to the archive's .header file.
+    """
+
+    def __init__(self, fetch, response, conn):
+        self.fetch = fetch
+        self.response = response
+        self.conn = conn
+        self.status = response.status
+        self.reason = response.reason
+        self.version = response.version
+        self.headers = response.headers
+        self.received = 0
+
+        length = response.getheader('Content-Length')
+        self.length = int(length) if length and length.isdigit() else None
+        self.validator = (response.getheader('ETag') or
+                          response.getheader('Last-Modified'))
+
+    def retry_after(self):
+        value = self.response.getheader('Retry-After')
+        if not value:
+            return None
+        if value.isdigit():
+            return int(value)
+        try:
+            when = email.utils.parsedate_to_datetime(value)
+            return max(when.timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            return None
+
+    def read(self, size=-1):
+        while True:
+            try:
+                chunk = self.response.read(None if size < 0 else size)
+            except socket.timeout:
+                self._resume('read_timeout')
+                continue
+            except (OSError, http.client.HTTPException):
+                self._resume('connection_error')
+                continue
+
+            if not chunk and self.length is not None and \
+                    self.received < self.length:
+                self._resume('connection_error')
+                continue
+
+            self.received += len(chunk)
+            return chunk
+
+    def _resume(self, outcome):
+        """Continue the body from where it stopped, or raise Interrupted."""
+        fetch = self.fetch
+        fetch.failed(outcome)
+        self._close()
+
+        if not self.validator or self.status != 200:
+            metrics.FETCH_RESUMES.inc(result='unsupported')
+            raise Interrupted(f'Data service {outcome} after '
+                              f'{self.received} bytes')
+        if not fetch.backoff():
+            raise Interrupted(f'Data service {outcome} after '
+                              f'{self.received} bytes, out of retries')
+
+        resumed = fetch.open(self.received, self.validator)
+        content_range = resumed.response.getheader('Content-Range') or ''
+        if resumed.status != 206 or not content_range.startswith(
+                f'bytes {self.received}-'):
+            resumed.close()
+            metrics.FETCH_RESUMES.inc(result='refused')
+            raise Interrupted(f'Data service would not resume at byte '
+                              f'{self.received}')
+
+        logger.info(f'Resumed {fetch.uri} at byte {self.received}')
+        metrics.FETCH_RESUMES.inc(result='resumed')
+        self.response, self.conn = resumed.response, resumed.conn
+
+    def _close(self):
+        self.response.close()
+        self.conn.close()
+
+    def close(self):
+        self._close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()